@@ -0,0 +1,206 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from boto3.dynamodb.conditions import Key
+
+from common import background, clients
+from common.embedding_cache import pack_vector, unpack_vector
+
+# Semantic answer cache: a question whose embedding is within ANSWER_CACHE_THRESHOLD
+# (cosine) of an earlier one in the same document scope gets the earlier answer back.
+# Each scope carries a version that ingestion bumps, which retires every older entry.
+# Scopes are per case ("{case_id}:{doc_id or *}"), so one case never sees another's answers.
+ANSWER_CACHE = os.environ.get('ANSWER_CACHE', 'dynamodb')  # dynamodb | sqlite | none
+ANSWER_CACHE_TABLE = os.environ.get('ANSWER_CACHE_TABLE', 'CaseChat_AnswerCache')
+ANSWER_CACHE_PATH = os.environ.get('ANSWER_CACHE_PATH', '/tmp/answer_cache.sqlite3')
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('ANSWER_CACHE_THRESHOLD', '0.95'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', '100'))  # compared per lookup
+ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', str(7 * 24 * 3600)))
+ALL_DOCUMENTS = '*'
+VERSION_KEY = '#version'
+
+
+def scope_for(doc_id, case_id=None):
+    scope = doc_id or ALL_DOCUMENTS
+    return f"{case_id}:{scope}" if case_id else scope
+
+
+def normalize(vector):
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class DynamoDBAnswerBackend:
+    """Items are (scope, entry_id); entry IDs start with the write time so newest sort last."""
+
+    def __init__(self, table_name=ANSWER_CACHE_TABLE):
+        self.table_name = table_name
+        self.table = clients.table(table_name)
+
+    def version(self, scope):
+        item = self.table.get_item(Key={'scope': scope, 'entry_id': VERSION_KEY}).get('Item')
+        return int(item['version']) if item else 0
+
+    def entries(self, scope, limit):
+        response = self.table.query(
+            KeyConditionExpression=Key('scope').eq(scope) & Key('entry_id').gt('0'),
+            ScanIndexForward=False,
+            Limit=limit
+        )
+        now = time.time()
+        return [
+            {**item, 'version': int(item['version']), 'vector': unpack_vector(item['vector'].value)}
+            for item in response.get('Items', []) if int(item.get('expires_at', 0)) > now
+        ]
+
+    def put(self, scope, entry):
+        background.put_item(self.table_name, {**entry, 'scope': scope, 'vector': pack_vector(entry['vector'])})
+
+    def bump(self, scope):
+        self.table.update_item(
+            Key={'scope': scope, 'entry_id': VERSION_KEY},
+            UpdateExpression='ADD version :one',
+            ExpressionAttributeValues={':one': 1}
+        )
+
+
+class SQLiteAnswerBackend:
+    """Local stand-in for development and offline tests."""
+
+    def __init__(self, path=ANSWER_CACHE_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS versions (scope TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers (scope TEXT, entry_id TEXT, version INTEGER, vector BLOB, "
+            "query TEXT, answer TEXT, sources TEXT, expires_at REAL, PRIMARY KEY (scope, entry_id))"
+        )
+        self.conn.commit()
+
+    def version(self, scope):
+        with self.lock:
+            row = self.conn.execute("SELECT version FROM versions WHERE scope = ?", (scope,)).fetchone()
+        return row[0] if row else 0
+
+    def entries(self, scope, limit):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT entry_id, version, vector, query, answer, sources FROM answers "
+                "WHERE scope = ? AND expires_at > ? ORDER BY entry_id DESC LIMIT ?",
+                (scope, time.time(), limit)
+            ).fetchall()
+        return [
+            {'entry_id': entry_id, 'version': version, 'vector': unpack_vector(vector),
+             'query': query, 'answer': answer, 'sources': sources}
+            for entry_id, version, vector, query, answer, sources in rows
+        ]
+
+    def put(self, scope, entry):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (scope, entry['entry_id'], entry['version'], pack_vector(entry['vector']), entry['query'],
+                 entry['answer'], entry['sources'], entry['expires_at'])
+            )
+            self.conn.commit()
+
+    def bump(self, scope):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO versions VALUES (?, 1) ON CONFLICT(scope) DO UPDATE SET version = version + 1",
+                (scope,)
+            )
+            self.conn.execute("DELETE FROM answers WHERE scope = ?", (scope,))
+            self.conn.commit()
+
+
+class AnswerCache:
+    def __init__(self, backend, threshold=ANSWER_CACHE_THRESHOLD, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.backend = backend
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def candidates(self, doc_id, case_id=None):
+        """Reads a scope's (version, entries); doesn't need the query vector, so it can overlap with embedding."""
+        scope = scope_for(doc_id, case_id)
+        try:
+            return self.backend.version(scope), self.backend.entries(scope, self.max_entries)
+        except Exception as e:
+            print(f"Answer cache read failed: {e}")
+            return None, []
+
+    def match(self, query_vector, version, entries):
+        """
+        Returns (hit, version). `hit` is the closest current entry above the threshold
+        (with 'answer', 'sources' and 'similarity') or None; pass `version` back to store().
+        """
+        if version is None:
+            return None, None
+        query_vector = normalize(query_vector)
+        best, best_similarity = None, self.threshold
+        for entry in entries:
+            if entry['version'] != version:
+                continue
+            similarity = sum(a * b for a, b in zip(query_vector, entry['vector']))
+            if similarity >= best_similarity:
+                best, best_similarity = entry, similarity
+        if best is None:
+            self.misses += 1
+            return None, version
+        self.hits += 1
+        return {
+            'query': best['query'],
+            'answer': best['answer'],
+            'sources': json.loads(best['sources']),
+            'similarity': best_similarity
+        }, version
+
+    def lookup(self, doc_id, query_vector, case_id=None):
+        return self.match(query_vector, *self.candidates(doc_id, case_id))
+
+    def store(self, doc_id, query_vector, query, answer, sources, version, case_id=None):
+        if version is None:
+            return
+        entry = {
+            'entry_id': f"{time.time():017.6f}#{uuid.uuid4().hex[:8]}",
+            'version': version,
+            'vector': normalize(query_vector),
+            'query': query,
+            'answer': answer,
+            'sources': json.dumps(sources, default=str),
+            'expires_at': int(time.time() + ANSWER_CACHE_TTL)
+        }
+        try:
+            self.backend.put(scope_for(doc_id, case_id), entry)
+        except Exception as e:
+            print(f"Answer cache write failed: {e}")
+
+    def invalidate(self, doc_id, case_id=None):
+        """Retires cached answers that could have drawn on doc_id: its own scope and the case's all-documents scope."""
+        for scope in (scope_for(doc_id, case_id), scope_for(None, case_id)):
+            try:
+                self.backend.bump(scope)
+            except Exception as e:
+                print(f"Answer cache invalidation failed ({scope}): {e}")
+
+
+def build_answer_cache(kind=ANSWER_CACHE):
+    if kind == 'none':
+        return None
+    if kind == 'sqlite':
+        return AnswerCache(SQLiteAnswerBackend())
+    return AnswerCache(DynamoDBAnswerBackend())
+
+
+def get_answer_cache():
+    """The process-wide answer cache, built on first use; None when ANSWER_CACHE=none."""
+    if ANSWER_CACHE == 'none':
+        return None
+    return clients.lazy('answer_cache', build_answer_cache)
@@ -0,0 +1,92 @@
+import gzip
+import json
+import os
+
+from botocore.exceptions import ClientError
+
+from common import clients
+
+# Per-document build artifacts (chunk manifests, offset indexes, ...) live next to the
+# evidence under ARTIFACT_PREFIX. Set ARTIFACT_DIR to keep them on local disk instead.
+ARTIFACT_BUCKET = os.environ.get('ARTIFACT_BUCKET') or os.environ.get('BUCKET_NAME')
+ARTIFACT_PREFIX = os.environ.get('ARTIFACT_PREFIX', '_lexguard/')
+ARTIFACT_DIR = os.environ.get('ARTIFACT_DIR')
+
+
+def artifact_key(doc_id, name):
+    return f"{ARTIFACT_PREFIX}{doc_id}/{name}"
+
+
+def put_object(key, body):
+    """Writes raw bytes under a full artifact key (see artifact_key)."""
+    if ARTIFACT_DIR:
+        path = os.path.join(ARTIFACT_DIR, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+        return
+    clients.s3().put_object(Bucket=ARTIFACT_BUCKET, Key=key, Body=body)
+
+
+def open_object(key):
+    """Readable binary stream of an artifact, or None if it has never been written. Close it when done."""
+    if ARTIFACT_DIR:
+        path = os.path.join(ARTIFACT_DIR, key)
+        if not os.path.exists(path):
+            return None
+        return open(path, 'rb')
+    try:
+        return clients.s3().get_object(Bucket=ARTIFACT_BUCKET, Key=key)['Body']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+
+
+def put_json(doc_id, name, data):
+    body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    if name.endswith('.gz'):
+        body = gzip.compress(body)
+    put_object(artifact_key(doc_id, name), body)
+
+
+def get_json(doc_id, name):
+    """Returns the parsed artifact, or None if it has never been written."""
+    stream = open_object(artifact_key(doc_id, name))
+    if stream is None:
+        return None
+    try:
+        body = stream.read()
+    finally:
+        stream.close()
+    if name.endswith('.gz'):
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+
+def delete_json(doc_id, name):
+    key = artifact_key(doc_id, name)
+    if ARTIFACT_DIR:
+        path = os.path.join(ARTIFACT_DIR, key)
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    clients.s3().delete_object(Bucket=ARTIFACT_BUCKET, Key=key)
+
+
+def list_doc_ids(name):
+    """Doc IDs that have an artifact called `name` (one LIST page per 1000 artifacts on S3)."""
+    root = os.path.join(ARTIFACT_DIR or '', ARTIFACT_PREFIX)
+    if ARTIFACT_DIR:
+        doc_ids = []
+        for dirpath, _, filenames in os.walk(root):
+            if name in filenames:
+                doc_ids.append(os.path.relpath(dirpath, root).replace(os.sep, '/'))
+        return doc_ids
+    doc_ids = []
+    paginator = clients.s3().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=ARTIFACT_BUCKET, Prefix=ARTIFACT_PREFIX):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/' + name):
+                doc_ids.append(obj['Key'][len(ARTIFACT_PREFIX):-len(name) - 1])
+    return doc_ids
@@ -0,0 +1,405 @@
+import atexit
+import base64
+import datetime
+import functools
+import hashlib
+import heapq
+import json
+import os
+import threading
+import time
+import uuid
+
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+
+from common import background, clients
+
+# Audit log with per-partition hash chains. Every writer process owns one chain (its chain_id):
+# each record carries its position (seq), the previous record's hash (prev_hash) and its own
+# hash = sha256(prev_hash | canonical event), so removing, reordering or editing a record breaks
+# the chain. Events are buffered in-process and flushed as one BatchWriteItem (through the
+# background writer) when AUDIT_BATCH_SIZE events are waiting, when the oldest has waited
+# AUDIT_FLUSH_SECONDS, or at the end of the invocation (see flushes). Each flush also writes the
+# chain's head item (log_id "CHAIN#{chain_id}") so a truncated tail can be told from a short chain.
+AUDIT_TABLE_NAME = os.environ.get('AUDIT_TABLE_NAME', 'CaseChat_Audit')
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', '24'))  # + the head item = one BatchWriteItem
+AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', '2'))
+# How long a handler waits at the end of an invocation for the audit batch to be written
+AUDIT_FLUSH_TIMEOUT = float(os.environ.get('AUDIT_FLUSH_TIMEOUT', str(background.BACKGROUND_FLUSH_TIMEOUT)))
+# Reads (query_events) go through two sparse GSIs, so their cost depends on the time range and
+# page size asked for, never on the table size:
+#   bucket-timestamp-index:  bucket = UTC day ("2026-01-31", or "2026-01-31#<shard>" with
+#                            AUDIT_BUCKET_SHARDS > 1 to spread a busy day's writes; a chain
+#                            always writes to the same shard)
+#   user_id-timestamp-index: one user's events
+AUDIT_BUCKET_INDEX = os.environ.get('AUDIT_BUCKET_INDEX', 'bucket-timestamp-index')
+AUDIT_USER_INDEX = os.environ.get('AUDIT_USER_INDEX', 'user_id-timestamp-index')
+AUDIT_BUCKET_SHARDS = int(os.environ.get('AUDIT_BUCKET_SHARDS', '1'))
+AUDIT_MAX_RANGE_DAYS = int(os.environ.get('AUDIT_MAX_RANGE_DAYS', '31'))  # days walked back when no start is given
+AUDIT_PAGE_SIZE = 20
+AUDIT_MAX_PAGE_SIZE = 500
+GENESIS_HASH = '0' * 64
+CHAIN_PREFIX = 'CHAIN#'
+HEAD_TIMESTAMP = 'HEAD'
+HASHED_FIELDS = ('chain_id', 'seq', 'timestamp', 'case_id', 'user_id', 'action', 'resource', 'details')
+
+
+def record_hash(prev_hash, record):
+    canonical = json.dumps([str(record.get(field, '')) for field in HASHED_FIELDS], separators=(',', ':'))
+    return hashlib.sha256(f"{prev_hash}|{canonical}".encode()).hexdigest()
+
+
+def bucket_for(timestamp, shard=0):
+    day = timestamp[:10]
+    return f"{day}#{shard}" if AUDIT_BUCKET_SHARDS > 1 else day
+
+
+def shard_for(chain_id):
+    return int(hashlib.sha256(chain_id.encode()).hexdigest()[:8], 16) % max(1, AUDIT_BUCKET_SHARDS)
+
+
+def is_head(item):
+    return str(item.get('log_id', '')).startswith(CHAIN_PREFIX)
+
+
+class AuditLog:
+    def __init__(self, table_name=AUDIT_TABLE_NAME, batch_size=AUDIT_BATCH_SIZE, flush_seconds=AUDIT_FLUSH_SECONDS,
+                 chain_id=None):
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        # Log stream names are unique per Lambda container; the suffix covers local processes
+        stream = os.environ.get('AWS_LAMBDA_LOG_STREAM_NAME', 'local').rsplit(']', 1)[-1]
+        self.chain_id = chain_id or f"{stream}-{uuid.uuid4().hex[:12]}"
+        self.shard = shard_for(self.chain_id)
+        self.seq = 0
+        self.prev_hash = GENESIS_HASH
+        self.buffer = []
+        self.oldest = None
+        self.lock = threading.Lock()
+
+    def log(self, user_id, action, resource, details, case_id='system_global'):
+        """Chains the event and buffers it. Returns its hash."""
+        with self.lock:
+            record = {
+                'chain_id': self.chain_id,
+                'seq': self.seq,
+                'timestamp': datetime.datetime.utcnow().isoformat(),
+                'case_id': case_id,
+                'user_id': user_id,
+                'action': action,
+                'resource': resource,
+                'details': details,
+                'prev_hash': self.prev_hash
+            }
+            record['hash'] = record_hash(self.prev_hash, record)
+            record['log_id'] = record['hash']
+            record['bucket'] = bucket_for(record['timestamp'], self.shard)
+            self.seq += 1
+            self.prev_hash = record['hash']
+            self.buffer.append(record)
+            if self.oldest is None:
+                self.oldest = time.time()
+            due = len(self.buffer) >= self.batch_size or time.time() - self.oldest >= self.flush_seconds
+        if due:
+            self.flush()
+        return record['hash']
+
+    def flush(self):
+        """Hands the buffered records (and the updated head) to the background writer."""
+        with self.lock:
+            if not self.buffer:
+                return 0
+            records, self.buffer, self.oldest = self.buffer, [], None
+            head = {
+                'log_id': f"{CHAIN_PREFIX}{self.chain_id}",
+                'timestamp': HEAD_TIMESTAMP,
+                'chain_id': self.chain_id,
+                'seq': records[-1]['seq'],
+                'hash': records[-1]['hash'],
+                'updated': records[-1]['timestamp']
+            }
+            # Queued under the lock so batches reach the writer in chain order
+            for start in range(0, len(records), self.batch_size):
+                batch = records[start:start + self.batch_size]
+                background.put_items(self.table_name, batch + ([head] if start + self.batch_size >= len(records) else []))
+        return len(records)
+
+
+_audit_log = None
+_audit_lock = threading.Lock()
+
+
+def get_audit_log():
+    global _audit_log
+    if _audit_log is None:
+        with _audit_lock:
+            if _audit_log is None:
+                _audit_log = AuditLog()
+                atexit.register(_audit_log.flush)
+    return _audit_log
+
+
+def log_event(user_id, action, resource, details, case_id='system_global'):
+    try:
+        return get_audit_log().log(user_id, action, resource, details, case_id)
+    except Exception as e:
+        print(f"AUDIT FAILURE: {e}")
+        return None
+
+
+def flush():
+    try:
+        return get_audit_log().flush()
+    except Exception as e:
+        print(f"AUDIT FAILURE: {e}")
+        return 0
+
+
+def flushes(handler):
+    """
+    Decorator for Lambda handlers: buffered audit events (and every other background write) are
+    written before the invocation returns, waiting up to AUDIT_FLUSH_TIMEOUT seconds, since a
+    frozen container runs no background thread.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            flush()
+            background.flush(AUDIT_FLUSH_TIMEOUT)
+    return wrapper
+
+
+def link_digest(seq, record_hash_hex):
+    return int.from_bytes(hashlib.sha256(f"{seq}:{record_hash_hex}".encode()).digest(), 'big')
+
+
+class ChainVerifier:
+    """
+    Order-independent, single-pass verification with O(chains) memory, so a full table scan
+    can be checked however its pages come back. Per chain it sums link digests of
+    (seq, hash) and of (seq - 1, prev_hash): when every record's prev_hash is its
+    predecessor's hash the two sums differ by exactly the tail's digest. Together with the
+    count (seq 0..max with no gaps or duplicates) and each record's recomputed hash, that
+    detects edited, deleted, inserted and reordered records.
+    """
+    MOD = 1 << 256
+
+    def __init__(self):
+        self.chains = {}
+        self.heads = {}
+        self.records = 0
+        self.errors = []
+
+    def add(self, item):
+        if is_head(item):
+            self.heads[item['chain_id']] = (int(item['seq']), item['hash'])
+            return
+        self.records += 1
+        seq = int(item['seq'])
+        chain = self.chains.setdefault(item['chain_id'], {'count': 0, 'produced': 0, 'consumed': 0, 'tail': (-1, None)})
+        if record_hash(item['prev_hash'], {**item, 'seq': seq}) != item['hash']:
+            self.errors.append(f"{item['chain_id']}#{seq}: hash does not match record contents")
+        chain['count'] += 1
+        chain['produced'] = (chain['produced'] + link_digest(seq, item['hash'])) % self.MOD
+        if seq == 0:
+            if item['prev_hash'] != GENESIS_HASH:
+                self.errors.append(f"{item['chain_id']}#0: does not start from the genesis hash")
+        else:
+            chain['consumed'] = (chain['consumed'] + link_digest(seq - 1, item['prev_hash'])) % self.MOD
+        if seq > chain['tail'][0]:
+            chain['tail'] = (seq, item['hash'])
+
+    def result(self):
+        errors = list(self.errors)
+        for chain_id, chain in self.chains.items():
+            tail_seq, tail_hash = chain['tail']
+            if chain['count'] != tail_seq + 1:
+                errors.append(f"{chain_id}: {chain['count']} records for seq 0..{tail_seq} (missing or duplicated records)")
+            elif (chain['produced'] - chain['consumed']) % self.MOD != link_digest(tail_seq, tail_hash):
+                errors.append(f"{chain_id}: broken links between records")
+            head = self.heads.get(chain_id)
+            if head is None:
+                errors.append(f"{chain_id}: no head item")
+            elif head[0] > tail_seq:
+                errors.append(f"{chain_id}: head is at seq {head[0]} but the chain ends at {tail_seq} (truncated)")
+            elif head[0] == tail_seq and head[1] != tail_hash:
+                errors.append(f"{chain_id}: tail record does not match the head")
+        for chain_id in set(self.heads) - set(self.chains):
+            errors.append(f"{chain_id}: head item without records")
+        return {'ok': not errors, 'records': self.records, 'chains': len(self.chains), 'errors': errors}
+
+
+def verify(items):
+    """Verifies an iterable of audit items (records and head items, any order)."""
+    verifier = ChainVerifier()
+    for item in items:
+        verifier.add(item)
+    return verifier.result()
+
+
+def scan_items(table_name=AUDIT_TABLE_NAME, page_size=1000):
+    """Streams every item of the audit table, one scan page at a time."""
+    kwargs = {'Limit': page_size}
+    while True:
+        response = clients.table(table_name).scan(**kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def verify_table(table_name=AUDIT_TABLE_NAME):
+    """The table alone; once days have been compacted use audit_archive.verify_all()."""
+    return verify(scan_items(table_name))
+
+
+def backfill_buckets(table_name=AUDIT_TABLE_NAME, page_size=1000):
+    """
+    Sets `bucket` on records written before the bucket index existed, which query_events and the
+    archive can't see otherwise. Not part of the hash, so chains still verify. Safe to re-run;
+    returns the number of records updated.
+    """
+    table = clients.table(table_name)
+    kwargs = {
+        'Limit': page_size,
+        'FilterExpression': Attr('bucket').not_exists() & Attr('timestamp').ne(HEAD_TIMESTAMP),
+        'ProjectionExpression': 'log_id, #ts, chain_id',
+        'ExpressionAttributeNames': {'#ts': 'timestamp'}
+    }
+    updated = 0
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            shard = shard_for(item['chain_id']) if item.get('chain_id') else 0
+            try:
+                table.update_item(
+                    Key={'log_id': item['log_id'], 'timestamp': item['timestamp']},
+                    UpdateExpression='SET #b = :bucket',
+                    ConditionExpression='attribute_exists(log_id)',  # archived meanwhile: don't recreate it
+                    ExpressionAttributeNames={'#b': 'bucket'},
+                    ExpressionAttributeValues={':bucket': bucket_for(item['timestamp'], shard)}
+                )
+                updated += 1
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                    raise
+        if 'LastEvaluatedKey' not in response:
+            return updated
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        print(f"DEBUG: Backfilled bucket on {updated} audit records so far")
+
+
+def encode_cursor(timestamp, seen):
+    return base64.urlsafe_b64encode(json.dumps({'ts': timestamp, 'seen': seen}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Raises ValueError for a cursor this API didn't issue."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return data['ts'], set(data['seen'])
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def days_between(start, end, descending):
+    first = datetime.date.fromisoformat(start[:10])
+    last = datetime.date.fromisoformat(end[:10])
+    days = [first + datetime.timedelta(days=n) for n in range((last - first).days + 1)]
+    return [day.isoformat() for day in (reversed(days) if descending else days)]
+
+
+def query_partition(index_name, key_name, key_value, start, end, descending, filters, page_size):
+    """Lazily yields one index partition's items between start and end (inclusive), in order."""
+    kwargs = {
+        'IndexName': index_name,
+        'KeyConditionExpression': Key(key_name).eq(key_value) & Key('timestamp').between(start, end),
+        'ScanIndexForward': not descending,
+        'Limit': page_size
+    }
+    if filters:
+        kwargs['FilterExpression'] = functools.reduce(lambda a, b: a & b, [Attr(k).eq(v) for k, v in filters.items()])
+    table = clients.table(AUDIT_TABLE_NAME)
+    while True:
+        response = table.query(**kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_events(limit=AUDIT_PAGE_SIZE, start=None, end=None, user_id=None, action=None, descending=True,
+                 cursor=None):
+    """
+    One page of audit events ordered by timestamp (newest first by default), optionally limited
+    to [start, end] (ISO timestamps or dates), one user and/or one action.
+    Returns (events, next_cursor); next_cursor is None once the range is exhausted.
+    """
+    limit = max(1, min(int(limit), AUDIT_MAX_PAGE_SIZE))
+    end = end or datetime.datetime.utcnow().isoformat()
+    if len(end) == 10:
+        end += 'T99'  # a bare date includes the whole day
+    seen = set()
+    if cursor:
+        # Resume at the last returned timestamp, skipping the events already returned at it
+        position, seen = decode_cursor(cursor)
+        if descending:
+            end = position
+        else:
+            start = position
+    filters = {'action': action} if action else {}
+    # Filters apply after DynamoDB's Limit, so read ahead when filtering
+    page_size = min(1000, (limit + len(seen) + 1) * (4 if filters else 1))
+
+    if user_id:
+        streams = [query_partition(AUDIT_USER_INDEX, 'user_id', user_id, start or '0', end, descending, filters,
+                                   page_size)]
+    else:
+        if not start:
+            start = (datetime.date.fromisoformat(end[:10]) - datetime.timedelta(days=AUDIT_MAX_RANGE_DAYS)).isoformat()
+        shards = range(AUDIT_BUCKET_SHARDS) if AUDIT_BUCKET_SHARDS > 1 else [0]
+
+        def day_events(day):
+            # Shards of one day are merged by timestamp; days are walked in order
+            return heapq.merge(
+                *[query_partition(AUDIT_BUCKET_INDEX, 'bucket', bucket_for(day, shard), start, end, descending,
+                                  filters, page_size) for shard in shards],
+                key=lambda item: item['timestamp'], reverse=descending
+            )
+        streams = [day_events(day) for day in days_between(start, end, descending)]
+
+    events = []
+    for stream in streams:
+        for item in stream:
+            if item['log_id'] in seen and item['timestamp'] == (end if descending else start):
+                continue
+            events.append(item)
+            if len(events) == limit:
+                break
+        if len(events) == limit:
+            break
+    if len(events) < limit:
+        return events, None
+    last = events[-1]['timestamp']
+    at_last = [item['log_id'] for item in events if item['timestamp'] == last]
+    if cursor and last == (end if descending else start):
+        at_last += list(seen)
+    return events, encode_cursor(last, at_last)
+
+
+if __name__ == '__main__':
+    # python -m common.audit [table]            verify the hash chains (archived records included)
+    # python -m common.audit backfill [table]   once, for records written before the bucket index
+    import sys
+    from common.audit_archive import verify_all
+    if sys.argv[1:2] == ['backfill']:
+        print(f"Backfilled bucket on {backfill_buckets(*sys.argv[2:3])} records")
+        sys.exit(0)
+    # Compaction moves the start of every chain to the archive, so the table alone always shows gaps
+    report = verify_all(*sys.argv[1:2])
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['ok'] else 1)
@@ -0,0 +1,257 @@
+import argparse
+import datetime
+import decimal
+import gzip
+import heapq
+import io
+import itertools
+import json
+import os
+import sys
+import time
+
+from common import audit, clients
+from common.artifacts import ARTIFACT_PREFIX, open_object, put_object
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Cold tier for the audit log. Once a UTC day is older than AUDIT_HOT_DAYS it is closed:
+# compact() streams its bucket partitions (all shards, merged by timestamp) into compressed
+# JSONL segment files of at most AUDIT_SEGMENT_RECORDS records, then deletes those records
+# from the table. The archive index records each segment's day, min/max timestamp, record
+# count and user ids, so query_archive() only opens segments that can hold a match and reads
+# them sequentially. Chain head items stay in the table; verify_all() checks chains across
+# both tiers. Segments use zstd when the zstandard package is importable, gzip otherwise;
+# readers pick the codec from the segment's extension.
+AUDIT_ARCHIVE_PREFIX = os.environ.get('AUDIT_ARCHIVE_PREFIX', f"{ARTIFACT_PREFIX}audit/")
+AUDIT_ARCHIVE_INDEX = f"{AUDIT_ARCHIVE_PREFIX}index.json"
+AUDIT_HOT_DAYS = int(os.environ.get('AUDIT_HOT_DAYS', str(audit.AUDIT_MAX_RANGE_DAYS)))
+AUDIT_SEGMENT_RECORDS = int(os.environ.get('AUDIT_SEGMENT_RECORDS', '50000'))
+AUDIT_ARCHIVE_CODEC = os.environ.get('AUDIT_ARCHIVE_CODEC', 'zstd' if zstandard else 'gzip')
+AUDIT_ARCHIVE_TIME_BUDGET = float(os.environ.get('AUDIT_ARCHIVE_TIME_BUDGET', '240'))
+CODEC_EXTENSIONS = {'zstd': '.jsonl.zst', 'gzip': '.jsonl.gz'}
+
+
+def plain(value):
+    # DynamoDB returns numbers as Decimal
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def compress(body, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("AUDIT_ARCHIVE_CODEC is zstd but the zstandard package is not installed")
+        return zstandard.ZstdCompressor(level=10).compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+
+def open_segment(key):
+    """Streams a segment's lines without loading the whole file."""
+    stream = open_object(key)
+    if stream is None:
+        raise RuntimeError(f"Archived audit segment {key} is missing")
+    if key.endswith(CODEC_EXTENSIONS['zstd']):
+        if zstandard is None:
+            stream.close()
+            raise RuntimeError(f"Reading {key} needs the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(stream, closefd=True), encoding='utf-8')
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=stream), encoding='utf-8')
+
+
+def read_segment(key):
+    with open_segment(key) as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_index():
+    stream = open_object(AUDIT_ARCHIVE_INDEX)
+    if stream is None:
+        return {'through': None, 'segments': []}
+    try:
+        return json.loads(stream.read())
+    finally:
+        stream.close()
+
+
+def save_index(index):
+    put_object(AUDIT_ARCHIVE_INDEX, json.dumps(index, separators=(',', ':')).encode('utf-8'))
+
+
+def next_day(day):
+    return (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+
+
+def day_items(day):
+    """All of one day's records, oldest first, across the bucket shards."""
+    shards = range(audit.AUDIT_BUCKET_SHARDS) if audit.AUDIT_BUCKET_SHARDS > 1 else [0]
+    return heapq.merge(
+        *[audit.query_partition(audit.AUDIT_BUCKET_INDEX, 'bucket', audit.bucket_for(day, shard), day, f"{day}T99",
+                                False, {}, 1000) for shard in shards],
+        key=lambda item: (item['timestamp'], item['log_id'])
+    )
+
+
+def first_day():
+    """Oldest day bucket still in the table. Only needed before the first compaction."""
+    kwargs = {
+        'IndexName': audit.AUDIT_BUCKET_INDEX,
+        'ProjectionExpression': '#b',
+        'ExpressionAttributeNames': {'#b': 'bucket'}
+    }
+    oldest = None
+    table = clients.table(audit.AUDIT_TABLE_NAME)
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            day = item['bucket'][:10]
+            oldest = day if oldest is None else min(oldest, day)
+        if 'LastEvaluatedKey' not in response:
+            return oldest
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def write_segment(index, day, records):
+    part = sum(1 for entry in index['segments'] if entry['day'] == day)
+    key = f"{AUDIT_ARCHIVE_PREFIX}segments/{day}-{part:03d}{CODEC_EXTENSIONS[AUDIT_ARCHIVE_CODEC]}"
+    body = "".join(json.dumps(record, separators=(',', ':'), default=plain) + "\n" for record in records)
+    data = compress(body.encode('utf-8'), AUDIT_ARCHIVE_CODEC)
+    put_object(key, data)
+    index['segments'].append({
+        'key': key,
+        'day': day,
+        'min_ts': records[0]['timestamp'],
+        'max_ts': records[-1]['timestamp'],
+        'count': len(records),
+        'users': sorted({str(record.get('user_id', '')) for record in records}),
+        'bytes': len(data)
+    })
+    print(f"DEBUG: Archived {len(records)} audit records for {day} to {key} ({len(body)} -> {len(data)} bytes)")
+
+
+def delete_items(keys):
+    with clients.table(audit.AUDIT_TABLE_NAME).batch_writer() as batch:
+        for log_id, timestamp in keys:
+            batch.delete_item(Key={'log_id': log_id, 'timestamp': timestamp})
+
+
+def archive_day(index, day):
+    """
+    Moves one closed day to segments. The index lists the new segments before any record
+    is deleted, so a run cut short at any point loses nothing; records of a resumed day
+    that an earlier segment already holds are deleted without being written again.
+    """
+    archived = set()
+    for entry in index['segments']:
+        if entry['day'] == day:
+            archived.update(record['log_id'] for record in read_segment(entry['key']))
+    keys = []
+    batch = []
+    for item in day_items(day):
+        keys.append((item['log_id'], item['timestamp']))
+        if item['log_id'] in archived:
+            continue
+        batch.append(item)
+        if len(batch) == AUDIT_SEGMENT_RECORDS:
+            write_segment(index, day, batch)
+            batch = []
+    if batch:
+        write_segment(index, day, batch)
+    if keys:
+        save_index(index)
+        delete_items(keys)
+        index['through'] = day
+        save_index(index)
+    return len(keys)
+
+
+def compact(today=None, time_budget=AUDIT_ARCHIVE_TIME_BUDGET):
+    """
+    Archives every closed day not archived yet. Returns the number of records moved, or
+    None if the time budget ran out first (call again to continue).
+    """
+    deadline = time.time() + time_budget
+    today = today or datetime.datetime.utcnow().date().isoformat()
+    cutoff = (datetime.date.fromisoformat(today) - datetime.timedelta(days=AUDIT_HOT_DAYS)).isoformat()
+    index = load_index()
+    day = next_day(index['through']) if index['through'] else (first_day() or cutoff)
+    moved = 0
+    while day < cutoff:
+        if time.time() > deadline:
+            print(f"DEBUG: Audit compaction out of time at {day}, {moved} records moved")
+            return None
+        moved += archive_day(index, day)
+        day = next_day(day)
+    # Empty days in between count as archived too
+    through = (datetime.date.fromisoformat(cutoff) - datetime.timedelta(days=1)).isoformat()
+    if (index['through'] or '') < through:
+        index['through'] = through
+        save_index(index)
+    print(f"DEBUG: Audit compaction done through {index['through']}, {moved} records moved")
+    return moved
+
+
+def query_archive(start=None, end=None, user_id=None, action=None):
+    """
+    Streams archived records in [start, end] (ISO timestamps or dates), oldest first,
+    optionally for one user and/or action. Segments are pruned by their time range and
+    user list before being opened.
+    """
+    if end and len(end) == 10:
+        end += 'T99'  # a bare date includes the whole day
+    segments = [
+        entry for entry in load_index()['segments']
+        if (not start or entry['max_ts'] >= start) and (not end or entry['min_ts'] <= end)
+        and (not user_id or user_id in entry['users'])
+    ]
+    segments.sort(key=lambda entry: entry['min_ts'])
+    # Days never overlap; a resumed day's segments can, so they are merged
+    for _, group in itertools.groupby(segments, key=lambda entry: entry['day']):
+        records = heapq.merge(*[read_segment(entry['key']) for entry in group], key=lambda record: record['timestamp'])
+        for record in records:
+            if start and record['timestamp'] < start:
+                continue
+            if end and record['timestamp'] > end:
+                break
+            if user_id and record.get('user_id') != user_id:
+                continue
+            if action and record.get('action') != action:
+                continue
+            yield record
+
+
+def archived_items():
+    for entry in load_index()['segments']:
+        yield from read_segment(entry['key'])
+
+
+def verify_all(table_name=audit.AUDIT_TABLE_NAME):
+    """Verifies the hash chains over the archive and the table together."""
+    return audit.verify(itertools.chain(archived_items(), audit.scan_items(table_name)))
+
+
+if __name__ == '__main__':
+    # python -m common.audit_archive query --from 2026-01-01 --to 2026-03-31 --user alice
+    # python -m common.audit_archive compact | verify
+    parser = argparse.ArgumentParser(prog='python -m common.audit_archive')
+    parser.add_argument('command', choices=['query', 'compact', 'verify'])
+    parser.add_argument('--from', dest='start')
+    parser.add_argument('--to', dest='end')
+    parser.add_argument('--user')
+    parser.add_argument('--action')
+    args = parser.parse_args()
+    if args.command == 'compact':
+        compact(time_budget=float('inf'))
+    elif args.command == 'verify':
+        report = verify_all()
+        print(json.dumps(report, indent=2))
+        sys.exit(0 if report['ok'] else 1)
+    else:
+        for record in query_archive(args.start, args.end, args.user, args.action):
+            sys.stdout.write(json.dumps(record, default=plain) + "\n")
@@ -0,0 +1,237 @@
+import atexit
+import base64
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from common import clients
+
+# Off-the-request-path DynamoDB writes (audit events, chat history). Handlers wait for them
+# with flush() before returning (see audit.flushes), so nothing is left queued while a Lambda
+# container is frozen. Every write is also appended to a per-process spool file before it is
+# queued, and the spool is only truncated once everything in it has been written: writes a
+# crash or a timed-out flush left behind are replayed by the next writer started in the same
+# container (or on the same host), which adopts spools whose process is gone.
+# Set BACKGROUND_WRITES=0 to write inline.
+BACKGROUND_WRITES = os.environ.get('BACKGROUND_WRITES', '1') == '1'
+WRITE_SPOOL_DIR = os.environ.get('WRITE_SPOOL_DIR', '/tmp')
+WRITE_SPOOL_PREFIX = 'lexguard_pending_writes.'
+WRITE_MAX_ATTEMPTS = int(os.environ.get('WRITE_MAX_ATTEMPTS', '5'))
+BACKGROUND_FLUSH_TIMEOUT = float(os.environ.get('BACKGROUND_FLUSH_TIMEOUT', '3'))
+BATCH_WRITE_SIZE = 25  # DynamoDB BatchWriteItem limit
+BINARY_KEY = '__binary__'
+
+
+def spool_file(pid, suffix=''):
+    return os.path.join(WRITE_SPOOL_DIR, f"{WRITE_SPOOL_PREFIX}{pid}{suffix}.jsonl")
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def orphaned_spools():
+    """Spool files of processes that have exited."""
+    try:
+        names = os.listdir(WRITE_SPOOL_DIR)
+    except FileNotFoundError:
+        return []
+    paths = []
+    for name in names:
+        pid = name[len(WRITE_SPOOL_PREFIX):-len('.jsonl')].split('-')[0]
+        if name.startswith(WRITE_SPOOL_PREFIX) and name.endswith('.jsonl') and pid.isdigit():
+            if int(pid) != os.getpid() and not process_alive(int(pid)):
+                paths.append(os.path.join(WRITE_SPOOL_DIR, name))
+    return paths
+
+
+def encode_binary(value):
+    # Binary attributes (packed vectors) go through the JSON spool as base64
+    if isinstance(value, (bytes, bytearray)):
+        return {BINARY_KEY: base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def decode_binary(obj):
+    if len(obj) == 1 and BINARY_KEY in obj:
+        return base64.b64decode(obj[BINARY_KEY])
+    return obj
+
+
+def spool_line(entry_id, table_name, items):
+    return json.dumps({'id': entry_id, 'table': table_name, 'items': items}, default=encode_binary) + "\n"
+
+
+def write_items(table_name, items):
+    """One PutItem for a single item, BatchWriteItem (retrying unprocessed items) for several."""
+    if len(items) == 1:
+        clients.table(table_name).put_item(Item=items[0])
+        return
+    request = {table_name: [{'PutRequest': {'Item': item}} for item in items]}
+    attempt = 0
+    while request:
+        request = clients.dynamodb().batch_write_item(RequestItems=request).get('UnprocessedItems') or None
+        if request:
+            attempt += 1
+            time.sleep(min(0.05 * 2 ** attempt, 1.0))
+
+
+class BackgroundWriter:
+    def __init__(self, spool_path=None, max_attempts=WRITE_MAX_ATTEMPTS):
+        self.spool_path = spool_path or spool_path_for_process()
+        self.max_attempts = max_attempts
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failed = {}
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = None
+        self.replay()
+
+    def replay(self):
+        """Re-queues writes spooled by this process or by exited ones but never confirmed."""
+        if not self.spool_path:
+            return
+        for n, path in enumerate([self.spool_path] + orphaned_spools()):
+            # Renaming is atomic, so two starting writers never replay the same file; the claimed
+            # name still carries this process's PID in case it dies before finishing
+            claimed = spool_file(os.getpid(), f"-replay{n}")
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            entries = []
+            with open(claimed) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line, object_hook=decode_binary))
+                    except ValueError:
+                        continue  # torn last line from an interrupted append
+            print(f"DEBUG: Replaying {len(entries)} spooled writes from {os.path.basename(path)}")
+            for entry in entries:
+                self.submit(entry['table'], entry.get('items') or [entry['item']], entry['id'])
+            os.remove(claimed)
+
+    def put_item(self, table_name, item):
+        self.submit(table_name, [item], str(uuid.uuid4()))
+
+    def put_items(self, table_name, items):
+        """Items queued together are written together (one BatchWriteItem per 25)."""
+        for start in range(0, len(items), BATCH_WRITE_SIZE):
+            self.submit(table_name, items[start:start + BATCH_WRITE_SIZE], str(uuid.uuid4()))
+
+    def submit(self, table_name, items, entry_id):
+        entry = {'id': entry_id, 'table': table_name, 'items': items, 'attempts': 0}
+        line = spool_line(entry_id, table_name, items) if self.spool_path else None
+        with self.lock:
+            if line:
+                with open(self.spool_path, 'a') as f:
+                    f.write(line)
+            self.pending[entry_id] = entry
+            self.idle.clear()
+        self.start()
+        self.queue.put(entry)
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, name='background-writer', daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                write_items(entry['table'], entry['items'])
+            except Exception as e:
+                entry['attempts'] += 1
+                if entry['attempts'] < self.max_attempts:
+                    print(f"BACKGROUND WRITE RETRY ({entry['table']}): {e}")
+                    time.sleep(min(0.1 * 2 ** entry['attempts'], 2.0))
+                    self.queue.put(entry)
+                    continue
+                # Kept in the spool: replayed the next time a writer starts
+                print(f"BACKGROUND WRITE FAILED ({entry['table']}): {e}")
+                with self.lock:
+                    self.failed[entry['id']] = entry
+            self.done(entry['id'])
+
+    def done(self, entry_id):
+        with self.lock:
+            self.pending.pop(entry_id, None)
+            if not self.pending:
+                if self.spool_path:
+                    self.compact()
+                self.idle.set()
+
+    def compact(self):
+        # Caller holds self.lock. Only writes that gave up survive in the spool.
+        if self.failed:
+            with open(self.spool_path, 'w') as f:
+                for entry in self.failed.values():
+                    f.write(spool_line(entry['id'], entry['table'], entry['items']))
+        elif os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+
+    def flush(self, timeout=None):
+        """Blocks until every queued write has been attempted. Returns False on timeout."""
+        return self.idle.wait(timeout)
+
+
+def spool_path_for_process():
+    return spool_file(os.getpid()) if WRITE_SPOOL_DIR else None
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BackgroundWriter()
+                atexit.register(_writer.flush, 5)
+    return _writer
+
+
+def flush(timeout=BACKGROUND_FLUSH_TIMEOUT):
+    """
+    Waits up to `timeout` seconds for every queued write. Returns False if some were still
+    pending; they stay in the spool and are replayed by the next writer.
+    """
+    if _writer is None:
+        return True
+    if _writer.flush(timeout):
+        return True
+    print(f"BACKGROUND WRITE FLUSH TIMED OUT after {timeout}s with {len(_writer.pending)} writes pending")
+    return False
+
+
+def put_item(table_name, item):
+    """Writes `item` to `table_name`, off the request path when BACKGROUND_WRITES is on."""
+    if not BACKGROUND_WRITES:
+        clients.table(table_name).put_item(Item=item)
+        return
+    get_writer().put_item(table_name, item)
+
+
+def put_items(table_name, items):
+    """Like put_item, but the items go out in shared BatchWriteItem calls."""
+    if not BACKGROUND_WRITES:
+        for start in range(0, len(items), BATCH_WRITE_SIZE):
+            write_items(table_name, items[start:start + BATCH_WRITE_SIZE])
+        return
+    get_writer().put_items(table_name, items)
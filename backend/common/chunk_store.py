@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from common import clients
+
+# Chunk text lives here, keyed by vector ID; Pinecone only keeps the filterable fields.
+CHUNK_STORE = os.environ.get('CHUNK_STORE', 'dynamodb')  # dynamodb | sqlite
+CHUNK_TABLE = os.environ.get('CHUNK_TABLE', 'CaseChat_Chunks')
+CHUNK_STORE_PATH = os.environ.get('CHUNK_STORE_PATH', '/tmp/chunk_store.sqlite3')
+CHUNK_CACHE_SIZE = int(os.environ.get('CHUNK_CACHE_SIZE', '5000'))
+BATCH_GET_SIZE = 100  # DynamoDB BatchGetItem limit
+
+
+class DynamoDBChunkBackend:
+    def __init__(self, table_name=CHUNK_TABLE):
+        self.table_name = table_name
+        self.table = clients.table(table_name)
+
+    def put_many(self, items):
+        with self.table.batch_writer(overwrite_by_pkeys=['vector_id']) as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+    def get_many(self, ids):
+        found = {}
+        for start in range(0, len(ids), BATCH_GET_SIZE):
+            request = {self.table_name: {'Keys': [{'vector_id': vid} for vid in ids[start:start + BATCH_GET_SIZE]]}}
+            attempt = 0
+            while request:
+                response = clients.dynamodb().batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self.table_name, []):
+                    found[item['vector_id']] = item
+                request = response.get('UnprocessedKeys') or None
+                if request:
+                    attempt += 1
+                    time.sleep(min(0.05 * 2 ** attempt, 1.0))
+        return found
+
+    def delete_many(self, ids):
+        with self.table.batch_writer() as batch:
+            for vid in ids:
+                batch.delete_item(Key={'vector_id': vid})
+
+
+class SQLiteChunkBackend:
+    """Local stand-in for development and offline tests."""
+
+    def __init__(self, path=CHUNK_STORE_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (vector_id TEXT PRIMARY KEY, doc_id TEXT, text TEXT NOT NULL, "
+            "tokens INTEGER, token_model TEXT)"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(chunks)")}
+        for column, kind in (('tokens', 'INTEGER'), ('token_model', 'TEXT')):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE chunks ADD COLUMN {column} {kind}")
+        self.conn.commit()
+
+    def put_many(self, items):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks (vector_id, doc_id, text, tokens, token_model) VALUES (?, ?, ?, ?, ?)",
+                [(item['vector_id'], item.get('doc_id'), item['text'], item.get('tokens'), item.get('token_model'))
+                 for item in items]
+            )
+            self.conn.commit()
+
+    def get_many(self, ids):
+        found = {}
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT vector_id, doc_id, text, tokens, token_model FROM chunks "
+                    f"WHERE vector_id IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for vector_id, doc_id, text, tokens, token_model in rows:
+                    found[vector_id] = {
+                        'vector_id': vector_id, 'doc_id': doc_id, 'text': text,
+                        'tokens': tokens, 'token_model': token_model
+                    }
+        return found
+
+    def delete_many(self, ids):
+        with self.lock:
+            self.conn.executemany("DELETE FROM chunks WHERE vector_id = ?", [(vid,) for vid in ids])
+            self.conn.commit()
+
+
+def chunk_fields(item):
+    return {'text': item['text'], 'tokens': item.get('tokens'), 'token_model': item.get('token_model')}
+
+
+class ChunkStore:
+    """Batch put/get/delete of chunk text with an in-process LRU in front of the backend."""
+
+    def __init__(self, backend, cache_size=CHUNK_CACHE_SIZE):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def remember(self, vector_id, chunk):
+        with self.lock:
+            self.cache[vector_id] = chunk
+            self.cache.move_to_end(vector_id)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def put_chunks(self, items):
+        """items: dicts with vector_id, doc_id and text, optionally tokens/token_model (see common/prompts.py)."""
+        if not items:
+            return
+        self.backend.put_many(items)
+        for item in items:
+            self.remember(item['vector_id'], chunk_fields(item))
+
+    def get_chunks(self, ids):
+        """Returns {vector_id: {'text', 'tokens', 'token_model'}} for the IDs that exist in the store."""
+        chunks = {}
+        missing = []
+        with self.lock:
+            for vid in ids:
+                if vid in self.cache:
+                    self.cache.move_to_end(vid)
+                    chunks[vid] = self.cache[vid]
+                else:
+                    missing.append(vid)
+        if missing:
+            for vid, item in self.backend.get_many(list(dict.fromkeys(missing))).items():
+                chunks[vid] = chunk_fields(item)
+                self.remember(vid, chunks[vid])
+        return chunks
+
+    def delete_chunks(self, ids):
+        if not ids:
+            return
+        self.backend.delete_many(ids)
+        with self.lock:
+            for vid in ids:
+                self.cache.pop(vid, None)
+
+
+def build_chunk_store(kind=CHUNK_STORE):
+    if kind == 'sqlite':
+        return ChunkStore(SQLiteChunkBackend())
+    return ChunkStore(DynamoDBChunkBackend())
+
+
+def get_chunk_store():
+    """The process-wide chunk store, built on first use."""
+    return clients.lazy('chunk_store', build_chunk_store)
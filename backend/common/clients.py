@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+# Lazily-built, process-wide clients. Each is created on first use and then reused by
+# every warm invocation, so HTTP keep-alive pools and the resolved Pinecone host survive
+# between requests and code paths that never touch a service never pay for it.
+PINECONE_API_KEY = os.environ.get('PINECONE_API_KEY')
+PINECONE_INDEX = os.environ.get('PINECONE_INDEX', 'casechat-index')
+PINECONE_INDEX_HOST = os.environ.get('PINECONE_INDEX_HOST')  # skips describe_index when set
+BOTO_MAX_POOL = int(os.environ.get('BOTO_MAX_POOL', '32'))
+
+BOTO_CONFIG = Config(tcp_keepalive=True, max_pool_connections=BOTO_MAX_POOL)
+
+_clients = {}
+_lock = threading.RLock()
+
+
+def lazy(name, factory):
+    """Returns the cached object for `name`, building it with factory() on first use."""
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                started = time.time()
+                client = factory()
+                _clients[name] = client
+                print(f"DEBUG: Initialized {name} in {(time.time() - started) * 1000:.0f} ms")
+    return client
+
+
+def s3():
+    return lazy('s3', lambda: boto3.client('s3', config=BOTO_CONFIG))
+
+
+def bedrock():
+    return lazy('bedrock-runtime', lambda: boto3.client('bedrock-runtime', config=BOTO_CONFIG))
+
+
+def sqs():
+    return lazy('sqs', lambda: boto3.client('sqs', config=BOTO_CONFIG))
+
+
+def dynamodb():
+    return lazy('dynamodb', lambda: boto3.resource('dynamodb', config=BOTO_CONFIG))
+
+
+def table(name):
+    return lazy(f"table:{name}", lambda: dynamodb().Table(name))
+
+
+def pinecone():
+    def build():
+        from pinecone import Pinecone
+
+        return Pinecone(api_key=PINECONE_API_KEY)
+    return lazy('pinecone', build)
+
+
+def pinecone_index(name=None):
+    """
+    The Index for `name`, bound directly to its data-plane host. The host lookup
+    (a control-plane call) happens once per process instead of once per request.
+    """
+    name = name or PINECONE_INDEX
+
+    def build():
+        host = PINECONE_INDEX_HOST if name == PINECONE_INDEX and PINECONE_INDEX_HOST else None
+        if host is None:
+            host = pinecone().describe_index(name).host
+        return pinecone().Index(host=host)
+    return lazy(f"pinecone_index:{name}", build)
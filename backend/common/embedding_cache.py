@@ -0,0 +1,192 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from common import clients
+
+EMBED_CACHE = os.environ.get('EMBED_CACHE', 'memory')  # memory | sqlite | dynamodb | none
+EMBED_CACHE_TABLE = os.environ.get('EMBED_CACHE_TABLE', 'CaseChat_EmbeddingCache')
+EMBED_CACHE_PATH = os.environ.get('EMBED_CACHE_PATH', '/tmp/embedding_cache.sqlite3')
+EMBED_CACHE_MAX_ENTRIES = int(os.environ.get('EMBED_CACHE_MAX_ENTRIES', '20000'))
+EMBED_CACHE_TTL = int(os.environ.get('EMBED_CACHE_TTL', str(30 * 24 * 3600)))
+
+
+def normalize_text(text):
+    return ' '.join(text.split())
+
+
+def cache_key(model_id, text):
+    return hashlib.sha256(f"{model_id}\n{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+
+def pack_vector(vector):
+    return array('f', vector).tobytes()
+
+
+def unpack_vector(blob):
+    values = array('f')
+    values.frombytes(bytes(blob))
+    return values.tolist()
+
+
+class MemoryCache:
+    """In-process LRU with a TTL. Survives across warm Lambda invocations."""
+
+    def __init__(self, max_entries=EMBED_CACHE_MAX_ENTRIES, ttl=EMBED_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None:
+                return None
+            vector, expires_at = entry
+            if expires_at < time.time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return vector
+
+    def put(self, key, vector):
+        with self.lock:
+            self.items[key] = (vector, time.time() + self.ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+
+
+class SQLiteCache:
+    """Local disk cache, handy for dev machines and long-running workers."""
+
+    def __init__(self, path=EMBED_CACHE_PATH, max_entries=EMBED_CACHE_MAX_ENTRIES, ttl=EMBED_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+        self.conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT vector, expires_at FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self.conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE embeddings SET used_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            return unpack_vector(row[0])
+
+    def put(self, key, vector):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, pack_vector(vector), now + self.ttl, now)
+            )
+            # Size-based eviction: drop the least recently used rows beyond the cap
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self.conn.commit()
+
+
+class DynamoDBCache:
+    """
+    Shared cache across Lambda instances. Eviction is left to the table's
+    TTL attribute (`expires_at`), see infra_serverless/main.tf.
+    """
+
+    def __init__(self, table_name=EMBED_CACHE_TABLE, ttl=EMBED_CACHE_TTL):
+        self.ttl = ttl
+        self.table = clients.table(table_name)
+
+    def get(self, key):
+        item = self.table.get_item(Key={'cache_key': key}).get('Item')
+        if not item or int(item.get('expires_at', 0)) < time.time():
+            return None
+        return unpack_vector(item['vector'].value)
+
+    def put(self, key, vector):
+        self.table.put_item(Item={
+            'cache_key': key,
+            'vector': pack_vector(vector),
+            'expires_at': int(time.time() + self.ttl)
+        })
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache: key = sha256(model id + normalized text).
+    An in-process LRU always sits in front of the optional shared backend.
+    """
+
+    def __init__(self, backend=None, memory=None):
+        self.memory = memory or MemoryCache()
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, model_id, text):
+        key = cache_key(model_id, text)
+        vector = self.memory.get(key)
+        if vector is None and self.backend is not None:
+            try:
+                vector = self.backend.get(key)
+            except Exception as e:
+                print(f"Embedding cache read failed: {e}")
+                vector = None
+            if vector is not None:
+                self.memory.put(key, vector)
+        with self.lock:
+            if vector is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return vector
+
+    def put(self, model_id, text, vector):
+        key = cache_key(model_id, text)
+        self.memory.put(key, vector)
+        if self.backend is not None:
+            try:
+                self.backend.put(key, vector)
+            except Exception as e:
+                print(f"Embedding cache write failed: {e}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0
+        }
+
+
+def build_cache(kind=EMBED_CACHE):
+    if kind == 'none':
+        return None
+    if kind == 'sqlite':
+        return EmbeddingCache(SQLiteCache())
+    if kind == 'dynamodb':
+        return EmbeddingCache(DynamoDBCache())
+    return EmbeddingCache()
@@ -0,0 +1,254 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from common import clients
+from common.embedding_cache import build_cache
+
+EMBED_MODEL_ID = os.environ.get('EMBED_MODEL_ID', 'amazon.titan-embed-text-v1')
+EMBED_WORKERS = int(os.environ.get('EMBED_WORKERS', '8'))
+EMBED_MAX_RETRIES = int(os.environ.get('EMBED_MAX_RETRIES', '8'))
+# Multi-text requests (batch-capable models only): max texts and estimated tokens per request
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', '96'))
+EMBED_BATCH_TOKENS = int(os.environ.get('EMBED_BATCH_TOKENS', '20000'))
+# Latency percentiles cover the most recent requests only, so a warm container's metrics stay bounded
+EMBED_METRICS_WINDOW = int(os.environ.get('EMBED_METRICS_WINDOW', '1000'))
+
+
+def bedrock():
+    # Retries are handled by AdaptiveThrottle below so that every worker backs off together.
+    return clients.lazy('bedrock-runtime:embeddings', lambda: boto3.client(
+        'bedrock-runtime',
+        config=Config(max_pool_connections=max(10, EMBED_WORKERS), tcp_keepalive=True, retries={'max_attempts': 1})
+    ))
+
+
+THROTTLE_ERRORS = (
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException',
+)
+
+
+class AdaptiveThrottle:
+    """
+    Shared pacing delay for all embedding workers (AIMD).
+    A throttled call doubles the delay, every success shrinks it a little,
+    so the pool settles just under the Bedrock TPS limit.
+    """
+
+    def __init__(self, min_delay=0.0, max_delay=20.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self.lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def on_success(self):
+        with self.lock:
+            self.delay = max(self.min_delay, self.delay - 0.05)
+
+    def on_throttle(self):
+        with self.lock:
+            self.delay = min(self.max_delay, max(0.25, self.delay * 2))
+
+
+throttle = AdaptiveThrottle()
+cache = build_cache()
+
+
+class BatchMetrics:
+    """
+    Per-request latency for embedding calls (one request may carry many texts). Counts and
+    the max are running totals; p50 is over the last `window` requests.
+    """
+
+    def __init__(self, window=EMBED_METRICS_WINDOW):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.texts = 0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, texts):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+            self.texts += texts
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            requests, texts, max_seconds = self.requests, self.texts, self.max_seconds
+        if not requests:
+            return {'requests': 0, 'texts': 0}
+        return {
+            'requests': requests,
+            'texts': texts,
+            'texts_per_request': round(texts / requests, 1),
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000),
+            'max_ms': round(max_seconds * 1000)
+        }
+
+
+metrics = BatchMetrics()
+
+
+def supports_batch(model_id=EMBED_MODEL_ID):
+    # Cohere embed models on Bedrock accept a `texts` array; Titan takes one inputText per call
+    return model_id.startswith('cohere.embed')
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def plan_batches(texts, max_texts=EMBED_BATCH_SIZE, max_tokens=EMBED_BATCH_TOKENS):
+    """Groups texts into requests bounded by both text count and estimated token budget."""
+    batch = []
+    budget = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_texts or budget + tokens > max_tokens):
+            yield batch
+            batch = []
+            budget = 0
+        batch.append(text)
+        budget += tokens
+    if batch:
+        yield batch
+
+
+def cache_model_key(input_type):
+    # Cohere embeds documents and queries differently, so the input type is part of the cache key
+    return f"{EMBED_MODEL_ID}:{input_type}" if supports_batch() else EMBED_MODEL_ID
+
+
+def request_body(texts, input_type):
+    if supports_batch():
+        return json.dumps({"texts": texts, "input_type": input_type, "truncate": "END"})
+    return json.dumps({"inputText": texts[0]})
+
+
+def invoke_embedding_model(texts, input_type='search_document'):
+    body = request_body(texts, input_type)
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        throttle.wait()
+        started = time.time()
+        try:
+            response = bedrock().invoke_model(
+                modelId=EMBED_MODEL_ID,
+                contentType='application/json',
+                accept='application/json',
+                body=body
+            )
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in THROTTLE_ERRORS or attempt == EMBED_MAX_RETRIES:
+                raise
+            throttle.on_throttle()
+            print(f"DEBUG: Embedding throttled ({code}), retry {attempt + 1} with delay {throttle.delay:.2f}s")
+            continue
+        throttle.on_success()
+        response_body = json.loads(response.get('body').read())
+        metrics.record(time.time() - started, len(texts))
+        if supports_batch():
+            return response_body['embeddings']
+        return [response_body['embedding']]
+
+
+def embed_many(texts, input_type='search_document', pool=None):
+    """
+    Returns one vector per text, in order. Cached texts are skipped, duplicates are
+    embedded once, and the rest go out as token-budgeted multi-text requests for
+    models that accept arrays, or as single-text requests pipelined over the pool.
+    """
+    model_key = cache_model_key(input_type)
+    vectors = [None] * len(texts)
+    missing = {}
+    for i, text in enumerate(texts):
+        cached = cache.get(model_key, text) if cache is not None else None
+        if cached is not None:
+            vectors[i] = cached
+        else:
+            missing.setdefault(text, []).append(i)
+
+    if missing:
+        if supports_batch():
+            requests = list(plan_batches(list(missing)))
+        else:
+            requests = [[text] for text in missing]
+        if pool is not None and len(requests) > 1:
+            results = list(pool.map(lambda batch: invoke_embedding_model(batch, input_type), requests))
+        else:
+            results = [invoke_embedding_model(batch, input_type) for batch in requests]
+        for batch, batch_vectors in zip(requests, results):
+            for text, vector in zip(batch, batch_vectors):
+                if cache is not None:
+                    cache.put(model_key, text, vector)
+                for i in missing[text]:
+                    vectors[i] = vector
+    return vectors
+
+
+def generate_embedding(text, input_type='search_document'):
+    return embed_many([text], input_type)[0]
+
+
+def embed_query(text):
+    return generate_embedding(text, input_type='search_query')
+
+
+def cache_stats():
+    return cache.stats() if cache is not None else {}
+
+
+def embedding_metrics():
+    return metrics.summary()
+
+
+def iter_embeddings(items, get_text=None, workers=None):
+    """
+    Embeds items on a bounded thread pool and yields (item, vector) in input order.
+    Items are grouped into blocks of EMBED_BATCH_SIZE for batch-capable models
+    (one text per block otherwise); at most 2 * workers blocks are in flight.
+    `items` may be a generator.
+    """
+    get_text = get_text or (lambda item: item)
+    workers = workers or EMBED_WORKERS
+    block_size = EMBED_BATCH_SIZE if supports_batch() else 1
+
+    def blocks():
+        block = []
+        for item in items:
+            block.append(item)
+            if len(block) >= block_size:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for block in blocks():
+            pending.append((block, pool.submit(embed_many, [get_text(item) for item in block])))
+            if len(pending) >= workers * 2:
+                block, future = pending.popleft()
+                yield from zip(block, future.result())
+        while pending:
+            block, future = pending.popleft()
+            yield from zip(block, future.result())
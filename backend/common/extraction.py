@@ -0,0 +1,295 @@
+import codecs
+import io
+import multiprocessing
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+from common import clients
+
+# Ranged reads keep at most RANGE_CACHE_BLOCKS * RANGE_BLOCK_SIZE bytes of the object in memory
+RANGE_BLOCK_SIZE = int(os.environ.get('RANGE_BLOCK_SIZE', str(1024 * 1024)))
+RANGE_CACHE_BLOCKS = int(os.environ.get('RANGE_CACHE_BLOCKS', '16'))
+# pypdf caches every object it resolves; drop that cache every N pages to bound memory
+PAGE_CACHE_FLUSH = int(os.environ.get('PAGE_CACHE_FLUSH', '20'))
+TEXT_BLOCK_SIZE = 64 * 1024
+# EXTRACT_MODE=parallel spools the PDF to /tmp and shards page ranges across processes
+EXTRACT_MODE = os.environ.get('EXTRACT_MODE', 'stream')
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', str(os.cpu_count() or 1)))
+PARALLEL_MIN_PAGES = int(os.environ.get('PARALLEL_MIN_PAGES', '40'))
+
+
+class S3RangeFile(io.RawIOBase):
+    """
+    Seekable, read-only file over an S3 object using ranged GETs.
+    PdfReader only touches the trailer, xref and the objects of the page it is
+    on, so a large PDF is never fully downloaded into memory or /tmp.
+    """
+
+    def __init__(self, bucket, key, block_size=RANGE_BLOCK_SIZE, cache_blocks=RANGE_CACHE_BLOCKS, client=None):
+        self.bucket = bucket
+        self.key = key
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.client = client or clients.s3()
+        self.size = self.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.position = 0
+        self.blocks = OrderedDict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        self.position = max(0, self.position)
+        return self.position
+
+    def get_block(self, n):
+        block = self.blocks.get(n)
+        if block is None:
+            start = n * self.block_size
+            end = min(start + self.block_size, self.size) - 1
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")
+            block = obj['Body'].read()
+            self.blocks[n] = block
+            if len(self.blocks) > self.cache_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(n)
+        return block
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        n, offset = divmod(self.position, self.block_size)
+        block = self.get_block(n)
+        data = block[offset:offset + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def sanitize(text):
+    return text.encode('ascii', 'ignore').decode('ascii')
+
+
+def page_text(page):
+    text = page.extract_text()
+    return sanitize(text) + "\n" if text else ""
+
+
+def iter_pdf_page_texts(stream):
+    """Yields the sanitized text of each page, one page at a time."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(stream)
+    for page_number, page in enumerate(reader.pages, start=1):
+        yield page_text(page)
+        if page_number % PAGE_CACHE_FLUSH == 0:
+            reader.resolved_objects.clear()
+
+
+def extract_page_range(path, start, end, conn):
+    # Runs in a child process with its own PdfReader; sends back the texts or the exception
+    try:
+        from pypdf import PdfReader
+
+        reader = PdfReader(path)
+        conn.send([page_text(reader.pages[i]) for i in range(start, end)])
+    except Exception as e:
+        conn.send(e)
+    finally:
+        conn.close()
+
+
+def page_ranges(page_count, shards):
+    size, extra = divmod(page_count, shards)
+    start = 0
+    for shard in range(shards):
+        end = start + size + (1 if shard < extra else 0)
+        if end > start:
+            yield start, end
+        start = end
+
+
+def iter_pdf_page_texts_parallel(path, workers=EXTRACT_WORKERS):
+    """
+    Extracts page ranges in separate processes and yields page texts in page order.
+    Uses Process + Pipe rather than multiprocessing.Pool, which needs /dev/shm
+    and is unavailable on Lambda. Small documents are extracted serially.
+    """
+    from pypdf import PdfReader
+
+    page_count = len(PdfReader(path).pages)
+    if workers <= 1 or page_count < PARALLEL_MIN_PAGES:
+        with open(path, 'rb') as f:
+            yield from iter_pdf_page_texts(f)
+        return
+
+    print(f"DEBUG: Extracting {page_count} pages with {workers} processes")
+    jobs = []
+    for start, end in page_ranges(page_count, workers):
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=extract_page_range, args=(path, start, end, child_conn))
+        process.start()
+        child_conn.close()
+        jobs.append((process, parent_conn))
+    try:
+        for process, conn in jobs:
+            result = conn.recv()
+            process.join()
+            if isinstance(result, Exception):
+                raise result
+            yield from result
+    finally:
+        for process, conn in jobs:
+            conn.close()
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+def iter_spooled_pdf_page_texts(bucket, key):
+    # Streams the object to /tmp in fixed-size parts (constant memory), then extracts in parallel
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as spool:
+        clients.s3().download_fileobj(bucket, key, spool)
+        spool.flush()
+        yield from iter_pdf_page_texts_parallel(spool.name)
+
+
+def iter_text_blocks(body, block_size=TEXT_BLOCK_SIZE):
+    """Decodes a streaming S3 body incrementally so multi-byte characters survive block edges."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    for data in body.iter_chunks(block_size):
+        text = decoder.decode(data)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def iter_s3_document_texts(bucket, key):
+    """
+    Streams the text of an S3 document as (page_number, text) pairs. PDFs yield
+    one item per page, text files yield fixed-size blocks all on page 1.
+    Returns None for unsupported file types.
+    """
+    if key.lower().endswith('.pdf'):
+        if EXTRACT_MODE == 'parallel':
+            return enumerate(iter_spooled_pdf_page_texts(bucket, key), start=1)
+        stream = io.BufferedReader(S3RangeFile(bucket, key), buffer_size=64 * 1024)
+        return enumerate(iter_pdf_page_texts(stream), start=1)
+    if key.lower().endswith('.txt'):
+        obj = clients.s3().get_object(Bucket=bucket, Key=key)
+        return ((1, text) for text in iter_text_blocks(obj['Body']))
+    return None
+
+
+PARAGRAPH = "\n\n"  # RecursiveCharacterTextSplitter's first separator
+
+
+def iter_chunks(pages, chunk_size=2000, chunk_overlap=200):
+    """
+    Streaming RecursiveCharacterTextSplitter over (page_number, text) pairs: yields the same
+    chunks, in the same order, as splitter.split_text() on the concatenated text.
+    Text is cut at paragraph breaks ("\n\n", the splitter's top-level separator) once the next
+    break has arrived, and the pieces go through the splitter's greedy merge, whose state (the
+    chunk being built and its overlap) is carried from page to page. Pieces of chunk_size or
+    more go to the splitter itself. A document with no paragraph break at all is split in one
+    go at the end, since the splitter would then use "\n" instead.
+    Yields dicts with the chunk text, its character offset in the document text
+    and the first/last page it spans.
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    page_offsets = []  # (document offset where the page starts, page number)
+    buffer = ""  # text from the last paragraph break on (or from the start before the first one)
+    base = 0  # document offset of buffer[0]
+    current = []  # (offset, piece) pairs of the chunk being merged, as in TextSplitter._merge_splits
+    total = 0
+    streaming = False
+
+    def page_at(offset):
+        for start, number in reversed(page_offsets):
+            if start <= offset:
+                return number
+        return page_offsets[0][1]
+
+    def located(offset, text):
+        return {
+            'text': text,
+            'char_offset': offset,
+            'page_start': page_at(offset),
+            'page_end': page_at(offset + max(len(text) - 1, 0))
+        }
+
+    def split_whole(offset, text):
+        search_from = 0
+        for chunk in splitter.split_text(text):
+            pos = text.find(chunk, search_from)
+            if pos == -1:
+                pos = max(0, search_from)
+            search_from = pos + 1
+            yield located(offset + pos, chunk)
+
+    def joined():
+        raw = "".join(piece for _, piece in current)
+        text = raw.strip()
+        if text:
+            yield located(current[0][0] + len(raw) - len(raw.lstrip()), text)
+
+    def add_piece(offset, piece):
+        nonlocal current, total
+        if len(piece) >= chunk_size:
+            yield from joined()
+            current, total = [], 0
+            yield from split_whole(offset, piece)
+            return
+        if total + len(piece) > chunk_size and current:
+            yield from joined()
+            while total > chunk_overlap or (total + len(piece) > chunk_size and total > 0):
+                total -= len(current[0][1])
+                current = current[1:]
+        current.append((offset, piece))
+        total += len(piece)
+
+    def cut(final):
+        """Feeds the pieces before the last paragraph break (all of them when final) to the merge."""
+        nonlocal buffer, base
+        starts = [match.start() for match in re.finditer(PARAGRAPH, buffer)]
+        bounds = sorted(set([0] + starts + ([len(buffer)] if final else [])))
+        for start, end in zip(bounds, bounds[1:]):
+            yield from add_piece(base + start, buffer[start:end])
+        buffer = buffer[bounds[-1]:]
+        base += bounds[-1]
+        # Pages that ended before anything still held can no longer be looked up
+        keep_from = current[0][0] if current else base
+        while len(page_offsets) > 1 and page_offsets[1][0] <= keep_from:
+            page_offsets.pop(0)
+
+    for page, text in pages:
+        if not page_offsets or page_offsets[-1][1] != page:
+            page_offsets.append((base + len(buffer), page))
+        buffer += text
+        streaming = streaming or PARAGRAPH in buffer
+        if streaming:
+            yield from cut(final=False)
+    if streaming:
+        yield from cut(final=True)
+        yield from joined()
+    elif buffer:
+        yield from split_whole(base, buffer)
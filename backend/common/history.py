@@ -0,0 +1,194 @@
+import datetime
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Key
+
+from common import background, clients
+from common.prompts import truncate_to_tokens
+
+# Chat history per session: a rolling summary plus the last HISTORY_KEEP_TURNS turns verbatim.
+# Turns are items keyed "{iso timestamp}#USER" / "#AI"; the summary is the item keyed "SUMMARY"
+# (it sorts after every timestamp, so one latest-first query returns it with the recent turns)
+# and records the timestamp of the last message it covers. Once HISTORY_SUMMARY_TURNS turns have
+# fallen out of the verbatim window they are folded into the summary by the model, off the
+# request path. Recent state is cached per session so a warm container answering a follow-up
+# doesn't query DynamoDB again.
+HISTORY_TABLE_NAME = os.environ.get('HISTORY_TABLE_NAME') or os.environ.get('HISTORY_TABLE', 'CaseChat_History')
+HISTORY_KEEP_TURNS = int(os.environ.get('HISTORY_KEEP_TURNS', '4'))
+HISTORY_SUMMARY_TURNS = int(os.environ.get('HISTORY_SUMMARY_TURNS', '4'))
+HISTORY_SUMMARY_TOKENS = int(os.environ.get('HISTORY_SUMMARY_TOKENS', '300'))
+HISTORY_CACHE_SIZE = int(os.environ.get('HISTORY_CACHE_SIZE', '256'))
+HISTORY_CACHE_TTL = int(os.environ.get('HISTORY_CACHE_TTL', '300'))
+SUMMARY_MODEL_ID = 'meta.llama3-8b-instruct-v1:0'
+SUMMARY_KEY = 'SUMMARY'
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_summarizing = set()
+_summary_pool = ThreadPoolExecutor(max_workers=1)
+
+
+def message_order(timestamp):
+    """Sort key for "{iso}#USER" / "{iso}#AI" keys: by time, the user's message before the answer."""
+    time_part, _, role = timestamp.rpartition('#')
+    return time_part, role != 'USER'
+
+
+def format_summary_prompt(summary, messages):
+    transcript = "".join(f"{msg['role'].upper()}: {msg['content']}\n" for msg in messages)
+    prompt = f"""
+    Instruction: Update the running summary of a conversation between a lawyer and a legal research assistant.
+    Keep the documents, clauses, parties, dates and conclusions discussed; drop pleasantries.
+    Reply with the updated summary only, in at most {HISTORY_SUMMARY_TOKENS * 3 // 4} words.
+
+    Current Summary:
+    {summary or "(none)"}
+
+    New Messages:
+    {transcript}
+
+    Updated Summary:
+    """
+
+    # Llama 3 Instruct Format
+    return f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+
+
+def summarize(summary, messages):
+    payload = {
+        "prompt": format_summary_prompt(summary, messages),
+        "max_gen_len": HISTORY_SUMMARY_TOKENS,
+        "temperature": 0.1
+    }
+    response = clients.bedrock().invoke_model(
+        modelId=SUMMARY_MODEL_ID,
+        contentType='application/json',
+        accept='application/json',
+        body=json.dumps(payload)
+    )
+    generation = json.loads(response.get('body').read())['generation'].strip()
+    return truncate_to_tokens(generation, HISTORY_SUMMARY_TOKENS, SUMMARY_MODEL_ID)
+
+
+def query_state(session_id):
+    # Enough to cover the summary, the verbatim window and a full batch waiting to be summarized
+    limit = 2 * (HISTORY_KEEP_TURNS + HISTORY_SUMMARY_TURNS) + 1
+    response = clients.table(HISTORY_TABLE_NAME).query(
+        KeyConditionExpression=Key('session_id').eq(session_id),
+        Limit=limit,
+        ScanIndexForward=False
+    )
+    summary = {}
+    messages = []
+    for item in response.get('Items', []):
+        if item['timestamp'] == SUMMARY_KEY:
+            summary = item
+        else:
+            messages.append({'role': item['role'], 'content': item['content'], 'timestamp': item['timestamp']})
+    through = summary.get('through', '')
+    messages = sorted(
+        (m for m in messages if message_order(m['timestamp']) > message_order(through)),
+        key=lambda m: message_order(m['timestamp'])
+    )
+    return {'summary': summary.get('summary', ''), 'through': through, 'messages': messages}
+
+
+def get_state(session_id):
+    with _lock:
+        entry = _cache.get(session_id)
+        if entry is not None and entry[1] > time.time():
+            _cache.move_to_end(session_id)
+            return entry[0]
+    state = query_state(session_id)
+    remember(session_id, state)
+    return state
+
+
+def remember(session_id, state):
+    with _lock:
+        _cache[session_id] = (state, time.time() + HISTORY_CACHE_TTL)
+        _cache.move_to_end(session_id)
+        while len(_cache) > HISTORY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def load_history(session_id):
+    """
+    Messages for the answer prompt, oldest first: the rolling summary (role 'summary'),
+    if there is one, followed by the last HISTORY_KEEP_TURNS turns.
+    """
+    if not session_id:
+        return []
+    try:
+        state = get_state(session_id)
+    except Exception as e:
+        print(f"Error loading history: {e}")
+        return []
+    recent = [{'role': m['role'], 'content': m['content']} for m in state['messages'][-2 * HISTORY_KEEP_TURNS:]]
+    if state['summary']:
+        return [{'role': 'summary', 'content': state['summary']}] + recent
+    return recent
+
+
+def save_history(session_id, user_msg, assistant_msg):
+    if not session_id:
+        return
+    timestamp = datetime.datetime.utcnow().isoformat()
+    messages = [
+        {'role': 'user', 'content': user_msg, 'timestamp': f"{timestamp}#USER"},
+        # Ensure unique sort key even if fast
+        {'role': 'assistant', 'content': assistant_msg, 'timestamp': f"{timestamp}#AI"}
+    ]
+    # Both turns go out in one BatchWriteItem, queued on the background writer
+    try:
+        background.put_items(HISTORY_TABLE_NAME, [dict(msg, session_id=session_id) for msg in messages])
+    except Exception as e:
+        print(f"Error saving history: {e}")
+        return
+    with _lock:
+        entry = _cache.pop(session_id, None)
+    if entry is None or entry[1] <= time.time():
+        return  # the next load_history reads the session back from the table
+    state = dict(entry[0], messages=entry[0]['messages'] + messages)
+    remember(session_id, state)
+    if len(state['messages']) >= 2 * (HISTORY_KEEP_TURNS + HISTORY_SUMMARY_TURNS):
+        with _lock:
+            if session_id in _summarizing:
+                return
+            _summarizing.add(session_id)
+        _summary_pool.submit(roll_summary, session_id, state)
+
+
+def roll_summary(session_id, state):
+    """Folds the messages older than the verbatim window into the session summary."""
+    try:
+        older = state['messages'][:-2 * HISTORY_KEEP_TURNS]
+        summary = summarize(state['summary'], older)
+        through = older[-1]['timestamp']
+        background.put_item(HISTORY_TABLE_NAME, {
+            'session_id': session_id,
+            'timestamp': SUMMARY_KEY,
+            'summary': summary,
+            'through': through,
+            'updated': datetime.datetime.utcnow().isoformat()
+        })
+        with _lock:
+            entry = _cache.get(session_id)
+        # Turns saved while the model was summarizing stay in the cached state
+        current = entry[0]['messages'] if entry is not None else state['messages']
+        remember(session_id, {
+            'summary': summary,
+            'through': through,
+            'messages': [m for m in current if message_order(m['timestamp']) > message_order(through)]
+        })
+        print(f"DEBUG: Summarized {len(older)} messages for session {session_id}")
+    except Exception as e:
+        print(f"HISTORY SUMMARY FAILED ({session_id}): {e}")
+    finally:
+        with _lock:
+            _summarizing.discard(session_id)
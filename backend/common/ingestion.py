@@ -0,0 +1,211 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from common import artifacts
+from common.answer_cache import get_answer_cache
+from common.chunk_store import get_chunk_store
+from common.embeddings import cache_stats, embedding_metrics, iter_embeddings
+from common.extraction import iter_chunks, iter_s3_document_texts
+from common.lexical import LexicalIndexBuilder, save_lexical_index
+from common.manifest import (PENDING_MANIFEST_NAME, ChunkMatcher, load_manifest, load_pending_manifest,
+                             save_manifest, save_pending_manifest)
+from common.offsets import build_offsets, chunk_location, save_offsets
+from common.prompts import DEFAULT_MODEL_ID, count_tokens
+from common.vector_index import DEFAULT_CASE_ID, namespace_for
+
+CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE', '2000'))
+CHUNK_OVERLAP = int(os.environ.get('CHUNK_OVERLAP', '200'))
+UPSERT_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+# Uploads for a case other than DEFAULT_CASE_ID land under {CASE_KEY_PREFIX}{case_id}/, which is
+# how the S3-triggered handlers tell which case a new object belongs to
+CASE_KEY_PREFIX = os.environ.get('CASE_KEY_PREFIX', 'cases/')
+
+# Metadata updates are one request per vector
+_update_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('METADATA_UPDATE_WORKERS', '8')))
+
+
+def upload_key(case_id, filename):
+    if not case_id or case_id == DEFAULT_CASE_ID:
+        return filename
+    return f"{CASE_KEY_PREFIX}{case_id}/{filename}"
+
+
+def case_id_for_key(key):
+    if key.startswith(CASE_KEY_PREFIX):
+        case_id, _, filename = key[len(CASE_KEY_PREFIX):].partition('/')
+        if case_id and filename:
+            return case_id
+    return DEFAULT_CASE_ID
+
+
+def document_name(key):
+    """The uploaded filename, without the case prefix."""
+    if case_id_for_key(key) != DEFAULT_CASE_ID:
+        return key[len(CASE_KEY_PREFIX):].partition('/')[2]
+    return key
+
+
+def list_vector_ids(index, key, namespace):
+    # index.list is only available on serverless indexes; pod indexes just skip the cleanup
+    try:
+        return [vid for page in index.list(prefix=f"{key}#", namespace=namespace) for vid in page]
+    except Exception as e:
+        print(f"DEBUG: Could not list existing vectors for {key}: {e}")
+        return []
+
+
+def upsert_chunks(index, doc_id, case_id, items):
+    """
+    Embeds (vector_id, chunk) items and writes them to the chunk store and the case's
+    Pinecone namespace. Shared by inline ingestion and the queue's embed tasks.
+    Returns the number of chunks written.
+    """
+    namespace = namespace_for(case_id)
+
+    def flush(vectors, chunk_items):
+        # Text goes to the chunk store first so a query never sees a vector without its text
+        get_chunk_store().put_chunks(chunk_items)
+        index.upsert(vectors=vectors, namespace=namespace)
+
+    # Embeddings run concurrently (EMBED_WORKERS) but arrive in chunk order,
+    # so upserts start while later chunks are still being produced.
+    written = 0
+    vectors_to_upsert = []
+    chunk_items = []
+    for (vector_id, chunk), embedding in iter_embeddings(items, get_text=lambda item: item[1]['text']):
+        written += 1
+        vectors_to_upsert.append({
+            'id': vector_id,
+            'values': embedding,
+            'metadata': {
+                'case_id': case_id,
+                'doc_id': doc_id,
+                'source': doc_id,
+                'page_start': chunk['page_start'],
+                'page_end': chunk['page_end'],
+                'char_offset': chunk['char_offset']
+            }
+        })
+        chunk_items.append({
+            'vector_id': vector_id,
+            'doc_id': doc_id,
+            'text': chunk['text'],
+            # Counted once here so prompt assembly doesn't recount every retrieved chunk
+            'tokens': count_tokens(chunk['text'], DEFAULT_MODEL_ID),
+            'token_model': DEFAULT_MODEL_ID
+        })
+        if len(vectors_to_upsert) >= UPSERT_BATCH_SIZE:
+            flush(vectors_to_upsert, chunk_items)
+            vectors_to_upsert = []
+            chunk_items = []
+    if vectors_to_upsert:
+        flush(vectors_to_upsert, chunk_items)
+    return written
+
+
+def chunk_metadata(chunk):
+    return {'page_start': chunk['page_start'], 'page_end': chunk['page_end'], 'char_offset': chunk['char_offset']}
+
+
+def update_locations(index, case_id, items):
+    """Refreshes the page/offset metadata of (vector_id, chunk) items whose text moved but didn't change."""
+    namespace = namespace_for(case_id)
+    list(_update_pool.map(lambda item: index.update(item[0], chunk_metadata(item[1]), namespace), items))
+
+
+def commit_manifest(index, key, case_id, manifest, removed):
+    """Deletes the vectors of chunks that are gone and records the manifest as the document's indexed state."""
+    for start in range(0, len(removed), DELETE_BATCH_SIZE):
+        index.delete(ids=removed[start:start + DELETE_BATCH_SIZE], namespace=namespace_for(case_id))
+        get_chunk_store().delete_chunks(removed[start:start + DELETE_BATCH_SIZE])
+    save_manifest(manifest)
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        answer_cache.invalidate(key, case_id)
+
+
+def commit_pending_manifest(index, key, case_id):
+    """Called once the last embed task of a queued ingest has landed (see ingest/index.py)."""
+    pending = load_pending_manifest(key)
+    if pending is None:
+        return
+    commit_manifest(index, key, case_id, pending['manifest'], pending['removed'])
+    artifacts.delete_json(key, PENDING_MANIFEST_NAME)
+
+
+def index_document(index, bucket, key, case_id, head_chars=100, dispatch=None):
+    """
+    Streams an S3 document through extract -> chunk -> embed -> upsert without
+    ever holding the whole file or its full text in memory.
+    Only chunks whose text is not in the stored manifest are embedded and upserted.
+    `dispatch(items)` can take over the (vector_id, chunk) items instead of embedding
+    them inline (the ingest queue uses it to fan out embed tasks); it returns the count.
+    The manifest is then only committed by commit_pending_manifest once they have all landed.
+    Returns None for unsupported file types, otherwise a summary including the
+    first `head_chars` characters of text (used for previews).
+    """
+    texts = iter_s3_document_texts(bucket, key)
+    if texts is None:
+        return None
+
+    summary = {'chars': 0, 'chunks': 0, 'changed': 0, 'moved': 0, 'removed': 0, 'head': ""}
+    previous = load_manifest(key)
+    matcher = ChunkMatcher(key, previous)
+    page_offsets = []
+    locations = []
+    moved = []
+    lexical = LexicalIndexBuilder(key)
+
+    def counted(pages):
+        last_page = None
+        for page, text in pages:
+            if page != last_page:
+                page_offsets.append(summary['chars'])
+                last_page = page
+            summary['chars'] += len(text)
+            if len(summary['head']) < head_chars:
+                summary['head'] += text[:head_chars - len(summary['head'])]
+            yield page, text
+
+    def changed_chunks():
+        for chunk in iter_chunks(counted(texts), CHUNK_SIZE, CHUNK_OVERLAP):
+            location = chunk_location(chunk)
+            locations.append(location)
+            entry, old = matcher.add(chunk['text'], location)
+            lexical.add(entry['id'], chunk['text'])
+            if old is None:
+                yield entry['id'], chunk
+            elif old.get('loc') != location:
+                moved.append((entry['id'], chunk))
+
+    summary['changed'] = (dispatch or (lambda items: upsert_chunks(index, key, case_id, items)))(changed_chunks())
+    update_locations(index, case_id, moved)
+    summary['moved'] = len(moved)
+
+    manifest = matcher.manifest()
+    summary['chunks'] = len(manifest['chunks'])
+    removed = matcher.removed()
+    if previous is None:
+        # First ingest (or pre-manifest vectors): drop any leftover {key}#{i} beyond the new range
+        removed = [
+            vid for vid in list_vector_ids(index, key, namespace_for(case_id))
+            if vid.rsplit('#', 1)[1].isdigit() and int(vid.rsplit('#', 1)[1]) >= summary['chunks']
+        ]
+    summary['removed'] = len(removed)
+
+    save_offsets(build_offsets(key, page_offsets, locations, [entry['id'] for entry in manifest['chunks']]))
+    save_lexical_index(lexical.build())
+    if dispatch is not None and summary['changed']:
+        # Until every embed task has landed, the old manifest stays the indexed state, so a failed
+        # task leaves its chunks to be embedded again by the next run
+        save_pending_manifest(manifest, removed)
+    elif summary['changed'] or summary['removed'] or summary['moved'] or previous is None:
+        commit_manifest(index, key, case_id, manifest, removed)
+    if dispatch is not None and not summary['changed']:
+        artifacts.delete_json(key, PENDING_MANIFEST_NAME)  # an earlier run's, superseded by this one
+
+    print(f"DEBUG: Indexed {key}: {summary['chars']} chars, {summary['chunks']} chunks, "
+          f"{summary['changed']} changed, {summary['moved']} moved, {summary['removed']} removed")
+    print(f"DEBUG: Embedding cache {cache_stats()}, requests {embedding_metrics()}")
+    return summary
@@ -0,0 +1,158 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from common import clients
+
+# INGEST_QUEUE_URL -> SQS (production); INGEST_QUEUE_PATH -> SQLite stand-in (local runs / tests,
+# ':memory:' for a throwaway in-process queue). With neither set, ingestion runs inline.
+INGEST_QUEUE_URL = os.environ.get('INGEST_QUEUE_URL')
+INGEST_QUEUE_PATH = os.environ.get('INGEST_QUEUE_PATH')
+VISIBILITY_TIMEOUT = int(os.environ.get('INGEST_VISIBILITY_TIMEOUT', '1800'))
+MAX_RECEIVES = int(os.environ.get('INGEST_MAX_RECEIVES', '3'))
+SEND_BATCH_SIZE = 10  # SQS SendMessageBatch limit
+
+
+class SQSQueue:
+    def __init__(self, queue_url=INGEST_QUEUE_URL):
+        self.queue_url = queue_url
+        self.client = clients.sqs()
+
+    def send_many(self, jobs):
+        for start in range(0, len(jobs), SEND_BATCH_SIZE):
+            entries = [
+                {'Id': str(i), 'MessageBody': json.dumps(job)}
+                for i, job in enumerate(jobs[start:start + SEND_BATCH_SIZE])
+            ]
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            if response.get('Failed'):
+                raise RuntimeError(f"Failed to enqueue {len(response['Failed'])} ingest jobs: {response['Failed']}")
+
+    def receive(self, max_messages=10):
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=1
+        )
+        return [
+            {'messageId': m['MessageId'], 'receiptHandle': m['ReceiptHandle'], 'body': m['Body']}
+            for m in response.get('Messages', [])
+        ]
+
+    def delete(self, receipt_handle):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle)
+
+
+class SQLiteQueue:
+    """
+    Local stand-in with SQS semantics: received messages stay invisible for the
+    visibility timeout, and a message received MAX_RECEIVES times without being
+    deleted moves to the dead_letters table.
+    """
+
+    def __init__(self, path=INGEST_QUEUE_PATH, visibility_timeout=VISIBILITY_TIMEOUT, max_receives=MAX_RECEIVES):
+        self.visibility_timeout = visibility_timeout
+        self.max_receives = max_receives
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id TEXT PRIMARY KEY, body TEXT NOT NULL, visible_at REAL NOT NULL, receives INTEGER NOT NULL DEFAULT 0, "
+            "receipt TEXT)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dead_letters (id TEXT PRIMARY KEY, body TEXT NOT NULL, failed_at REAL)")
+        self.conn.commit()
+
+    def send_many(self, jobs):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO messages (id, body, visible_at) VALUES (?, ?, ?)",
+                [(str(uuid.uuid4()), json.dumps(job), now) for job in jobs]
+            )
+            self.conn.commit()
+
+    def receive(self, max_messages=10):
+        now = time.time()
+        messages = []
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, body, receives FROM messages WHERE visible_at <= ? ORDER BY rowid LIMIT ?",
+                (now, max_messages)
+            ).fetchall()
+            for message_id, body, receives in rows:
+                if receives >= self.max_receives:
+                    self.conn.execute("INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?)", (message_id, body, now))
+                    self.conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+                    continue
+                receipt = str(uuid.uuid4())
+                self.conn.execute(
+                    "UPDATE messages SET visible_at = ?, receives = receives + 1, receipt = ? WHERE id = ?",
+                    (now + self.visibility_timeout, receipt, message_id)
+                )
+                messages.append({'messageId': message_id, 'receiptHandle': receipt, 'body': body})
+            self.conn.commit()
+        return messages
+
+    def delete(self, receipt_handle):
+        with self.lock:
+            self.conn.execute("DELETE FROM messages WHERE receipt = ?", (receipt_handle,))
+            self.conn.commit()
+
+    def dead_letters(self):
+        with self.lock:
+            return [json.loads(body) for (body,) in self.conn.execute("SELECT body FROM dead_letters")]
+
+
+_queue = None
+
+
+def get_queue():
+    """Returns the configured ingest queue, or None when ingestion should run inline."""
+    global _queue
+    if _queue is None:
+        if INGEST_QUEUE_URL:
+            _queue = SQSQueue()
+        elif INGEST_QUEUE_PATH:
+            _queue = SQLiteQueue()
+    return _queue
+
+
+def handle_sqs_event(event, process_job):
+    """
+    Lambda SQS entry point. Each record is processed independently and only the
+    failed ones are reported back (ReportBatchItemFailures), so SQS retries them
+    and eventually moves them to the dead-letter queue.
+    """
+    failures = []
+    for record in event.get('Records', []):
+        try:
+            process_job(json.loads(record['body']))
+        except Exception as e:
+            print(f"INGEST JOB FAILED ({record.get('messageId')}): {e}")
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+
+def drain(queue, process_job, idle_rounds=1):
+    """Local worker loop: processes messages until the queue stays empty for idle_rounds polls."""
+    idle = 0
+    processed = 0
+    while idle < idle_rounds:
+        messages = queue.receive()
+        if not messages:
+            idle += 1
+            continue
+        idle = 0
+        for message in messages:
+            try:
+                process_job(json.loads(message['body']))
+                queue.delete(message['receiptHandle'])
+                processed += 1
+            except Exception as e:
+                # Left on the queue: it becomes visible again after the visibility timeout
+                print(f"INGEST JOB FAILED ({message['messageId']}): {e}")
+    return processed
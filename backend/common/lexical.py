@@ -0,0 +1,159 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from common import artifacts
+
+# Per-document BM25 inverted index, built at ingest time and stored next to the
+# manifest as a gzipped artifact:
+#   ids:      vector ID per chunk, in document order
+#   lengths:  token count per chunk, by position
+#   postings: {term: [i0, tf0, i1, tf1, ...]} (positions; flat pairs keep the JSON small)
+# Corpus statistics (N, avgdl, df) are combined across whichever documents a query covers.
+LEXICAL_NAME = 'bm25.json.gz'
+LEXICAL_TOP_K = int(os.environ.get('LEXICAL_TOP_K', '10'))
+LEXICAL_CACHE_SIZE = int(os.environ.get('LEXICAL_CACHE_SIZE', '64'))
+LEXICAL_CACHE_TTL = int(os.environ.get('LEXICAL_CACHE_TTL', '60'))
+# A case's uncached indexes are fetched this many at a time, so a query over many documents
+# costs roughly one artifact round-trip per LEXICAL_FETCH_WORKERS documents
+LEXICAL_FETCH_WORKERS = int(os.environ.get('LEXICAL_FETCH_WORKERS', '16'))
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were "
+    "will with any all such which who what when where how does do".split()
+)
+# Light suffix stripping so "terminate", "terminated" and "termination" share a term
+SUFFIXES = ('ations', 'ation', 'ating', 'ated', 'ates', 'ate', 'ings', 'ing', 'ions', 'ion', 'ed', 's')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_fetch_pool = ThreadPoolExecutor(max_workers=LEXICAL_FETCH_WORKERS)
+_doc_ids = {'at': 0.0, 'ids': []}
+
+
+def stem(token):
+    for suffix in SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 4:
+            return token[:-len(suffix)]
+    return token
+
+
+def tokenize(text):
+    return [stem(token) for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+class LexicalIndexBuilder:
+    def __init__(self, doc_id):
+        self.doc_id = doc_id
+        self.ids = []
+        self.lengths = []
+        self.postings = {}
+
+    def add(self, vector_id, text):
+        """Chunks must be added in document order."""
+        i = len(self.ids)
+        tokens = tokenize(text)
+        self.ids.append(vector_id)
+        self.lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            self.postings.setdefault(term, []).extend((i, tf))
+
+    def build(self):
+        return {'doc_id': self.doc_id, 'ids': self.ids, 'lengths': self.lengths, 'postings': self.postings}
+
+
+def save_lexical_index(index):
+    artifacts.put_json(index['doc_id'], LEXICAL_NAME, index)
+    with _cache_lock:
+        _cache.pop(index['doc_id'], None)
+
+
+def cached_lexical_index(doc_id):
+    with _cache_lock:
+        entry = _cache.get(doc_id)
+        if entry is not None and entry[1] > time.time():
+            _cache.move_to_end(doc_id)
+            return entry[0]
+    return None
+
+
+def load_lexical_index(doc_id):
+    index = cached_lexical_index(doc_id)
+    if index is not None:
+        return index
+    index = artifacts.get_json(doc_id, LEXICAL_NAME)
+    if index is not None:
+        with _cache_lock:
+            _cache[doc_id] = (index, time.time() + LEXICAL_CACHE_TTL)
+            _cache.move_to_end(doc_id)
+            if len(_cache) > LEXICAL_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return index
+
+
+def load_lexical_indexes(doc_ids):
+    """Indexes of `doc_ids` that exist, in order; the uncached ones are fetched in parallel."""
+    indexes = {doc_id: cached_lexical_index(doc_id) for doc_id in doc_ids}
+    missing = [doc_id for doc_id, index in indexes.items() if index is None]
+    if len(missing) > 1:
+        indexes.update(zip(missing, _fetch_pool.map(load_lexical_index, missing)))
+    elif missing:
+        indexes[missing[0]] = load_lexical_index(missing[0])
+    return [indexes[doc_id] for doc_id in doc_ids if indexes[doc_id]]
+
+
+def indexed_doc_ids():
+    if _doc_ids['at'] < time.time() - LEXICAL_CACHE_TTL:
+        _doc_ids['ids'] = artifacts.list_doc_ids(LEXICAL_NAME)
+        _doc_ids['at'] = time.time()
+    return _doc_ids['ids']
+
+
+def search(query, doc_ids=None, top_k=LEXICAL_TOP_K):
+    """BM25 over the chunks of `doc_ids` (default: every indexed document). Returns [(vector_id, score)]."""
+    terms = set(tokenize(query))
+    if not terms:
+        return []
+    indexes = load_lexical_indexes(doc_ids or indexed_doc_ids())
+    total_chunks = sum(len(ix['lengths']) for ix in indexes)
+    if not total_chunks:
+        return []
+    avgdl = sum(sum(ix['lengths']) for ix in indexes) / total_chunks or 1.0
+
+    idf = {}
+    for term in terms:
+        df = sum(len(ix['postings'].get(term, ())) // 2 for ix in indexes)
+        if df:
+            idf[term] = math.log(1 + (total_chunks - df + 0.5) / (df + 0.5))
+
+    scores = {}
+    for ix in indexes:
+        lengths = ix['lengths']
+        ids = ix.get('ids')  # indexes built before it existed used positional IDs
+        for term, weight in idf.items():
+            postings = ix['postings'].get(term)
+            if not postings:
+                continue
+            for j in range(0, len(postings), 2):
+                i, tf = postings[j], postings[j + 1]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[i] / avgdl)
+                key = ids[i] if ids else f"{ix['doc_id']}#{i}"
+                scores[key] = scores.get(key, 0.0) + weight * tf * (BM25_K1 + 1) / (tf + norm)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Fuses ranked ID lists: score(id) = sum of 1 / (k + rank). Returns [(id, score)] best first."""
+    fused = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            fused[item_id] = fused.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
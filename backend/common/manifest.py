@@ -0,0 +1,79 @@
+import hashlib
+
+from common import artifacts
+
+MANIFEST_NAME = 'manifest.json'
+PENDING_MANIFEST_NAME = 'manifest.pending.json'
+
+# Per-document chunk manifest: one {'id', 'hash', 'loc'} entry per chunk, in document order,
+# and 'next', the first unused vector number. Vector IDs are {doc_id}#{n}. A chunk keeps its ID
+# for as long as its text is unchanged, wherever it moves in the document, so an amendment only
+# embeds chunks with new text; chunks that merely moved get their location metadata refreshed.
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def vector_id(doc_id, n):
+    return f"{doc_id}#{n}"
+
+
+def next_vector_number(manifest):
+    if not manifest:
+        return 0
+    if 'next' in manifest:
+        return manifest['next']
+    # Manifests written before 'next' existed used positional IDs
+    numbers = [int(n) for n in (entry['id'].rpartition('#')[2] for entry in manifest['chunks']) if n.isdigit()]
+    return max(numbers, default=-1) + 1
+
+
+class ChunkMatcher:
+    """Builds a document's new manifest, reusing the previous version's vector ID for every unchanged chunk text."""
+
+    def __init__(self, doc_id, previous):
+        self.doc_id = doc_id
+        self.next = next_vector_number(previous)
+        self.chunks = []
+        # Repeated texts (boilerplate clauses) are matched in document order
+        self.unmatched = {}
+        for entry in (previous['chunks'] if previous else []):
+            self.unmatched.setdefault(entry['hash'], []).append(entry)
+
+    def add(self, text, location):
+        """Returns (entry, previous entry with the same text or None). Chunks must be added in order."""
+        digest = chunk_hash(text)
+        candidates = self.unmatched.get(digest)
+        old = candidates.pop(0) if candidates else None
+        if old is None:
+            entry = {'id': vector_id(self.doc_id, self.next), 'hash': digest, 'loc': location}
+            self.next += 1
+        else:
+            entry = {'id': old['id'], 'hash': digest, 'loc': location}
+        self.chunks.append(entry)
+        return entry, old
+
+    def removed(self):
+        """Vector IDs of previous chunks whose text is gone."""
+        return [entry['id'] for entries in self.unmatched.values() for entry in entries]
+
+    def manifest(self):
+        return {'doc_id': self.doc_id, 'chunks': self.chunks, 'next': self.next}
+
+
+def load_manifest(doc_id):
+    return artifacts.get_json(doc_id, MANIFEST_NAME)
+
+
+def save_manifest(manifest):
+    artifacts.put_json(manifest['doc_id'], MANIFEST_NAME, manifest)
+
+
+def load_pending_manifest(doc_id):
+    return artifacts.get_json(doc_id, PENDING_MANIFEST_NAME)
+
+
+def save_pending_manifest(manifest, removed):
+    """Parks a manifest whose chunks are still being embedded, with the vector IDs to delete once they land."""
+    artifacts.put_json(manifest['doc_id'], PENDING_MANIFEST_NAME, {'manifest': manifest, 'removed': removed})
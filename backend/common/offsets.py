@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+
+from common import artifacts
+
+OFFSETS_NAME = 'offsets.json'
+OFFSETS_CACHE_SIZE = 64
+
+# Per-document offset index, stored as flat arrays so even large documents stay small:
+#   pages:  document character offset where each page starts (index 0 = page 1 for PDFs)
+#   chunks: [char_offset, length, page_start, page_end] per chunk, in document order
+#   ids:    the vector ID of each of those chunks
+_cache = OrderedDict()
+# Chat retrieval and ingestion look offsets up from pool threads
+_cache_lock = threading.Lock()
+
+
+def chunk_location(chunk):
+    return [chunk['char_offset'], len(chunk['text']), chunk['page_start'], chunk['page_end']]
+
+
+def build_offsets(doc_id, page_offsets, locations, ids):
+    return {'doc_id': doc_id, 'pages': page_offsets, 'chunks': locations, 'ids': ids}
+
+
+def save_offsets(offsets):
+    artifacts.put_json(offsets['doc_id'], OFFSETS_NAME, offsets)
+    with _cache_lock:
+        _cache.pop(offsets['doc_id'], None)
+
+
+def load_offsets(doc_id):
+    with _cache_lock:
+        offsets = _cache.get(doc_id)
+        if offsets is not None:
+            _cache.move_to_end(doc_id)
+            return offsets
+    offsets = artifacts.get_json(doc_id, OFFSETS_NAME)
+    if offsets is not None:
+        # Indexes written before 'ids' existed used positional IDs ({doc_id}#{i})
+        ids = offsets.get('ids') or [f"{doc_id}#{i}" for i in range(len(offsets['chunks']))]
+        offsets['positions'] = {vector_id: i for i, vector_id in enumerate(ids)}
+        with _cache_lock:
+            _cache[doc_id] = offsets
+            _cache.move_to_end(doc_id)
+            if len(_cache) > OFFSETS_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return offsets
+
+
+def locate_chunk(vector_id):
+    """
+    Resolves a {doc_id}#{n} vector ID to its source location without touching the PDF.
+    Returns None if the document has no offset index (ingested before it existed).
+    """
+    doc_id = vector_id.rpartition('#')[0]
+    offsets = load_offsets(doc_id)
+    i = offsets['positions'].get(vector_id) if offsets else None
+    if i is None:
+        return None
+    char_offset, length, page_start, page_end = offsets['chunks'][i]
+    pages = offsets['pages']
+    page_char_offset = char_offset - pages[page_start - 1] if 0 < page_start <= len(pages) else None
+    return {
+        'doc_id': doc_id,
+        'char_offset': char_offset,
+        'length': length,
+        'page_start': page_start,
+        'page_end': page_end,
+        'page_char_offset': page_char_offset
+    }
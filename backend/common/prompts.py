@@ -0,0 +1,82 @@
+import math
+import os
+import re
+
+# Token accounting for prompts. No tokenizer ships in the Lambda bundle, so counts use a
+# conservative per-model characters-per-token ratio (errs towards overcounting) plus a
+# safety margin on the context window.
+DEFAULT_MODEL_ID = os.environ.get('ANSWER_MODEL_ID', 'meta.llama3-8b-instruct-v1:0')
+PROMPT_SAFETY_MARGIN = float(os.environ.get('PROMPT_SAFETY_MARGIN', '0.05'))
+TRUNCATION_MARKER = "...(truncated)"
+
+# model id -> (context window in tokens, characters per token)
+MODEL_LIMITS = {
+    'meta.llama3-8b-instruct-v1:0': (8192, 3.6),
+    'meta.llama3-70b-instruct-v1:0': (8192, 3.6),
+    'amazon.titan-text-express-v1': (8192, 3.2),
+    'amazon.titan-embed-text-v1': (8192, 3.2),
+    'anthropic.claude-3-haiku-20240307-v1:0': (200000, 3.4),
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': (200000, 3.4),
+}
+DEFAULT_LIMITS = (4096, 3.0)
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?;:])\s+|\n\s*\n")
+
+
+def model_limits(model_id=None):
+    return MODEL_LIMITS.get(model_id or DEFAULT_MODEL_ID, DEFAULT_LIMITS)
+
+
+def count_tokens(text, model_id=None):
+    if not text:
+        return 0
+    return math.ceil(len(text) / model_limits(model_id)[1])
+
+
+def chars_for_tokens(tokens, model_id=None):
+    return int(max(tokens, 0) * model_limits(model_id)[1])
+
+
+def chunk_tokens(chunk, model_id=None):
+    """Token count for a chunk-store item, using the count cached at ingest when it was made for this model."""
+    model_id = model_id or DEFAULT_MODEL_ID
+    if chunk.get('tokens') is not None and chunk.get('token_model') == model_id:
+        return int(chunk['tokens'])
+    return count_tokens(chunk.get('text', ''), model_id)
+
+
+def input_budget(model_id, max_output_tokens, *fixed_texts):
+    """Tokens left for variable prompt sections after the output reservation, margin and fixed text."""
+    window = model_limits(model_id)[0]
+    usable = int(window * (1 - PROMPT_SAFETY_MARGIN)) - max_output_tokens
+    return max(0, usable - sum(count_tokens(text, model_id) for text in fixed_texts))
+
+
+def truncate_to_tokens(text, max_tokens, model_id=None, marker=TRUNCATION_MARKER):
+    """Cuts `text` to fit `max_tokens`, at the last sentence/paragraph break that fits (else a word break)."""
+    if count_tokens(text, model_id) <= max_tokens:
+        return text
+    limit = chars_for_tokens(max_tokens - count_tokens(marker, model_id), model_id)
+    if limit <= 0:
+        return ""
+    head = text[:limit]
+    breaks = [m.start() for m in SENTENCE_END_RE.finditer(head)]
+    # Only back up to a sentence break if it keeps most of the allowance
+    if breaks and breaks[-1] >= limit * 0.6:
+        head = head[:breaks[-1]]
+    elif ' ' in head[int(limit * 0.8):]:
+        head = head[:head.rindex(' ')]
+    return head.rstrip() + marker
+
+
+def fit_history(history, max_tokens, model_id=None):
+    """Most recent whole messages that fit in `max_tokens`, oldest first."""
+    kept = []
+    used = 0
+    for msg in reversed(history):
+        cost = count_tokens(f"{msg['role'].upper()}: {msg['content']}\n", model_id)
+        if used + cost > max_tokens:
+            break
+        kept.append(msg)
+        used += cost
+    return list(reversed(kept)), used
@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+import re
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from common import artifacts, clients
+from common.chunk_store import get_chunk_store
+from common.manifest import load_manifest
+from common.offsets import load_offsets
+from common.prompts import chunk_tokens, input_budget
+
+# Full-document risk analysis, run as its own job after a document is indexed:
+#   screen: a single combined regex over the risk vocabulary drops chunks with no risk language
+#           at all, so clean documents score 'Low' without a model call; flagged chunks are cut
+#           down to the windows around their matches
+#   map:    consecutive flagged chunks are packed into prompt-sized batches and scanned in parallel,
+#           each returning clause-level findings tagged with the chunk they came from
+#   reduce: findings are de-duplicated, ranked and folded into the document's risk score, together
+#           with the clauses whose absence is a risk, which only the whole document can show
+# Finished batches are checkpointed to the risk_run.json artifact (keyed by the chunk hashes
+# they cover), so a retried or interrupted run only scans what is still missing.
+RISK_MODEL_ID = 'meta.llama3-8b-instruct-v1:0'
+RISK_MAX_TOKENS = 1024
+RISK_WORKERS = int(os.environ.get('RISK_WORKERS', '4'))
+RISK_MAX_CLAUSES = int(os.environ.get('RISK_MAX_CLAUSES', '50'))  # kept on the metadata item (400 KB limit)
+# A run stops starting new batches after this many seconds and reports itself unfinished so the
+# caller can re-queue it (the worker Lambda times out at 300s)
+RISK_TIME_BUDGET = int(os.environ.get('RISK_TIME_BUDGET', '240'))
+RISK_RUN_NAME = 'risk_run.json'
+RISK_PRESCREEN = os.environ.get('RISK_PRESCREEN', '1') == '1'
+PRESCREEN_WINDOW = 600  # characters kept either side of a match by prescreen_windows()
+METADATA_TABLE = os.environ.get('TABLE_NAME', 'CaseChat_Metadata')
+
+SEVERITY = {'High': 3, 'Medium': 2, 'Low': 1}
+CATEGORIES = [
+    "Unlimited Liability",
+    "Liability Cap",
+    "Unilateral Indemnification",
+    "Missing Termination for Convenience",
+    "Termination",
+    "Non-Compete",
+    "Auto-Renewal",
+    "Governing Law / Venue",
+    "Other",
+]
+
+# Categories that flag a missing clause: a batch only sees excerpts, so these are decided once per
+# document in the reduce step (risk when nothing in the document matches) and never asked of the model
+ABSENCE_CHECKS = {
+    "Missing Termination for Convenience": (
+        re.compile(r"for\s+convenience|without\s+cause|for\s+any\s+reason\s+or\s+no\s+reason", re.IGNORECASE),
+        'Medium',
+        "No clause lets a party terminate for convenience."
+    ),
+}
+BATCH_CATEGORIES = [category for category in CATEGORIES if category not in ABSENCE_CHECKS]
+
+# Vocabulary behind each category in the prompt; any match sends the chunk to the model
+PRESCREEN_PATTERNS = {
+    'liability': r"liab(?:le|ility|ilities)|unlimited|consequential\s+damages|damages\s+(?:shall\s+)?not\s+exceed",
+    'indemnification': r"indemn\w*|hold(?:s)?\s+harmless",
+    'termination': r"terminat\w*|for\s+convenience|cancel\w*",
+    'non_compete': r"non[-\s]?compet\w*|not\s+(?:to\s+)?compete|non[-\s]?solicit\w*|restrictive\s+covenant",
+    'renewal': r"(?:auto(?:matic(?:ally)?)?[-\s]?)renew\w*|renew\w*\s+automatically|evergreen",
+    'governing_law': r"governing\s+law|governed\s+by|jurisdiction|venue",
+}
+# The lookahead on the first letters every pattern can start with lets the scan skip most
+# word boundaries without trying each alternative (about 2x faster on contract text)
+PRESCREEN_RE = re.compile(
+    r"\b(?=[acdefghijlnrtuv])(?:" + "|".join(f"(?P<{name}>{pattern})" for name, pattern in PRESCREEN_PATTERNS.items()) + ")",
+    re.IGNORECASE
+)
+
+
+def format_batch_prompt(chunks_text):
+    prompt = f"""
+    Instruction: Act as a Senior Legal Risk Officer.
+    Below are numbered excerpts of one contract. Identify every clause that creates legal risk.
+    Only report clauses present in the excerpts, never ones that seem to be missing.
+    Focus on:
+    1. Unlimited Liability (High Risk)
+    2. Unilateral Indemnification (High Risk)
+    3. Non-Compete Clauses > 2 Years (Medium Risk)
+    Also report liability caps, termination, auto-renewal and governing law / venue clauses.
+
+    Return ONLY a JSON object in this format (an empty list if nothing is risky):
+    {{
+        "clauses": [
+            {{
+                "chunk": <excerpt number>,
+                "category": one of {json.dumps(BATCH_CATEGORIES)},
+                "risk": "High" or "Medium" or "Low",
+                "summary": "One sentence describing the risk"
+            }}
+        ]
+    }}
+
+    Excerpts:
+    {chunks_text}
+
+    JSON Response:
+    """
+
+    # Llama 3 Instruct Format
+    return f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+
+
+def prescreen_windows(text, radius=PRESCREEN_WINDOW):
+    """
+    Text around every risk-vocabulary match, with overlapping windows merged, joined by
+    "...". Empty when nothing matches (the document can be scored 'Low' without a model call).
+    """
+    spans = []
+    for match in PRESCREEN_RE.finditer(text):
+        start, end = max(0, match.start() - radius), min(len(text), match.end() + radius)
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+    return "\n...\n".join(text[start:end] for start, end in spans)
+
+
+def prescreen(chunks):
+    """Keeps the (i, chunk) pairs that contain any risk vocabulary, each cut down to its prescreen_windows()."""
+    screened = []
+    for i, chunk in chunks:
+        windows = prescreen_windows(chunk['text'])
+        if windows:
+            screened.append((i, {'text': windows}))
+    return screened
+
+
+def absence_clauses(chunks):
+    """Document-level findings for the ABSENCE_CHECKS categories with no match in any chunk."""
+    return [
+        {'chunk': -1, 'category': category, 'risk': risk, 'summary': summary}
+        for category, (pattern, risk, summary) in ABSENCE_CHECKS.items()
+        if not any(pattern.search(chunk['text']) for _, chunk in chunks)
+    ]
+
+
+def excerpt(i, chunk):
+    return f"[Excerpt {i}]\n{chunk['text']}\n"
+
+
+def plan_batches(chunks):
+    """Packs (i, chunk) pairs, in document order, into batches that fit the risk prompt."""
+    budget = input_budget(RISK_MODEL_ID, RISK_MAX_TOKENS, format_batch_prompt(""))
+    batches = []
+    batch = []
+    used = 0
+    for i, chunk in chunks:
+        cost = chunk_tokens(chunk, RISK_MODEL_ID) + 8  # excerpt header
+        if batch and used + cost > budget:
+            batches.append(batch)
+            batch = []
+            used = 0
+        batch.append((i, chunk))
+        used += cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def batch_key(batch, hashes):
+    return hashlib.sha256('|'.join(f"{i}:{hashes[i]}" for i, _ in batch).encode()).hexdigest()[:16]
+
+
+def parse_clauses(raw_completion, batch):
+    start = raw_completion.find('{')
+    end = raw_completion.rfind('}') + 1
+    if start == -1 or end == 0:
+        print("DEBUG: Could not find JSON in risk response")
+        return []
+    try:
+        clauses = json.loads(raw_completion[start:end]).get('clauses', [])
+    except ValueError:
+        print("DEBUG: Risk response was not valid JSON")
+        return []
+    in_batch = {i for i, _ in batch}
+    parsed = []
+    for clause in clauses:
+        try:
+            i = int(clause.get('chunk'))
+        except (TypeError, ValueError):
+            continue
+        if i not in in_batch:
+            continue
+        parsed.append({
+            'chunk': i,
+            'category': clause.get('category') if clause.get('category') in CATEGORIES else 'Other',
+            'risk': clause.get('risk') if clause.get('risk') in SEVERITY else 'Low',
+            'summary': str(clause.get('summary', ''))[:300]
+        })
+    return parsed
+
+
+def scan_batch(batch):
+    """Map step: one model call over a batch of excerpts."""
+    payload = {
+        "prompt": format_batch_prompt("\n".join(excerpt(i, chunk) for i, chunk in batch)),
+        "max_gen_len": RISK_MAX_TOKENS,
+        "temperature": 0.1
+    }
+    response = clients.bedrock().invoke_model(
+        modelId=RISK_MODEL_ID,
+        contentType='application/json',
+        accept='application/json',
+        body=json.dumps(payload)
+    )
+    response_body = json.loads(response.get('body').read())
+    return parse_clauses(response_body['generation'].strip(), batch)
+
+
+def add_pages(clause, offsets):
+    if offsets and clause['chunk'] < len(offsets['chunks']):
+        _, _, page_start, page_end = offsets['chunks'][clause['chunk']]
+        clause['page_start'], clause['page_end'] = page_start, page_end
+    return clause
+
+
+def reduce_clauses(clauses, absent=()):
+    """
+    Reduce step: one finding per (category, page) with the highest severity, ranked by severity
+    then position. Batch findings in the ABSENCE_CHECKS categories are replaced by the
+    document-level `absent` ones. Returns (score, flags, clauses).
+    """
+    merged = {}
+    for clause in [c for c in clauses if c['category'] not in ABSENCE_CHECKS] + list(absent):
+        key = (clause['category'], clause.get('page_start', clause['chunk']))
+        current = merged.get(key)
+        if current is None or SEVERITY[clause['risk']] > SEVERITY[current['risk']]:
+            merged[key] = clause
+    ranked = sorted(merged.values(), key=lambda c: (-SEVERITY[c['risk']], c['chunk']))[:RISK_MAX_CLAUSES]
+    if not ranked:
+        return 'Low', [], []
+    score = max(ranked, key=lambda c: SEVERITY[c['risk']])['risk']
+    flags = []
+    for clause in ranked:
+        if clause['risk'] == 'Low':
+            continue
+        page = f" (p. {clause['page_start']})" if clause.get('page_start') else ""
+        flag = f"{clause['category']}{page}: {clause['summary']}"
+        if flag not in flags:
+            flags.append(flag)
+    return score, flags[:10], ranked
+
+
+def set_risk_status(case_id, doc_id, status, **fields):
+    names = {'#risk_status': 'risk_status'}
+    values = {':risk_status': status, ':risk_updated': datetime.datetime.utcnow().isoformat()}
+    # updated_at moves the document up the listing index so polling clients see the change
+    expressions = ['#risk_status = :risk_status', 'risk_updated = :risk_updated', 'updated_at = :risk_updated']
+    for name, value in fields.items():
+        names[f"#{name}"] = name
+        values[f":{name}"] = value
+        expressions.append(f"#{name} = :{name}")
+    clients.table(METADATA_TABLE).update_item(
+        Key={'case_id': case_id, 'doc_id': doc_id},
+        UpdateExpression='SET ' + ', '.join(expressions),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+
+def analyze_document_risk(case_id, doc_id, workers=RISK_WORKERS, time_budget=RISK_TIME_BUDGET):
+    """
+    Scans every indexed chunk of doc_id and stores the per-clause results (with page
+    references) plus the overall score and flags on its metadata item. Safe to re-run:
+    batches already checkpointed for the current chunk contents are not scanned again.
+    Returns the result, or None if the time budget ran out first (re-run to continue).
+    """
+    started = time.time()
+    manifest = load_manifest(doc_id)
+    if not manifest or not manifest['chunks']:
+        print(f"DEBUG: No manifest for {doc_id}, skipping risk analysis")
+        return {'score': 'Low', 'flags': [], 'clauses': []}
+    hashes = [entry['hash'] for entry in manifest['chunks']]
+    texts = get_chunk_store().get_chunks([entry['id'] for entry in manifest['chunks']])
+    chunks = [(i, texts[entry['id']]) for i, entry in enumerate(manifest['chunks']) if entry['id'] in texts]
+    absent = absence_clauses(chunks)
+    if RISK_PRESCREEN:
+        screened = prescreen(chunks)
+        print(f"DEBUG: Risk prescreen for {doc_id}: {len(screened)}/{len(chunks)} chunks flagged")
+        chunks = screened
+    batches = plan_batches(chunks)
+
+    run = artifacts.get_json(doc_id, RISK_RUN_NAME) or {}
+    keys = [batch_key(batch, hashes) for batch in batches]
+    # Checkpoints for batches that no longer exist (the document changed since) are dropped
+    done = {key: run['batches'][key] for key in keys if key in run.get('batches', {})}
+    pending = [(key, batch) for key, batch in zip(keys, batches) if key not in done]
+    print(f"DEBUG: Risk analysis for {doc_id}: {len(batches)} batches, {len(pending)} to scan")
+    set_risk_status(case_id, doc_id, 'Running')
+
+    failures = 0
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # One wave per pool-full, checkpointing after each so a timeout loses at most one wave
+        for start in range(0, len(pending), workers):
+            if time_budget is not None and time.time() - started > time_budget:
+                print(f"DEBUG: Risk analysis for {doc_id} out of time with {len(pending) - start} batches left")
+                return None
+            wave = pending[start:start + workers]
+            for (key, _), result in zip(wave, [pool.submit(scan_batch, batch) for _, batch in wave]):
+                try:
+                    done[key] = result.result()
+                except Exception as e:
+                    print(f"RISK BATCH FAILED ({doc_id}): {e}")
+                    failures += 1
+            artifacts.put_json(doc_id, RISK_RUN_NAME, {'doc_id': doc_id, 'batches': done})
+
+    if failures:
+        set_risk_status(case_id, doc_id, 'Incomplete')
+        raise RuntimeError(f"{failures} of {len(batches)} risk batches failed for {doc_id}; re-run to resume")
+
+    offsets = load_offsets(doc_id)
+    clauses = [add_pages(dict(clause), offsets) for key in keys for clause in done[key]]
+    score, flags, ranked = reduce_clauses(clauses, absent)
+    set_risk_status(case_id, doc_id, 'Complete', risk_score=score, risk_flags=flags, risk_clauses=ranked)
+    print(f"DEBUG: Risk analysis for {doc_id}: {score}, {len(ranked)} clauses")
+    return {'score': score, 'flags': flags, 'clauses': ranked}
+
+
+def request_risk_analysis(case_id, doc_id, queue=None):
+    """Queues the scan as a 'risk' ingest job, or runs it inline when there is no queue."""
+    if queue is not None:
+        queue.send_many([{'type': 'risk', 'case_id': case_id, 'doc_id': doc_id}])
+        return
+    # Inline runs never fail the caller; re-running resumes from the checkpointed batches
+    try:
+        if analyze_document_risk(case_id, doc_id) is None:
+            print(f"RISK ANALYSIS INCOMPLETE: {doc_id} ran out of time")
+    except Exception as e:
+        print(f"RISK ANALYSIS FAILED: {e}")
@@ -0,0 +1,175 @@
+import fnmatch
+import heapq
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import clients
+from common.vector_store import get_vector_store
+
+# Vectors are partitioned by case: every case_id gets its own namespace, so a query
+# scoped to a case only searches that case's vectors and its latency doesn't grow with the
+# number of firms and cases in the index. Which index a case lives in is routed by
+# VECTOR_INDEX_ROUTES, a JSON list of [case_id glob, index name] pairs tried in order
+# (e.g. '[["acme-*", "casechat-acme"]]'); unmatched cases go to PINECONE_INDEX. A query
+# over several cases runs one query_namespaces call per index and merges the results by
+# score. VECTOR_NAMESPACES=shared keeps the old layout (one namespace, case_id filter).
+# Index names resolve to a VectorStore (Pinecone, or the local engine; see common/vector_store.py).
+# Until `migrate` has emptied PINECONE_INDEX's default namespace, queries also search it for
+# the cases' vectors written before per-case namespaces (checked every LEGACY_CHECK_TTL seconds).
+VECTOR_NAMESPACES = os.environ.get('VECTOR_NAMESPACES', 'case')  # case | shared
+VECTOR_NAMESPACE_PREFIX = os.environ.get('VECTOR_NAMESPACE_PREFIX', '')
+VECTOR_INDEX_ROUTES = json.loads(os.environ.get('VECTOR_INDEX_ROUTES') or '[]')
+VECTOR_METRIC = os.environ.get('VECTOR_METRIC', 'cosine')  # the indexes' metric, for merging scores
+DEFAULT_CASE_ID = os.environ.get('DEFAULT_CASE_ID', 'default-case')
+SHARED_NAMESPACE = ''
+MIGRATE_BATCH_SIZE = 100
+LEGACY_CHECK_TTL = int(os.environ.get('LEGACY_CHECK_TTL', '300'))
+
+_route_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('VECTOR_ROUTE_WORKERS', '4')))
+_legacy = {}
+
+
+def index_name_for(case_id):
+    for pattern, index_name in VECTOR_INDEX_ROUTES:
+        if fnmatch.fnmatchcase(case_id, pattern):
+            return index_name
+    return clients.PINECONE_INDEX
+
+
+def namespace_for(case_id):
+    if VECTOR_NAMESPACES == 'shared':
+        return SHARED_NAMESPACE
+    return f"{VECTOR_NAMESPACE_PREFIX}{case_id}"
+
+
+def store_for(index_name):
+    return get_vector_store(index_name, VECTOR_METRIC)
+
+
+def index_for(case_id):
+    return store_for(index_name_for(case_id))
+
+
+def case_filter(case_ids, doc_id=None):
+    """Metadata filter for a query: the doc_id scope, plus the case scope when cases share a namespace."""
+    clauses = [{'doc_id': doc_id}] if doc_id else []
+    if VECTOR_NAMESPACES == 'shared':
+        clauses.append({'case_id': {'$in': list(case_ids)}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+
+
+def query_index(index_name, case_ids, vector, top_k, doc_id, include_values):
+    index = store_for(index_name)
+    namespaces = sorted({namespace_for(case_id) for case_id in case_ids})
+    options = {
+        'top_k': top_k,
+        'filter': case_filter(case_ids, doc_id),
+        'include_values': include_values,
+        'include_metadata': True
+    }
+    if len(namespaces) == 1:
+        results = index.query(vector=vector, namespace=namespaces[0], **options)
+    else:
+        results = index.query_namespaces(vector=vector, namespaces=namespaces, metric=VECTOR_METRIC, **options)
+    return results['matches']
+
+
+def legacy_namespace_in_use(index_name):
+    """Whether the index's default namespace still holds unmigrated vectors."""
+    if VECTOR_NAMESPACES == 'shared':
+        return False
+    checked = _legacy.get(index_name)
+    if checked is None or checked[0] < time.time() - LEGACY_CHECK_TTL:
+        try:
+            in_use = bool(next(iter(store_for(index_name).list(namespace=SHARED_NAMESPACE, limit=1)), []))
+        except Exception as e:
+            print(f"Legacy namespace check failed ({index_name}): {e}")
+            in_use = True
+        checked = _legacy[index_name] = (time.time(), in_use)
+    return checked[1]
+
+
+def query_legacy_namespace(index_name, case_ids, vector, top_k, doc_id, include_values):
+    """The cases' vectors still in the default namespace; those without case_id belong to DEFAULT_CASE_ID, as in migrate."""
+    case_ids = set(case_ids)
+    clauses = [{'doc_id': doc_id}] if doc_id else []
+    if DEFAULT_CASE_ID not in case_ids:
+        # Vectors without case_id can only belong to the default case, so the filter can be exact
+        clauses.append({'case_id': {'$in': sorted(case_ids)}})
+    results = store_for(index_name).query(
+        vector=vector, top_k=top_k, namespace=SHARED_NAMESPACE,
+        filter=(clauses[0] if len(clauses) == 1 else {'$and': clauses}) if clauses else None,
+        include_values=include_values, include_metadata=True
+    )
+    return [match for match in results['matches'] if (match['metadata'].get('case_id') or DEFAULT_CASE_ID) in case_ids]
+
+
+def best_matches(matches, top_k):
+    # Distances rank ascending, similarities descending; a vector caught mid-migration counts once
+    pick = heapq.nsmallest if VECTOR_METRIC == 'euclidean' else heapq.nlargest
+    by_id = {}
+    for match in pick(len(matches), matches, key=lambda match: match['score']):
+        by_id.setdefault(match['id'], match)
+    return list(by_id.values())[:top_k]
+
+
+def query(vector, case_ids, top_k, doc_id=None, include_values=False):
+    """
+    Top-k matches for `vector` across the given cases (optionally one document), best first.
+    Each match is a plain dict with id, score, metadata, values and namespace.
+    """
+    by_index = {}
+    for case_id in dict.fromkeys(case_ids):
+        by_index.setdefault(index_name_for(case_id), []).append(case_id)
+    searches = [(query_index, index_name, cases) for index_name, cases in by_index.items()]
+    # Vectors from before per-case namespaces and routing all live in PINECONE_INDEX
+    if legacy_namespace_in_use(clients.PINECONE_INDEX):
+        searches.append((query_legacy_namespace, clients.PINECONE_INDEX, list(dict.fromkeys(case_ids))))
+    if len(searches) == 1:
+        search, index_name, cases = searches[0]
+        return search(index_name, cases, vector, top_k, doc_id, include_values)
+    futures = [
+        _route_pool.submit(search, index_name, cases, vector, top_k, doc_id, include_values)
+        for search, index_name, cases in searches
+    ]
+    return best_matches([match for future in futures for match in future.result()], top_k)
+
+
+def migrate_shared_namespace(index_name=None):
+    """
+    Moves vectors written before per-case namespaces from the default namespace of
+    `index_name` (default PINECONE_INDEX) into their case's index and namespace, by
+    their case_id metadata. Safe to re-run; returns the number of vectors moved.
+    """
+    source = store_for(index_name or clients.PINECONE_INDEX)
+    moved = 0
+    while True:
+        # Always the first page: the previous one has been deleted
+        ids = next(iter(source.list(namespace=SHARED_NAMESPACE, limit=MIGRATE_BATCH_SIZE)), [])
+        if not ids:
+            return moved
+        by_case = {}
+        for vector_id, vector in source.fetch(ids, SHARED_NAMESPACE).items():
+            metadata = vector['metadata']
+            case_id = metadata.get('case_id') or DEFAULT_CASE_ID
+            metadata['case_id'] = case_id
+            by_case.setdefault(case_id, []).append({'id': vector_id, 'values': vector['values'], 'metadata': metadata})
+        for case_id, vectors in by_case.items():
+            index_for(case_id).upsert(vectors, namespace_for(case_id))
+        source.delete(ids, SHARED_NAMESPACE)
+        _legacy.pop(index_name or clients.PINECONE_INDEX, None)
+        moved += len(ids)
+        print(f"DEBUG: Moved {moved} vectors out of the shared namespace")
+
+
+if __name__ == '__main__':
+    # One-off, after switching to per-case namespaces:
+    #   python -m common.vector_index migrate [index_name]
+    import sys
+    if sys.argv[1:2] != ['migrate'] or VECTOR_NAMESPACES == 'shared':
+        sys.exit("Usage: python -m common.vector_index migrate [index_name] (with VECTOR_NAMESPACES=case)")
+    print(f"Moved {migrate_shared_namespace(*sys.argv[2:3])} vectors")
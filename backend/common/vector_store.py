@@ -0,0 +1,180 @@
+import abc
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from common import clients
+
+# Where vectors live, per index name (see common/vector_index.py for the per-case routing):
+#   pinecone        the Pinecone index (default)
+#   local           common/local_vectors.py on LOCAL_VECTOR_DIR: offline development, tests, benchmarks
+#   pinecone+local  Pinecone, with every write mirrored to the local engine and queries answered
+#                   locally when Pinecone errors or takes longer than VECTOR_QUERY_TIMEOUT seconds
+#                   (LOCAL_VECTOR_DIR must then be storage the ingest and query processes share)
+VECTOR_STORE = os.environ.get('VECTOR_STORE', 'pinecone')  # pinecone | local | pinecone+local
+VECTOR_QUERY_TIMEOUT = float(os.environ.get('VECTOR_QUERY_TIMEOUT', '2'))
+
+_fallback_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('VECTOR_FALLBACK_WORKERS', '4')))
+
+
+def plain_match(match, namespace):
+    """A query match as a plain, JSON-serializable dict."""
+    return {
+        'id': match['id'],
+        'score': float(match['score']),
+        'metadata': dict(match.get('metadata') or {}),
+        'values': list(match.get('values') or []),
+        'namespace': match.get('namespace') or namespace
+    }
+
+
+class VectorStore(abc.ABC):
+    """
+    The slice of the Pinecone Index API the pipeline uses. Vectors are
+    {'id', 'values', 'metadata'} dicts; query results are {'matches': [plain_match dicts]},
+    best first. Filters are Pinecone filter dicts (the local engine supports doc_id and
+    case_id with $eq / $in / $and).
+    """
+
+    @abc.abstractmethod
+    def upsert(self, vectors, namespace=''):
+        """Writes vectors, replacing any with the same id."""
+
+    @abc.abstractmethod
+    def delete(self, ids, namespace=''):
+        """Removes the given ids; missing ones are ignored."""
+
+    @abc.abstractmethod
+    def update(self, vector_id, set_metadata, namespace=''):
+        """Merges set_metadata into one vector's metadata, leaving its values alone."""
+
+    @abc.abstractmethod
+    def list(self, prefix=None, namespace='', limit=None):
+        """Yields pages (lists) of vector ids."""
+
+    @abc.abstractmethod
+    def fetch(self, ids, namespace=''):
+        """Returns {id: {'values', 'metadata'}} for the ids that exist."""
+
+    @abc.abstractmethod
+    def query(self, vector, top_k, namespace='', filter=None, include_values=False, include_metadata=True):
+        """Top-k matches in one namespace, best first."""
+
+    def query_namespaces(self, vector, namespaces, metric, top_k, filter=None, include_values=False,
+                         include_metadata=True):
+        """Top-k over several namespaces, merged by score."""
+        matches = [
+            match for namespace in namespaces
+            for match in self.query(vector, top_k, namespace, filter, include_values, include_metadata)['matches']
+        ]
+        if metric == 'euclidean':
+            return {'matches': heapq.nsmallest(top_k, matches, key=lambda match: match['score'])}
+        return {'matches': heapq.nlargest(top_k, matches, key=lambda match: match['score'])}
+
+
+class PineconeVectorStore(VectorStore):
+    def __init__(self, index_name):
+        self.index = clients.pinecone_index(index_name)
+
+    def upsert(self, vectors, namespace=''):
+        self.index.upsert(vectors=vectors, namespace=namespace)
+
+    def delete(self, ids, namespace=''):
+        self.index.delete(ids=ids, namespace=namespace)
+
+    def update(self, vector_id, set_metadata, namespace=''):
+        self.index.update(id=vector_id, set_metadata=set_metadata, namespace=namespace)
+
+    def list(self, prefix=None, namespace='', limit=None):
+        options = {'namespace': namespace}
+        if prefix:
+            options['prefix'] = prefix
+        if limit:
+            options['limit'] = limit
+        return self.index.list(**options)
+
+    def fetch(self, ids, namespace=''):
+        vectors = self.index.fetch(ids=ids, namespace=namespace).vectors
+        return {vid: {'values': list(v.values), 'metadata': dict(v.metadata or {})} for vid, v in vectors.items()}
+
+    def query(self, vector, top_k, namespace='', filter=None, include_values=False, include_metadata=True):
+        results = self.index.query(
+            vector=vector, top_k=top_k, namespace=namespace, filter=filter,
+            include_values=include_values, include_metadata=include_metadata
+        )
+        return {'matches': [plain_match(match, namespace) for match in results['matches']]}
+
+    def query_namespaces(self, vector, namespaces, metric, top_k, filter=None, include_values=False,
+                         include_metadata=True):
+        # The SDK runs the per-namespace queries concurrently and merges them
+        results = self.index.query_namespaces(
+            vector=vector, namespaces=namespaces, metric=metric, top_k=top_k, filter=filter,
+            include_values=include_values, include_metadata=include_metadata
+        )
+        return {'matches': [plain_match(match, '') for match in results['matches']]}
+
+
+class FallbackVectorStore(VectorStore):
+    """Writes go to both stores; reads come from the primary unless it fails or is too slow."""
+
+    def __init__(self, primary, fallback, timeout=VECTOR_QUERY_TIMEOUT):
+        self.primary = primary
+        self.fallback = fallback
+        self.timeout = timeout
+
+    def mirror(self, method, *args, **kwargs):
+        try:
+            getattr(self.fallback, method)(*args, **kwargs)
+        except Exception as e:
+            print(f"Local vector mirror {method} failed: {e}")
+
+    def upsert(self, vectors, namespace=''):
+        self.primary.upsert(vectors, namespace)
+        self.mirror('upsert', vectors, namespace)
+
+    def delete(self, ids, namespace=''):
+        self.primary.delete(ids, namespace)
+        self.mirror('delete', ids, namespace)
+
+    def update(self, vector_id, set_metadata, namespace=''):
+        self.primary.update(vector_id, set_metadata, namespace)
+        self.mirror('update', vector_id, set_metadata, namespace)
+
+    def list(self, prefix=None, namespace='', limit=None):
+        return self.primary.list(prefix, namespace, limit)
+
+    def fetch(self, ids, namespace=''):
+        return self.primary.fetch(ids, namespace)
+
+    def read(self, method, *args):
+        future = _fallback_pool.submit(getattr(self.primary, method), *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except Exception as e:
+            print(f"Vector {method} fell back to the local store: {e.__class__.__name__} {e}")
+            return getattr(self.fallback, method)(*args)
+
+    def query(self, vector, top_k, namespace='', filter=None, include_values=False, include_metadata=True):
+        return self.read('query', vector, top_k, namespace, filter, include_values, include_metadata)
+
+    def query_namespaces(self, vector, namespaces, metric, top_k, filter=None, include_values=False,
+                         include_metadata=True):
+        return self.read('query_namespaces', vector, namespaces, metric, top_k, filter, include_values,
+                         include_metadata)
+
+
+def build_vector_store(index_name, kind=VECTOR_STORE, metric='cosine'):
+    if kind == 'pinecone':
+        return PineconeVectorStore(index_name)
+    # numpy is only needed (and only packaged) where the local engine is used
+    from common.local_vectors import LocalVectorStore
+    if kind == 'local':
+        return LocalVectorStore(index_name, metric=metric)
+    if kind == 'pinecone+local':
+        return FallbackVectorStore(PineconeVectorStore(index_name), LocalVectorStore(index_name, metric=metric))
+    raise ValueError(f"Unknown VECTOR_STORE: {kind}")
+
+
+def get_vector_store(index_name, metric='cosine'):
+    """The process-wide store for `index_name`, built on first use."""
+    return clients.lazy(f"vector_store:{index_name}", lambda: build_vector_store(index_name, metric=metric))
@@ -1,28 +1,27 @@
 import json
 import os
-import boto3
 import urllib.parse
+import uuid
 import datetime
-import hashlib
-from pinecone import Pinecone
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from pypdf import PdfReader
+from botocore.exceptions import ClientError
+from common import audit, clients
+from common.audit_archive import compact as compact_audit_log
+from common.ingestion import case_id_for_key, commit_pending_manifest, index_document, upsert_chunks
+from common.jobs import drain, get_queue, handle_sqs_event
+from common.prompts import input_budget, truncate_to_tokens
+from common.risk import analyze_document_risk, request_risk_analysis
+from common.vector_index import DEFAULT_CASE_ID, index_for
 
-s3 = boto3.client('s3')
-bedrock = boto3.client('bedrock-runtime')
-dynamodb = boto3.resource('dynamodb')
 # textract = boto3.client('textract') # Removing Textract due to subscription issue
-audit_table = dynamodb.Table('CaseChat_Audit')
-
 TABLE_NAME = os.environ.get('TABLE_NAME')
-PINECONE_API_KEY = os.environ.get('PINECONE_API_KEY')
-PINECONE_INDEX = os.environ.get('PINECONE_INDEX', 'casechat-index')
+ENTITY_MODEL_ID = 'amazon.titan-text-express-v1'
+ENTITY_MAX_TOKENS = 512
 
-def get_pinecone_index():
-    pc = Pinecone(api_key=PINECONE_API_KEY)
-    return pc.Index(PINECONE_INDEX)
+def get_pinecone_index(case_id):
+    # Routed per case (see common/vector_index.py)
+    return index_for(case_id)
 
-def extract_entities(text_chunk):
+def format_entity_prompt(text_chunk):
     prompt = f"""
     Human: Extract the following entities from the text below:
     - Plaintiff (Name)
@@ -32,16 +31,20 @@ def extract_entities(text_chunk):
     
     Format the output as JSON only.
     
-    Text: {text_chunk[:2000]}
+    Text: {text_chunk}
     
     Assistant:
     """
+    return f"System: Extract entities as JSON.\n\n{prompt}"
+
+def extract_entities(text_chunk):
+    budget = input_budget(ENTITY_MODEL_ID, ENTITY_MAX_TOKENS, format_entity_prompt(""))
     
     # Titan Text Payload
     payload_titan = {
-        "inputText": f"System: Extract entities as JSON.\n\n{prompt}",
+        "inputText": format_entity_prompt(truncate_to_tokens(text_chunk, budget, ENTITY_MODEL_ID)),
         "textGenerationConfig": {
-            "maxTokenCount": 512,
+            "maxTokenCount": ENTITY_MAX_TOKENS,
             "stopSequences": [],
             "temperature": 0,
             "topP": 1
@@ -49,126 +52,191 @@ def extract_entities(text_chunk):
     }
     
     # Fallback to Titan Text Express (Available)
-    response = bedrock.invoke_model(
-        modelId='amazon.titan-text-express-v1',
+    response = clients.bedrock().invoke_model(
+        modelId=ENTITY_MODEL_ID,
         body=json.dumps(payload_titan)
     )
     
     response_body = json.loads(response.get('body').read())
     return response_body['results'][0]['outputText']
 
-def generate_embedding(text):
-    body = json.dumps({"inputText": text})
-    response = bedrock.invoke_model(
-        modelId='amazon.titan-embed-text-v1',
-        contentType='application/json',
-        accept='application/json',
-        body=body
-    )
-    response_body = json.loads(response.get('body').read())
-    return response_body['embedding']
-
 def log_audit_event(action, resource, details):
-    timestamp = datetime.datetime.utcnow().isoformat()
-    event_str = f"{timestamp}|system_ingest|{action}|{resource}|{details}"
-    event_hash = hashlib.sha256(event_str.encode()).hexdigest()
+    audit.log_event('system_ingest_bot', action, resource, details)
+
+EMBED_TASK_SIZE = int(os.environ.get('EMBED_TASK_SIZE', '25')) # chunks per embed task (~2KB each, SQS max 256KB)
+
+def ingest_document(bucket, key, case_id=DEFAULT_CASE_ID, queue=None):
+    """
+    Indexes one document. With a queue, changed chunks are fanned out as embed
+    tasks and the document stays 'Processing' until the last task completes.
+    """
+    log_audit_event("INGEST_START", key, "Started processing document")
+    
+    # 1. Stream + Extract + Chunk + Embed (pages are read with ranged S3 GETs, never downloaded whole)
+    index = get_pinecone_index(case_id) # Initialize Pinecone Index
+    embed_jobs = []
+    run_id = uuid.uuid4().hex[:12] # tasks of an earlier ingest of the same document don't count towards this one
+    
+    def embed_job(batch):
+        task_id = f"{run_id}-{len(embed_jobs)}"
+        return {'type': 'embed', 'case_id': case_id, 'doc_id': key, 'run_id': run_id, 'task_id': task_id, 'chunks': batch}
+    
+    def enqueue_embed_tasks(items):
+        batch = []
+        count = 0
+        for vector_id, chunk in items:
+            batch.append(dict(chunk, id=vector_id))
+            count += 1
+            if len(batch) >= EMBED_TASK_SIZE:
+                embed_jobs.append(embed_job(batch))
+                batch = []
+        if batch:
+            embed_jobs.append(embed_job(batch))
+        return count
+    
+    summary = index_document(
+        index, bucket, key, case_id=case_id, head_chars=2000,
+        dispatch=enqueue_embed_tasks if queue is not None else None
+    )
+    if summary is None:
+        print(f"Skipping unsupported file: {key}")
+        return None
+    
+    # 2. Entity Extraction (GenAI) - SKIP for now to unblock vectors
+    # entities_json = extract_entities(summary['head'])
+    entities_json = "{}"
     
-    audit_table.put_item(Item={
-        'log_id': event_hash,
-        'case_id': 'system_global',
+    # 3. Save Metadata to DynamoDB (before the embed tasks exist, so their countdown has a target)
+    table = clients.table(TABLE_NAME)
+    timestamp = datetime.datetime.utcnow().isoformat()
+    table.put_item(Item={
+        'case_id': case_id,
+        'doc_id': key,
         'timestamp': timestamp,
-        'user_id': 'system_ingest_bot',
-        'action': action,
-        'resource': resource,
-        'details': details,
-        'hash': event_hash
+        'updated_at': timestamp, # Sort key of the listing index (see GET /documents)
+        'status': 'Processing' if embed_jobs else 'Indexed',
+        'pending_tasks': len(embed_jobs),
+        'ingest_run': run_id,
+        'risk_status': 'Pending',
+        'text_preview': summary['head'][:100],
+        'extracted_entities': entities_json
     })
+    if embed_jobs:
+        queue.send_many(embed_jobs)
+        print(f"DEBUG: Enqueued {len(embed_jobs)} embed tasks for {key}")
+    else:
+        request_risk_analysis(case_id, key, queue)
+    return summary
 
+def complete_embed_task(case_id, doc_id, run_id, task_id):
+    table = clients.table(TABLE_NAME)
+    # SQS delivers at least once: a task is only counted once, and only for the ingest that queued it
+    update = {
+        'UpdateExpression': 'ADD pending_tasks :minus_one, done_tasks :task',
+        'ConditionExpression': 'ingest_run = :run AND NOT contains(done_tasks, :task_id)',
+        'ExpressionAttributeValues': {':minus_one': -1, ':task': {task_id}, ':task_id': task_id, ':run': run_id}
+    }
+    if task_id is None:
+        # Queued before tasks carried IDs
+        update = {'UpdateExpression': 'ADD pending_tasks :minus_one', 'ExpressionAttributeValues': {':minus_one': -1}}
+    try:
+        response = table.update_item(Key={'case_id': case_id, 'doc_id': doc_id}, ReturnValues='UPDATED_NEW', **update)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+        # A redelivered last task whose first attempt failed after the countdown reached zero
+        # finishes the ingest; anything else was already counted or belongs to a superseded run
+        item = table.get_item(Key={'case_id': case_id, 'doc_id': doc_id}, ConsistentRead=True).get('Item') or {}
+        if item.get('ingest_run') != run_id or item.get('pending_tasks', 1) > 0 or item.get('status') == 'Indexed':
+            print(f"DEBUG: Embed task {task_id} for {doc_id} already counted or superseded")
+            return
+    else:
+        if response['Attributes'].get('pending_tasks', 0) > 0:
+            return
+    finish_ingest(case_id, doc_id)
+
+def finish_ingest(case_id, doc_id):
+    """
+    Tail of a queued ingest. Every step is safe to repeat, and 'Indexed' is written last, so an
+    attempt that fails part-way is completed by the task's redelivery.
+    """
+    # Deletes the vectors of chunks that are gone and retires cached answers
+    commit_pending_manifest(get_pinecone_index(case_id), doc_id, case_id)
+    request_risk_analysis(case_id, doc_id, get_queue())
+    log_audit_event("INGEST_COMPLETE", doc_id, "All embed tasks finished")
+    clients.table(TABLE_NAME).update_item(
+        Key={'case_id': case_id, 'doc_id': doc_id},
+        UpdateExpression='SET #status = :indexed, updated_at = :now',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':indexed': 'Indexed', ':now': datetime.datetime.utcnow().isoformat()}
+    )
+
+def process_job(job):
+    if job['type'] == 'document':
+        ingest_document(job['bucket'], job['key'], job.get('case_id', DEFAULT_CASE_ID), queue=get_queue())
+    elif job['type'] == 'embed':
+        items = [(chunk['id'], chunk) for chunk in job['chunks']]
+        upsert_chunks(get_pinecone_index(job['case_id']), job['doc_id'], job['case_id'], items)
+        complete_embed_task(job['case_id'], job['doc_id'], job.get('run_id'), job.get('task_id'))
+    elif job['type'] == 'risk':
+        if analyze_document_risk(job['case_id'], job['doc_id']) is None:
+            # Out of time: finished batches are checkpointed, a fresh job picks up the rest
+            get_queue().send_many([job])
+        else:
+            log_audit_event("RISK_ANALYSIS_COMPLETE", job['doc_id'], "Full-document risk scan finished")
+    elif job['type'] == 'audit_compact':
+        # Daily, from the EventBridge schedule (aws_cloudwatch_event_rule.audit_compact)
+        moved = compact_audit_log()
+        if moved is None:
+            get_queue().send_many([job])
+        elif moved:
+            log_audit_event("AUDIT_ARCHIVED", "audit_log", f"Moved {moved} closed-day records to the archive")
+    else:
+        raise ValueError(f"Unknown ingest job type: {job['type']}")
+
+@audit.flushes
 def handler(event, context):
     print("VERSION: CHUNKING_V2")
     print("Received event: " + json.dumps(event))
     
-    # Get the object from the event
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-    
     try:
-        log_audit_event("INGEST_START", key, "Started processing document")
-        
-        # 1. Download File (In real prod, stream it or use Textract S3 direct)
-        file_path = f"/tmp/{key.split('/')[-1]}"
-        s3.download_file(bucket, key, file_path)
-        
-        # 2. Extract Text (Switched to pypdf for reliability/cost)
-        # 2. Extract Text
-        full_text = ""
-        if key.lower().endswith('.pdf'):
-            with open(file_path, 'rb') as f:
-                reader = PdfReader(f)
-                for page in reader.pages:
-                    text = page.extract_text()
-                    if text:
-                        safe_text = text.encode('ascii', 'ignore').decode('ascii')
-                        full_text += safe_text + "\n"
-        elif key.lower().endswith('.txt'):
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                full_text = f.read()
-        else:
-            print(f"Skipping unsupported file: {key}")
-            return "Skipped"
-        
-        print(f"DEBUG: Extracted {len(full_text)} chars using PyPDF (Sanitized)")
-        
-        # 3. Entity Extraction (GenAI) - SKIP for now to unblock vectors
-        # entities_json = extract_entities(full_text)
-        entities_json = "{}"
-        
-        # 4. Save Metadata to DynamoDB
-        table = dynamodb.Table(TABLE_NAME)
-        table.put_item(Item={
-            'case_id': 'default-case', # Placeholder
-            'doc_id': key,
-            'timestamp': datetime.datetime.utcnow().isoformat(),
-            'status': 'Indexed',
-            'text_preview': full_text[:100],
-            'extracted_entities': entities_json
-        })
-        
-        # 5. Vectors (Chunking)
-        index = get_pinecone_index() # Initialize Pinecone Index
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=2000,
-            chunk_overlap=200
-        )
-        chunks = text_splitter.split_text(full_text)
-        print(f"DEBUG: Split into {len(chunks)} chunks")
-        
-        vectors_to_upsert = []
-        for i, chunk in enumerate(chunks):
-            embedding = generate_embedding(chunk)
-            vector_id = f"{key}#{i}"
-            vectors_to_upsert.append({
-                'id': vector_id,
-                'values': embedding,
-                'metadata': {
-                    'text': chunk,
-                    'case_id': 'default-case',
-                    'doc_id': key
-                }
+        # Get the objects from the event
+        documents = []
+        for record in event['Records']:
+            key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+            documents.append({
+                'type': 'document',
+                'bucket': record['s3']['bucket']['name'],
+                'key': key,
+                'case_id': case_id_for_key(key)
             })
-            
-            # Batch upsert every 100 chunks
-            if len(vectors_to_upsert) >= 100:
-                index.upsert(vectors=vectors_to_upsert)
-                vectors_to_upsert = []
-                
-        # Remainder
-        if vectors_to_upsert:
-            index.upsert(vectors=vectors_to_upsert)
         
-        return "Success"
+        # With an ingest queue configured the S3 event only enqueues; workers do the heavy lifting
+        queue = get_queue()
+        if queue is not None:
+            queue.send_many(documents)
+            for job in documents:
+                log_audit_event("INGEST_QUEUED", job['key'], "Queued for processing")
+            return "Queued"
+        
+        results = [ingest_document(job['bucket'], job['key'], job['case_id']) for job in documents]
+        return "Success" if any(results) else "Skipped"
         
     except Exception as e:
         print(e)
         raise e
+
+@audit.flushes
+def worker_handler(event, context):
+    # SQS-triggered worker (see aws_lambda_event_source_mapping.ingest_worker)
+    return handle_sqs_event(event, process_job)
+
+if __name__ == '__main__':
+    # Local run against the SQLite queue stand-in:
+    #   INGEST_QUEUE_PATH=/tmp/ingest_queue.sqlite3 python -m ingest.index <bucket> <key>
+    import sys
+    queue = get_queue()
+    if queue is None:
+        sys.exit("Set INGEST_QUEUE_PATH to run the local ingest worker")
+    queue.send_many([{'type': 'document', 'bucket': sys.argv[1], 'key': sys.argv[2], 'case_id': case_id_for_key(sys.argv[2])}])
+    print(f"Processed {drain(queue, process_job)} ingest jobs")
@@ -1,23 +1,24 @@
 import os
 import json
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from query.index import handler  # Import the Lambda handler
+from query.index import handler, stream_chat  # Import the Lambda handler
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for local development
+CORS(app, expose_headers=['ETag'])  # Enable CORS for local development
 
 # Helper to mimic Lambda Event
-def create_lambda_event(path, method, body=None, query_params=None):
+def create_lambda_event(path, method, body=None, query_params=None, headers=None):
     return {
         "rawPath": path,
         "path": path,
         "httpMethod": method,
+        "headers": headers or {},
         "queryStringParameters": query_params or {},
         "body": json.dumps(body) if body else None,
         "requestContext": {
@@ -33,7 +34,7 @@ def invoke_lambda(path):
     body = request.get_json(silent=True)
     query_params = request.args.to_dict()
 
-    event = create_lambda_event(path, method, body, query_params)
+    event = create_lambda_event(path, method, body, query_params, dict(request.headers))
     logger.info(f"Invoking Lambda for {method} {path}")
     
     response = handler(event, None)
@@ -41,6 +42,10 @@ def invoke_lambda(path):
     # Parse Lambda Response
     status_code = response.get('statusCode', 200)
     response_body = response.get('body', '{}')
+    # CORS is handled by flask_cors; pass through the rest (e.g. ETag for conditional GETs)
+    headers = {k: v for k, v in (response.get('headers') or {}).items() if not k.lower().startswith('access-control-')}
+    if status_code == 304:
+        return Response(status=304, headers=headers)
     
     try:
         # Try to parse JSON body
@@ -51,7 +56,7 @@ def invoke_lambda(path):
     except json.JSONDecodeError:
         response_data = response_body
         
-    return jsonify(response_data), status_code
+    return jsonify(response_data), status_code, headers
 
 @app.route('/upload-url', methods=['GET'])
 def upload_url():
@@ -65,6 +70,21 @@ def documents():
 def chat():
     return invoke_lambda('/chat')
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    # Streams Server-Sent Events as tokens are generated (the Lambda route buffers them)
+    body = request.get_json(silent=True) or {}
+    if not body.get('query'):
+        return jsonify("Missing query/body"), 400
+    logger.info("Streaming POST /chat/stream")
+    case_ids = body.get('caseIds') or ([body['caseId']] if body.get('caseId') else None)
+    events = stream_chat(body['query'], body.get('docId'), body.get('sessionId', 'default-session'), case_ids=case_ids)
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/audit', methods=['GET'])
 def audit():
     return invoke_lambda('/audit')
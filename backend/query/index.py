@@ -1,80 +1,60 @@
+import base64
 import json
 # FORCE_UPDATE_Fix_Syntax_V5_LexGuard_Resync
 import os
-import boto3
 import datetime
 import hashlib
-from pinecone import Pinecone
+import time
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+from common import audit, clients
+from common.answer_cache import get_answer_cache
+from common.artifacts import ARTIFACT_PREFIX
+from common.chunk_store import get_chunk_store
+from common.embeddings import embed_query
+from common.history import load_history, save_history
+from common.ingestion import case_id_for_key, document_name, index_document, upload_key
+from common.jobs import get_queue
+from common.lexical import reciprocal_rank_fusion, search as lexical_search
+from common.offsets import locate_chunk
+from common.risk import request_risk_analysis
+from common.vector_index import DEFAULT_CASE_ID, index_for, query as query_vectors
+from common.prompts import chunk_tokens, fit_history, input_budget
+from query.rerank import build_context
 
-bedrock = boto3.client('bedrock-runtime')
-dynamodb = boto3.resource('dynamodb')
-audit_table = dynamodb.Table('CaseChat_Audit')
-history_table = dynamodb.Table('CaseChat_History')
-s3_client = boto3.client('s3')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
+ANSWER_MODEL_ID = os.environ.get('ANSWER_MODEL_ID', 'meta.llama3-8b-instruct-v1:0')
+ANSWER_MAX_TOKENS = 1024
+HISTORY_TOKEN_SHARE = float(os.environ.get('HISTORY_TOKEN_SHARE', '0.2'))
+ANSWER_ERROR_MESSAGE = "I encountered an error generating the response. Please try again."
+# Mock user identity for MVP (In prod, get from event.requestContext.authorizer)
+DEFAULT_USER_ID = "alice@firm.com"
 
-PINECONE_API_KEY = os.environ.get('PINECONE_API_KEY')
-PINECONE_INDEX = os.environ.get('PINECONE_INDEX', 'casechat-index')
+# Vector and BM25 candidates are fused with reciprocal-rank fusion down to SEARCH_TOP_K
+SEARCH_TOP_K = int(os.environ.get('SEARCH_TOP_K', '10'))
 
-def get_pinecone_index():
-    pc = Pinecone(api_key=PINECONE_API_KEY)
-    return pc.Index(PINECONE_INDEX)
+# GET /documents pages through the metadata table's case_id + updated_at index, newest first
+DOCUMENTS_INDEX = os.environ.get('DOCUMENTS_INDEX', 'case_id-updated_at-index')
+DOCUMENTS_PAGE_SIZE = int(os.environ.get('DOCUMENTS_PAGE_SIZE', '50'))
+DOCUMENTS_MAX_PAGE_SIZE = 200
+CASE_DOCS_TTL = int(os.environ.get('CASE_DOCS_TTL', '60'))  # seconds a case's doc list is reused for BM25
+_case_docs = {}
 
-def load_history(session_id):
-    if not session_id:
-        return []
-    try:
-        response = history_table.query(
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('session_id').eq(session_id),
-            Limit=10, # Last 5 exchanges
-            ScanIndexForward=False # Get latest first, but we will reverse it for prompt
-        )
-        items = response.get('Items', [])
-        # Sort properly by timestamp ascending for context window
-        items.sort(key=lambda x: x['timestamp'])
-        return items
-    except Exception as e:
-        print(f"Error loading history: {e}")
-        return []
+# Independent chat stages (history load, query embedding, index lookup) overlap on this pool
+chat_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('CHAT_WORKERS', '4')))
 
-def save_history(session_id, user_msg, assistant_msg):
-    if not session_id:
-        return
-    timestamp = datetime.datetime.utcnow().isoformat()
-    try:
-        # Save User Message
-        history_table.put_item(Item={
-            'session_id': session_id,
-            'timestamp': f"{timestamp}#USER",
-            'role': 'user',
-            'content': user_msg
-        })
-        # Save Assistant Message
-        history_table.put_item(Item={
-            'session_id': session_id,
-            'timestamp': f"{timestamp}#AI", # Ensure unique sort key even if fast
-            'role': 'assistant',
-            'content': assistant_msg
-        })
-    except Exception as e:
-        print(f"Error saving history: {e}")
-
-def generate_embedding(text):
-    body = json.dumps({"inputText": text})
-    response = bedrock.invoke_model(
-        modelId='amazon.titan-embed-text-v1',
-        contentType='application/json',
-        accept='application/json',
-        body=body
-    )
-    response_body = json.loads(response.get('body').read())
-    return response_body['embedding']
+def get_pinecone_index(case_id):
+    # Routed per case (see common/vector_index.py)
+    return index_for(case_id)
 
-def get_answer_from_bedrock(query, context, history=[], model_id='anthropic.claude-3-5-sonnet-20240620-v1:0'):
+def format_answer_prompt(query, context, history=[]):
     # Format history string
     history_str = ""
     for msg in history:
-        history_str += f"{msg['role'].upper()}: {msg['content']}\n"
+        if msg['role'] == 'summary':
+            history_str += f"(Summary of earlier conversation) {msg['content']}\n"
+        else:
+            history_str += f"{msg['role'].upper()}: {msg['content']}\n"
     
     prompt = f"""
     Instruction: You are an expert legal researcher. 
@@ -95,30 +75,46 @@ def get_answer_from_bedrock(query, context, history=[], model_id='anthropic.clau
     Answer:
     """
     
-    # Use Meta Llama 3 8B Instruct - Smarter & Less Restrictive
-    try:
-        print(f"Generating answer with Meta Llama 3...")
-        
-        # Format prompt with special tokens for Llama 3 Instruct if needed, 
-        # but raw text often works. Let's wrap in standard Llama 3 instruct format headers if possible,
-        # or just pass the instruction block.
-        # Llama 3 Instruct Format: <|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n
-        
-        formatted_prompt = f"""<|begin_of_text|><|start_header_id|>user<|end_header_id|>
+    # Format prompt with special tokens for Llama 3 Instruct if needed, 
+    # but raw text often works. Let's wrap in standard Llama 3 instruct format headers if possible,
+    # or just pass the instruction block.
+    # Llama 3 Instruct Format: <|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n
+    
+    formatted_prompt = f"""<|begin_of_text|><|start_header_id|>user<|end_header_id|>
 
 {prompt}
 <|eot_id|><|start_header_id|>assistant<|end_header_id|>
 """
+    return formatted_prompt
 
-        payload_llama = {
-            "prompt": formatted_prompt,
-            "max_gen_len": 1024,
-            "temperature": 0.1,
-            "top_p": 0.9
-        }
+def plan_answer_prompt(query, history):
+    """
+    Splits the answer model's input window: the template and question are fixed, history gets
+    at most HISTORY_TOKEN_SHARE of the rest (most recent whole messages) and context gets what remains.
+    Returns (history, context_token_budget).
+    """
+    available = input_budget(ANSWER_MODEL_ID, ANSWER_MAX_TOKENS, format_answer_prompt("", "", []), query)
+    history, history_tokens = fit_history(history, int(available * HISTORY_TOKEN_SHARE), ANSWER_MODEL_ID)
+    return history, available - history_tokens
+
+def build_answer_payload(query, context, history=[]):
+    formatted_prompt = format_answer_prompt(query, context, history)
+    return {
+        "prompt": formatted_prompt,
+        "max_gen_len": ANSWER_MAX_TOKENS,
+        "temperature": 0.1,
+        "top_p": 0.9
+    }
+
+def get_answer_from_bedrock(query, context, history=[], model_id='anthropic.claude-3-5-sonnet-20240620-v1:0'):
+    # Use Meta Llama 3 8B Instruct - Smarter & Less Restrictive
+    try:
+        print(f"Generating answer with Meta Llama 3...")
+        
+        payload_llama = build_answer_payload(query, context, history)
         
-        response = bedrock.invoke_model(
-            modelId='meta.llama3-8b-instruct-v1:0',
+        response = clients.bedrock().invoke_model(
+            modelId=ANSWER_MODEL_ID,
             contentType='application/json',
             accept='application/json',
             body=json.dumps(payload_llama)
@@ -129,103 +125,321 @@ def get_answer_from_bedrock(query, context, history=[], model_id='anthropic.clau
         
     except Exception as e:
         print(f"Titan Generation Failed: {e}")
-        return "I encountered an error generating the response. Please try again."
+        return ANSWER_ERROR_MESSAGE
+
+def stream_answer_from_bedrock(query, context, history=[]):
+    """Yields the answer as text deltas as Llama 3 generates them."""
+    produced = False
+    try:
+        print(f"Streaming answer with Meta Llama 3...")
+        response = clients.bedrock().invoke_model_with_response_stream(
+            modelId=ANSWER_MODEL_ID,
+            contentType='application/json',
+            accept='application/json',
+            body=json.dumps(build_answer_payload(query, context, history))
+        )
+        for event in response.get('body'):
+            chunk = event.get('chunk')
+            if not chunk:
+                continue
+            delta = json.loads(chunk['bytes']).get('generation')
+            if delta:
+                produced = True
+                yield delta
+    except Exception as e:
+        print(f"Streaming Generation Failed: {e}")
+        if produced:
+            raise  # part of the answer is out already; the caller reports the failure (see stream_chat)
+        yield ANSWER_ERROR_MESSAGE
 
 # ... content omitted ...
 
 
 
 def log_audit_event(user_id, action, resource, details):
-    timestamp = datetime.datetime.utcnow().isoformat()
-    # Create a cryptographic hash of the event for immutability
-    event_str = f"{timestamp}|{user_id}|{action}|{resource}|{details}"
-    event_hash = hashlib.sha256(event_str.encode()).hexdigest()
+    # Hash-chained and buffered; written in one batch at the end of the invocation (see common/audit.py)
+    audit.log_event(user_id, action, resource, details)
+
+def retrieve_context(query, selected_doc_id, session_id, user_id, case_ids, vector_future=None):
+    """
+    Retrieval half of /chat, shared by the buffered and streaming paths, over the
+    vectors and documents of `case_ids`. Pass the query's embedding future if the
+    answer-cache check already started it. Returns (hits, context_text, history).
+    """
+    # History, query embedding, the index handles and the BM25 lookup don't depend on each other
+    history_future = chat_pool.submit(load_history, session_id)
+    vector_future = vector_future or chat_pool.submit(embed_query, query)
+    index_future = chat_pool.submit(lambda: [get_pinecone_index(case_id) for case_id in case_ids])
+    lexical_future = chat_pool.submit(search_lexical, query, selected_doc_id, case_ids)
+
+    # AUDIT LOG: SEARCH_INIT (queued, not awaited)
+    log_audit_event(user_id, "SEARCH_QUERY", "vector_store", f"Query length: {len(query)}")
+    
+    # 1. Embed Query
+    query_vector = vector_future.result()
+    
+    # 2. Search Pinecone: the cases' namespaces, merged by score when there are several
+    index_future.result()
+    matches = query_vectors(
+        query_vector, case_ids, SEARCH_TOP_K,
+        doc_id=selected_doc_id,
+        include_values=True # reused by the rerank stage for MMR / near-duplicate checks
+    )
+    vector_hits = [
+        {'id': match['id'], 'score': match['score'], 'metadata': match['metadata'], 'values': match['values']}
+        for match in matches
+    ]
+    
+    hits = fuse_hits(vector_hits, lexical_future.result())
+    
+    # Chunk text lives in the chunk store; vectors indexed before it still carry metadata['text']
+    chunks = get_chunk_store().get_chunks([hit['id'] for hit in hits])
+    for hit in hits:
+        if hit['id'] in chunks:
+            hit['metadata']['text'] = chunks[hit['id']]['text']
+            hit['tokens'] = chunk_tokens(chunks[hit['id']], ANSWER_MODEL_ID)
+    
+    # Whatever the template, question and history leave of the window goes to context
+    history, context_budget = plan_answer_prompt(query, history_future.result())
     
+    # Dedupe, MMR, merge adjacent chunks and pack into the context token budget (query/rerank.py)
+    context_text, hits = build_context(hits, context_budget, ANSWER_MODEL_ID)
+    for hit in hits:
+        hit.pop('values', None)
+        hit.pop('tokens', None)
+    
+    print(f"DEBUG: Retrieved {len(context_text)} chars of context ({context_budget} token budget)")
+    
+    return hits, context_text, history
+
+def case_document_ids(case_ids):
+    """Doc IDs of the given cases from the metadata table, each case's list reused for CASE_DOCS_TTL seconds."""
+    md_table = clients.table(os.environ.get('TABLE_NAME', 'CaseChat_Metadata'))
+    doc_ids = []
+    for case_id in case_ids:
+        cached = _case_docs.get(case_id)
+        if cached is None or cached[0] < time.time() - CASE_DOCS_TTL:
+            kwargs = {'KeyConditionExpression': Key('case_id').eq(case_id), 'ProjectionExpression': 'doc_id'}
+            ids = []
+            while True:
+                response = md_table.query(**kwargs)
+                ids.extend(item['doc_id'] for item in response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            cached = _case_docs[case_id] = (time.time(), ids)
+        doc_ids.extend(cached[1])
+    return doc_ids
+
+def search_lexical(query, selected_doc_id, case_ids):
+    # Exact legal terms that embeddings blur ("indemnify", clause numbers) are caught here,
+    # over the same cases the vector search covers
     try:
-        audit_table.put_item(Item={
-            'case_id': 'system_global', # Partition key, could be specific case
-            'timestamp': timestamp,
-            'user_id': user_id,
-            'action': action,
-            'resource': resource,
-            'details': details,
-            'hash': event_hash
-        })
+        doc_ids = [selected_doc_id] if selected_doc_id else case_document_ids(case_ids)
+        return lexical_search(query, doc_ids) if doc_ids else []
     except Exception as e:
-        print(f"AUDIT FAILURE: {e}")
+        print(f"Lexical search failed: {e}")
+        return []
+
+def lexical_metadata(vector_id):
+    # Hits found only by BM25 get the same metadata fields the vectors carry, from the offset index
+    doc_id = vector_id.rpartition('#')[0]
+    metadata = {'doc_id': doc_id, 'source': doc_id}
+    location = locate_chunk(vector_id)
+    if location:
+        metadata.update({
+            'page_start': location['page_start'],
+            'page_end': location['page_end'],
+            'char_offset': location['char_offset']
+        })
+    return metadata
 
-def analyze_risk_scan(text):
+def fuse_hits(vector_hits, lexical_hits):
     """
-    Scans the document text for high-risk legal clauses using Llama 3.
-    Returns a dict: { 'score': 'High'|'Medium'|'Low', 'flags': ['Flag 1', 'Flag 2'] }
+    Reciprocal-rank fusion of the Pinecone and BM25 rankings, cut back to SEARCH_TOP_K.
+    `score` becomes the fused score relative to the best hit; the cosine stays in `vector_score`.
     """
+    by_id = {hit['id']: hit for hit in vector_hits}
+    fused = reciprocal_rank_fusion([[hit['id'] for hit in vector_hits], [vid for vid, _ in lexical_hits]])
+    fused = fused[:SEARCH_TOP_K]
+    lexical_ids = {vid for vid, _ in lexical_hits}
+    hits = []
+    for vector_id, score in fused:
+        hit = by_id.get(vector_id)
+        if hit is None:
+            hit = {'id': vector_id, 'metadata': lexical_metadata(vector_id)}
+        else:
+            hit['vector_score'] = hit['score']
+        hit['score'] = score / fused[0][1]
+        hit['match'] = 'both' if vector_id in by_id and vector_id in lexical_ids else ('vector' if vector_id in by_id else 'lexical')
+        hits.append(hit)
+    print(f"DEBUG: Fused {len(vector_hits)} vector + {len(lexical_hits)} lexical candidates into {len(hits)} hits")
+    return hits
+
+def check_answer_cache(selected_doc_id, case_ids, vector_future):
+    """Returns (cached, version): a semantically equivalent earlier answer in the same case and doc scope, or None."""
+    answer_cache = get_answer_cache()
+    # Questions spanning several cases aren't cached: no single case's ingestion could retire them
+    if answer_cache is None or len(case_ids) != 1:
+        return None, None
+    # The scope's entries are read while the query is still being embedded on chat_pool;
+    # retrieval reuses the same future on a miss
+    version, entries = answer_cache.candidates(selected_doc_id, case_ids[0])
+    cached, version = answer_cache.match(vector_future.result(), version, entries)
+    if cached:
+        print(f"DEBUG: Answer cache hit (similarity {cached['similarity']:.3f}) for: {cached['query'][:50]}")
+    return cached, version
+
+def remember_answer(query, selected_doc_id, answer, hits, version, case_ids, vector_future):
+    answer_cache = get_answer_cache()
+    if answer_cache is None or len(case_ids) != 1 or not answer or answer == ANSWER_ERROR_MESSAGE:
+        return
+    answer_cache.store(selected_doc_id, vector_future.result(), query, answer, hits, version, case_ids[0])
+
+def finish_chat(user_id, session_id, query, answer, cached=None):
+    # Save History (background)
+    save_history(session_id, query, answer)
+
+    # 4. Log to Audit (background)
+    if cached:
+        log_audit_event(user_id, "SEARCH_QUERY_CACHE_HIT", "answer_cache",
+                        f"Query: {query[:50]}... (similarity {cached['similarity']:.3f})")
+    else:
+        log_audit_event(user_id, "SEARCH_QUERY", "query_engine", f"Query: {query[:50]}...")
+
+def sse_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def stream_chat(query, selected_doc_id=None, session_id='default-session', user_id=DEFAULT_USER_ID, case_ids=None):
+    """
+    Server-Sent Events for one chat turn: a `sources` event as soon as retrieval is done,
+    one `token` event per generated delta, then `done` with timings. History and the
+    audit event are written once the answer is complete. If retrieval or generation fails
+    part-way the stream ends with an `error` event instead, and the partial answer is not kept.
+    """
+    started = time.time()
+    case_ids = case_ids or [DEFAULT_CASE_ID]
+    vector_future = chat_pool.submit(embed_query, query)
+    cached, cache_version = check_answer_cache(selected_doc_id, case_ids, vector_future)
+    if cached:
+        yield sse_event('sources', {'sources': cached['sources'], 'sessionId': session_id})
+        yield sse_event('token', {'text': cached['answer']})
+        finish_chat(user_id, session_id, query, cached['answer'], cached=cached)
+        total_ms = int((time.time() - started) * 1000)
+        yield sse_event('done', {'ttft_ms': total_ms, 'total_ms': total_ms, 'cached': True})
+        return
+    
+    parts = []
+    first_token_ms = None
     try:
-        print("DEBUG: Starting Risk Analysis Scan...")
-        prompt = f"""
-        Instruction: Act as a Senior Legal Risk Officer.
-        Analyze the following legal document text for critical risks.
-        Focus on:
-        1. Unlimited Liability (High Risk)
-        2. Missing Termination for Convenience (Medium Risk)
-        3. Unilateral Indemnification (High Risk)
-        4. Non-Compete Clauses > 2 Years (Medium Risk)
-        
-        Return ONLY a JSON object in this format:
-        {{
-            "score": "High" or "Medium" or "Low",
-            "flags": ["Brief description of risk 1", "Brief description of risk 2"]
-        }}
-        
-        Document Text (Truncated):
-        {text[:12000]}
-        
-        JSON Response:
-        """
-        
-        
-        # Llama 3 Instruct Format
-        formatted_prompt = f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+        hits, context_text, history = retrieve_context(query, selected_doc_id, session_id, user_id, case_ids, vector_future)
+        yield sse_event('sources', {'sources': hits, 'sessionId': session_id})
         
-        payload = {
-            "prompt": formatted_prompt,
-            "max_gen_len": 512,
-            "temperature": 0.1
-        }
-        
-        response = bedrock.invoke_model(
-            modelId='meta.llama3-8b-instruct-v1:0',
-            contentType='application/json',
-            accept='application/json',
-            body=json.dumps(payload)
-        )
-        
-        response_body = json.loads(response.get('body').read())
-        raw_completion = response_body['generation'].strip()
-        
-        # Simple JSON extraction
-        try:
-            start = raw_completion.find('{')
-            end = raw_completion.rfind('}') + 1
-            if start != -1 and end != -1:
-                json_str = raw_completion[start:end]
-                print(f"DEBUG: Parsed Risk JSON: {json_str}")
-                return json.loads(json_str)
-            else:
-                print("DEBUG: Could not find JSON in risk response")
-                return {"score": "Low", "flags": ["Analysis Inconclusive"]}
-        except:
-             return {"score": "Low", "flags": ["Analysis Parsing Error"]}
-             
+        for delta in stream_answer_from_bedrock(query, context_text, history):
+            if first_token_ms is None:
+                first_token_ms = int((time.time() - started) * 1000)
+                print(f"DEBUG: Time to first token: {first_token_ms} ms")
+            parts.append(delta)
+            yield sse_event('token', {'text': delta})
     except Exception as e:
-        print(f"RISK ANALYSIS FAILED: {e}")
-        return {"score": "Low", "flags": []}
+        print(f"Chat stream failed after {len(parts)} deltas: {e}")
+        log_audit_event(user_id, "SEARCH_QUERY_FAILED", "query_engine", f"Query: {query[:50]}... ({type(e).__name__})")
+        yield sse_event('error', {'message': ANSWER_ERROR_MESSAGE, 'partial': bool(parts)})
+        return
+    
+    answer = ''.join(parts)
+    finish_chat(user_id, session_id, query, answer)
+    remember_answer(query, selected_doc_id, answer, hits, cache_version, case_ids, vector_future)
+    total_ms = int((time.time() - started) * 1000)
+    print(f"DEBUG: Stream complete: {len(answer)} chars, ttft={first_token_ms} ms, total={total_ms} ms")
+    yield sse_event('done', {'ttft_ms': first_token_ms, 'total_ms': total_ms, 'cached': False})
+
+def encode_cursor(last_key):
+    return base64.urlsafe_b64encode(json.dumps(last_key, default=str).encode()).decode() if last_key else None
+
+def decode_cursor(cursor):
+    """Raises ValueError for a cursor this API didn't issue."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def format_document(item):
+    return {
+        'id': item.get('doc_id'),
+        'name': document_name(item.get('doc_id') or ''),
+        'date': item.get('timestamp'),
+        'updated_at': item.get('updated_at'),
+        'status': item.get('status', 'Indexed'),
+        'risk_score': item.get('risk_score', 'Low'),
+        'risk_flags': item.get('risk_flags', []),
+        'risk_status': item.get('risk_status', 'Complete'),
+        'risk_clauses': item.get('risk_clauses', [])
+    }
+
+def documents_etag(md_table, case_id, *params):
+    """
+    Every write to a metadata item bumps its updated_at, so the newest updated_at in the case
+    (one single-item index read) identifies the listing; the request parameters pick the page.
+    """
+    response = md_table.query(
+        IndexName=DOCUMENTS_INDEX,
+        KeyConditionExpression=Key('case_id').eq(case_id),
+        ScanIndexForward=False,
+        Limit=1
+    )
+    latest = [item.get('updated_at') for item in response.get('Items', [])]
+    return '"' + hashlib.sha256(json.dumps([case_id, latest, *params]).encode()).hexdigest()[:32] + '"'
 
+def list_documents(md_table, case_id, limit, cursor=None, since=None):
+    """
+    One page of a case's documents. Without `since`: newest first, `cursor` continues the listing.
+    With `since`: only documents changed after that updated_at watermark, oldest change first.
+    Returns (documents, next_cursor, watermark).
+    """
+    key_condition = Key('case_id').eq(case_id)
+    if since:
+        key_condition = key_condition & Key('updated_at').gt(since)
+    kwargs = {
+        'IndexName': DOCUMENTS_INDEX,
+        'KeyConditionExpression': key_condition,
+        'ScanIndexForward': bool(since),
+        'Limit': limit
+    }
+    if cursor:
+        kwargs['ExclusiveStartKey'] = decode_cursor(cursor)
+    response = md_table.query(**kwargs)
+    items = response.get('Items', [])
+    watermark = max([since or ''] + [item.get('updated_at', '') for item in items]) or None
+    return [format_document(item) for item in items], encode_cursor(response.get('LastEvaluatedKey')), watermark
+
+def list_s3_documents(limit, cursor=None):
+    """Fallback listing straight from the bucket, one page per call, without ingest artifacts."""
+    kwargs = {'Bucket': BUCKET_NAME, 'MaxKeys': limit}
+    if cursor:
+        kwargs['ContinuationToken'] = cursor
+    response = clients.s3().list_objects_v2(**kwargs)
+    documents = []
+    for obj in response.get('Contents', []):
+        if obj['Key'].startswith(ARTIFACT_PREFIX):
+            continue
+        documents.append({
+            'id': obj['Key'],
+            'name': document_name(obj['Key']),
+            'date': obj['LastModified'].isoformat(),
+            'status': 'Indexed',
+            'risk_score': 'Low', # Default
+            'risk_flags': []
+        })
+    return documents, response.get('NextContinuationToken')
+
+@audit.flushes
 def handler(event, context):
     try:
         print("DEBUG EVENT:", json.dumps(event), flush=True)
         print("DEBUG: VERSION 3.1 - LEXGUARD FIX")
         # Mock user identity for MVP (In prod, get from event.requestContext.authorizer)
-        user_id = "alice@firm.com"
+        user_id = DEFAULT_USER_ID
         
 # ... (Moving to top level)
 # This function was incorrectly placed inside handler
@@ -243,7 +457,7 @@ def handler(event, context):
                 "headers": {
                     "Access-Control-Allow-Origin": "*",
                     "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
-                    "Access-Control-Allow-Headers": "Content-Type, Authorization"
+                    "Access-Control-Allow-Headers": "Content-Type, Authorization, If-None-Match"
                 },
                 "body": ""
             }
@@ -255,82 +469,33 @@ def handler(event, context):
              try:
                  bucket = event['Records'][0]['s3']['bucket']['name']
                  key = event['Records'][0]['s3']['object']['key']
+                 case_id = case_id_for_key(key)
                  
-                 # Get File
-                 obj = s3_client.get_object(Bucket=bucket, Key=key)
-                 file_content = obj['Body'].read()
-                 
-                 # Extract Text (Simple PDF/Text handler)
-                 # Note: For production, we'd use a robust PDF parser. 
-                 # For now, we assume if it's PDF, we might need pypdf, but let's stick to simple text for the generic handler 
-                 # or assume text extraction happened elsewhere. 
-                 # If binary PDF, we strictly need pypdf. 
-                 # Let's import pypdf safely.
-                 
-                 text = ""
-                 if key.lower().endswith('.pdf'):
-                     try:
-                         import io
-                         from pypdf import PdfReader
-                         pdf_file = io.BytesIO(file_content)
-                         reader = PdfReader(pdf_file)
-                         for page in reader.pages:
-                             text += page.extract_text() + "\n"
-                     except ImportError:
-                         print("ERROR: pypdf not found. Indexing raw bytes as string.")
-                         text = str(file_content[:10000])
-                 else:
-                     text = file_content.decode('utf-8', errors='ignore')
-                     
-                 print(f"DEBUG: Extracted {len(text)} chars from {key}")
-                 
-                 # 1. RISK ANALYSIS (New for Veritas)
-                 risk_data = analyze_risk_scan(text)
-                 print(f"DEBUG: Risk Score: {risk_data['score']}")
-                 
-                 # 2. EMBED & INDEX (Pinecone)
-                 # Chunking (Simple overlap)
-                 chunk_size = 1000
-                 overlap = 200
-                 chunks = []
-                 for i in range(0, len(text), chunk_size - overlap):
-                     chunks.append(text[i:i + chunk_size])
-                     
-                 # Embed (Batch or Loop)
-                 index = get_pinecone_index()
-                 vectors = []
-                 
-                 for i, chunk in enumerate(chunks[:200]): # Limit to 200 chunks for demo
-                     emb = generate_embedding(chunk)
-                     vec_id = f"{key}#{i}"
-                     vectors.append({
-                        "id": vec_id,
-                        "values": emb,
-                        "metadata": {
-                            "text": chunk,
-                            "doc_id": key,
-                            "source": key
-                        }
-                     })
-                     
-                     if len(vectors) >= 20: # Batch upsert
-                         index.upsert(vectors=vectors)
-                         vectors = []
-                         
-                 if vectors:
-                     index.upsert(vectors=vectors)
+                 # 1. EMBED & INDEX (Pinecone)
+                 # Shared streaming pipeline: ranged S3 reads, page-by-page extraction,
+                 # incremental chunking and manifest diffing (see common/ingestion.py)
+                 index = get_pinecone_index(case_id)
+                 summary = index_document(index, bucket, key, case_id=case_id)
+                 if summary is None:
+                     print(f"DEBUG: Skipping unsupported file: {key}")
+                     return {"statusCode": 200, "body": "Skipped"}
+                 print(f"DEBUG: Extracted {summary['chars']} chars from {key}")
                      
-                 # 3. SAVE METADATA (DynamoDB) with RISK
+                 # 2. SAVE METADATA (DynamoDB)
                  # Save to metadata table for the UI list
-                 dynamodb.Table(os.environ.get('TABLE_NAME', 'CaseChat_Metadata')).put_item(Item={
-                     'case_id': 'case_001', # Hardcoded Partition Key for Demo
+                 timestamp = datetime.datetime.utcnow().isoformat()
+                 clients.table(os.environ.get('TABLE_NAME', 'CaseChat_Metadata')).put_item(Item={
+                     'case_id': case_id,
                      'doc_id': key,
-                     'timestamp': datetime.datetime.utcnow().isoformat(),
+                     'timestamp': timestamp,
+                     'updated_at': timestamp,
                      'status': 'Indexed',
-                     'risk_score': risk_data.get('score', 'Low'),
-                     'risk_flags': risk_data.get('flags', [])
+                     'risk_status': 'Pending'
                  })
                  
+                 # 3. RISK ANALYSIS over every chunk (map-reduce, see common/risk.py); queued when a worker exists
+                 request_risk_analysis(case_id, key, get_queue())
+                 
                  return {"statusCode": 200, "body": "Ingestion Complete"}
                  
              except Exception as e:
@@ -340,9 +505,13 @@ def handler(event, context):
         if (path == '/upload-url' and method == 'GET') or route_key == 'GET /upload-url':
              filename = event.get('queryStringParameters', {}).get('filename', 'evidence.pdf')
              content_type = event.get('queryStringParameters', {}).get('contentType', 'application/pdf')
-             key = f"{filename}" 
+             case_id = (event.get('queryStringParameters') or {}).get('caseId') or DEFAULT_CASE_ID
+             if '/' in case_id:
+                 return {"statusCode": 400, "body": json.dumps({"error": "Invalid caseId"})}
+             # The S3 trigger reads the case back from the key (see common/ingestion.py)
+             key = upload_key(case_id, filename)
              
-             presigned_url = s3_client.generate_presigned_url(
+             presigned_url = clients.s3().generate_presigned_url(
                 ClientMethod='put_object',
                 Params={
                     'Bucket': BUCKET_NAME,
@@ -354,80 +523,77 @@ def handler(event, context):
              
              return {
                 "statusCode": 200,
-                "body": json.dumps({"uploadURL": presigned_url, "key": key})
+                "body": json.dumps({"uploadURL": presigned_url, "key": key, "caseId": case_id})
              }
 
         if (path == '/documents' and method == 'GET') or route_key == 'GET /documents':
              print("DEBUG: Listing documents from Metadata Table (Veritas Mode)")
-             # We should read from DynamoDB now to get the Risk Scores, not S3
-             # But if table is empty, fallback to s3 list?
-             # Let's stick to scanning the DynamoDB table we just wrote to.
+             params = event.get('queryStringParameters') or {}
+             request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+             case_id = params.get('caseId') or DEFAULT_CASE_ID
+             cursor = params.get('cursor')
+             since = params.get('since')
+             headers = {
+                 "Content-Type": "application/json",
+                 "Access-Control-Allow-Origin": "*",
+                 "Access-Control-Expose-Headers": "ETag",
+                 "Cache-Control": "no-cache"
+             }
+             try:
+                 limit = max(1, min(int(params.get('limit', DOCUMENTS_PAGE_SIZE)), DOCUMENTS_MAX_PAGE_SIZE))
+             except ValueError:
+                 return {"statusCode": 400, "headers": headers, "body": json.dumps("Invalid limit")}
              
              table_name = os.environ.get('TABLE_NAME', 'CaseChat_Metadata') # Ensure variable is set
              try:
-                 md_table = dynamodb.Table(table_name)
-                 response = md_table.scan()
-                 items = response.get('Items', [])
-                 
-                 # Format for UI
-                 documents = []
-                 for item in items:
-                     documents.append({
-                         'id': item.get('doc_id'),
-                         'name': item.get('doc_id'),
-                         'date': item.get('timestamp'),
-                         'status': item.get('status', 'Indexed'),
-                         'risk_score': item.get('risk_score', 'Low'),
-                         'risk_flags': item.get('risk_flags', [])
-                     })
-                     
+                 md_table = clients.table(table_name)
+                 # Pollers send back the ETag they last saw; nothing changed -> 304 without reading the page
+                 etag = documents_etag(md_table, case_id, limit, cursor, since)
+                 if request_headers.get('if-none-match') == etag:
+                     return {"statusCode": 304, "headers": {**headers, "ETag": etag}, "body": ""}
+                 documents, next_cursor, watermark = list_documents(md_table, case_id, limit, cursor, since)
                  return {
                     "statusCode": 200,
-                    "headers": {
-                        "Content-Type": "application/json",
-                        "Access-Control-Allow-Origin": "*"
-                    },
-                    "body": json.dumps(documents, default=str)
+                    "headers": {**headers, "ETag": etag},
+                    "body": json.dumps({"documents": documents, "cursor": next_cursor, "watermark": watermark}, default=str)
                 }
-             except:
-                  # Fallback to S3 list if DynamoDB fails or is empty for old docs
-                 print("DEBUG: Fallback to S3 Listing")
-                 response = s3_client.list_objects_v2(Bucket=BUCKET_NAME)
-                 documents = []
-                 if 'Contents' in response:
-                     for obj in response['Contents']:
-                         documents.append({
-                             'id': obj['Key'],
-                             'name': obj['Key'],
-                             'date': obj['LastModified'].isoformat(),
-                             'status': 'Indexed',
-                             'risk_score': 'Low', # Default
-                             'risk_flags': []
-                         })
+             except ValueError as e:
+                 return {"statusCode": 400, "headers": headers, "body": json.dumps(str(e))}
+             except Exception as e:
+                 # Fallback to S3 list if DynamoDB fails (cursors are then S3 continuation tokens)
+                 print(f"DEBUG: Fallback to S3 Listing ({e})")
+                 documents, next_cursor = list_s3_documents(limit, cursor)
                  return {
                     "statusCode": 200,
-                    "headers": {
-                        "Content-Type": "application/json",
-                        "Access-Control-Allow-Origin": "*"
-                    },
-                    "body": json.dumps(documents, default=str)
+                    "headers": headers,
+                    "body": json.dumps({"documents": documents, "cursor": next_cursor, "watermark": None}, default=str)
                 }
 
         elif (path == '/audit' and method == 'GET') or route_key == 'GET /audit':
-             print("DEBUG: Scanning Audit Table")
-             response = audit_table.scan(Limit=20) 
-             items = response.get('Items', [])
-             
-             # Sort by timestamp desc
-             items.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+             print("DEBUG: Querying Audit Table")
+             # ?limit&from&to&user&action&order=asc|desc&cursor (see audit.query_events)
+             params = event.get('queryStringParameters') or {}
+             headers = {
+                "Content-Type": "application/json",
+                "Access-Control-Allow-Origin": "*"
+             }
+             try:
+                 events, next_cursor = audit.query_events(
+                     limit=params.get('limit', audit.AUDIT_PAGE_SIZE),
+                     start=params.get('from'),
+                     end=params.get('to'),
+                     user_id=params.get('user'),
+                     action=params.get('action'),
+                     descending=params.get('order', 'desc') != 'asc',
+                     cursor=params.get('cursor')
+                 )
+             except ValueError as e:
+                 return {"statusCode": 400, "headers": headers, "body": json.dumps(str(e))}
              
              return {
                  "statusCode": 200,
-                 "headers": {
-                    "Content-Type": "application/json",
-                    "Access-Control-Allow-Origin": "*"
-                },
-                 "body": json.dumps(items, default=str)
+                 "headers": headers,
+                 "body": json.dumps({"events": events, "cursor": next_cursor}, default=str)
              }
         
         # DEFAULT: CHAT HANDLER (POST)
@@ -437,74 +603,56 @@ def handler(event, context):
             query = body.get('query')
             selected_doc_id = body.get('docId', None) # Support filtering
             session_id = body.get('sessionId', 'default-session')
+            # One case (caseId) or several (caseIds); each case is its own vector namespace
+            case_ids = body.get('caseIds') or [body.get('caseId') or DEFAULT_CASE_ID]
+            if not isinstance(case_ids, list) or not all(isinstance(c, str) and c for c in case_ids):
+                return {"statusCode": 400, "body": "caseIds must be a list of case IDs"}
         else:
              print("DEBUG: No Body found")
              return {"statusCode": 400, "body": "Missing query/body"}
 
         print(f"DEBUG: Processing query: {query} (Doc: {selected_doc_id}) Session: {session_id}")
 
-        # AUDIT LOG: SEARCH_INIT
-        log_audit_event(user_id, "SEARCH_QUERY", "vector_store", f"Query length: {len(query)}")
-        
-        # Load History
-        history = load_history(session_id)
-        
-        # 1. Embed Query
-        query_vector = generate_embedding(query)
-        
-        # 2. Search Pinecone
-        index = get_pinecone_index()
-        
-        filter_dict = {}
-        if selected_doc_id:
-            filter_dict = {"doc_id": selected_doc_id}
-
-        # Dynamic top_k strategy
-        search_k = 10
-        if "termination" in query.lower():
-            print("DEBUG: Keyword 'termination' detected. Boosting top_k to 8 (Titan Optimized).")
-            # Titan struggles with too much noise, 8 is better than 15
-            search_k = 8
-
-        results = index.query(
-            vector=query_vector,
-            top_k=search_k, 
-            include_metadata=True,
-            filter=filter_dict if filter_dict else None
-        )
-        
-        # Extract text from metadata
-        hits = []
-        for match in results['matches']:
-            # Convert Pinecone object to dict explicitly if needed, but usually .to_dict() or simple dict access works
-            # Safest is to rebuild the dict to ensure serializability
-            hit = {
-                'id': match['id'],
-                'score': float(match['score']),
-                'metadata': match.get('metadata', {})
+        if (path == '/chat/stream' and method == 'POST') or route_key == 'POST /chat/stream':
+            # API Gateway buffers Lambda responses, so the events arrive together here (the
+            # frontend uses /chat unless STREAM_CHAT is set); local_server.py serves the same
+            # generator incrementally.
+            return {
+                "statusCode": 200,
+                "headers": {
+                    "Content-Type": "text/event-stream",
+                    "Cache-Control": "no-cache",
+                    "Access-Control-Allow-Origin": "*"
+                },
+                "body": "".join(stream_chat(query, selected_doc_id, session_id, user_id, case_ids))
             }
-            hits.append(hit)
-        
-        context_text = ""
-        for hit in hits:
-             context_text += hit['metadata'].get('text', '') + "\n\n"
-        
-        # TRUNCATION to prevent ValidationException (Titan limit ~42k chars)
-        if len(context_text) > 35000:
-            print(f"DEBUG: Context too long ({len(context_text)} chars). Truncating to 35000.")
-            context_text = context_text[:35000] + "...(truncated)"
-        
-        print(f"DEBUG: Retrieved {len(context_text)} chars of context")
+
+        vector_future = chat_pool.submit(embed_query, query)
+        cached, cache_version = check_answer_cache(selected_doc_id, case_ids, vector_future)
+        if cached:
+            finish_chat(user_id, session_id, query, cached['answer'], cached=cached)
+            return {
+                "statusCode": 200,
+                "headers": {
+                    "Content-Type": "application/json",
+                    "Access-Control-Allow-Origin": "*"
+                },
+                "body": json.dumps({
+                    "answer": cached['answer'],
+                    "sources": cached['sources'],
+                    "sessionId": session_id,
+                    "cached": True
+                })
+            }
+
+        hits, context_text, history = retrieve_context(query, selected_doc_id, session_id, user_id, case_ids, vector_future)
         
         # 3. Generate Answer
         # Switch to Claude 3 Haiku (Standard modern fast model)
         answer = get_answer_from_bedrock(query, context_text, history, model_id='anthropic.claude-3-haiku-20240307-v1:0')
         
-        # Save History
-        save_history(session_id, query, answer)
-
-        # 4. Log to Audit
-        log_audit_event(user_id, "SEARCH_QUERY", "query_engine", f"Query: {query[:50]}...")
+        finish_chat(user_id, session_id, query, answer)
+        remember_answer(query, selected_doc_id, answer, hits, cache_version, case_ids, vector_future)
         
         return {
             "statusCode": 200,
@@ -1,55 +1,45 @@
 
 import json
-import time
 import os
-import boto3
 import datetime
 import hashlib
-from pinecone import Pinecone
-
-bedrock = boto3.client('bedrock-runtime')
-dynamodb = boto3.resource('dynamodb')
-audit_table = dynamodb.Table('CaseChat_Audit')
-history_table = dynamodb.Table('CaseChat_History')
-s3_client = boto3.client('s3')
+from common import clients
+from common.ingestion import case_id_for_key, upsert_chunks
+from common.prompts import input_budget, truncate_to_tokens
+from common.risk import prescreen_windows
+from common.vector_index import index_for
 
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
-PINECONE_API_KEY = os.environ.get('PINECONE_API_KEY')
-PINECONE_INDEX = os.environ.get('PINECONE_INDEX', 'casechat-index')
-
-def get_pinecone_index():
-    pc = Pinecone(api_key=PINECONE_API_KEY)
-    return pc.Index(PINECONE_INDEX)
+RISK_MODEL_ID = 'meta.llama3-8b-instruct-v1:0'
+RISK_MAX_TOKENS = 512
 
-def generate_embedding(text):
-    # RATE LIMIT FIX
-    time.sleep(1) 
-    body = json.dumps({"inputText": text})
-    response = bedrock.invoke_model(
-        modelId='amazon.titan-embed-text-v1',
-        contentType='application/json',
-        accept='application/json',
-        body=body
-    )
-    response_body = json.loads(response.get('body').read())
-    return response_body['embedding']
+def get_pinecone_index(case_id):
+    return index_for(case_id)
 
-def analyze_risk_scan(text):
-    try:
-        prompt = f"""
+def format_risk_prompt(text):
+    prompt = f"""
         Instruction: Act as a Senior Legal Risk Officer.
         Analyze:
-        {text[:12000]}
+        {text}
         
         Return JSON: {{ "score": "High"|"Medium"|"Low", "flags": ["Risk 1"] }}
         """
-        fmt_prompt = f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+    return f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+
+def analyze_risk_scan(text):
+    # Only the passages around liability/indemnity/termination/non-compete language go to the model
+    windows = prescreen_windows(text)
+    if not windows:
+        return {"score": "Low", "flags": []}
+    try:
+        budget = input_budget(RISK_MODEL_ID, RISK_MAX_TOKENS, format_risk_prompt(""))
+        fmt_prompt = format_risk_prompt(truncate_to_tokens(windows, budget, RISK_MODEL_ID))
         
-        response = bedrock.invoke_model(
-            modelId='meta.llama3-8b-instruct-v1:0',
+        response = clients.bedrock().invoke_model(
+            modelId=RISK_MODEL_ID,
             contentType='application/json',
             accept='application/json',
-            body=json.dumps({"prompt": fmt_prompt, "max_gen_len": 512})
+            body=json.dumps({"prompt": fmt_prompt, "max_gen_len": RISK_MAX_TOKENS})
         )
         res = json.loads(response.get('body').read())
         raw = res['generation'].strip()
@@ -71,7 +61,7 @@ def handler(event, context):
              print("DEBUG: S3 Trigger")
              bucket = event['Records'][0]['s3']['bucket']['name']
              key = event['Records'][0]['s3']['object']['key']
-             obj = s3_client.get_object(Bucket=bucket, Key=key)
+             obj = clients.s3().get_object(Bucket=bucket, Key=key)
              content = obj['Body'].read()
              
              text = ""
@@ -93,26 +83,17 @@ def handler(event, context):
              risk = analyze_risk_scan(text)
              print(f"DEBUG: Risk Score: {risk['score']}")
              
-             # Embed
-             index = get_pinecone_index()
-             chunks = [text[i:i+1000] for i in range(0, len(text), 800)]
-             vectors = []
-             for i, chunk in enumerate(chunks[:50]):
-                 emb = generate_embedding(chunk)
-                 vectors.append({
-                    "id": f"{key}#{i}",
-                    "values": emb,
-                    "metadata": {"text": chunk, "doc_id": key}
-                 })
-                 if len(vectors) >= 10:
-                     index.upsert(vectors=vectors)
-                     vectors = []
-                     
-             if vectors: index.upsert(vectors=vectors)
+             # Embed (text goes to the chunk store, never into Pinecone metadata)
+             case_id = case_id_for_key(key)
+             items = [
+                 (f"{key}#{n}", {'text': text[i:i+1000], 'page_start': 1, 'page_end': 1, 'char_offset': i})
+                 for n, i in enumerate(range(0, len(text), 800))
+             ]
+             upsert_chunks(get_pinecone_index(case_id), key, case_id, items[:50])
              
              # Metadata
-             dynamodb.Table(os.environ.get('TABLE_NAME', 'CaseChat_Metadata')).put_item(Item={
-                 'case_id': 'case_001',
+             clients.table(os.environ.get('TABLE_NAME', 'CaseChat_Metadata')).put_item(Item={
+                 'case_id': case_id,
                  'doc_id': key,
                  'timestamp': datetime.datetime.utcnow().isoformat(),
                  'status': 'Indexed',
@@ -125,7 +106,7 @@ def handler(event, context):
         # API HANDLERS (Simplified)
         path = event.get('rawPath') or event.get('path')
         if path == '/documents':
-             resp = dynamodb.Table(os.environ.get('TABLE_NAME', 'CaseChat_Metadata')).scan()
+             resp = clients.table(os.environ.get('TABLE_NAME', 'CaseChat_Metadata')).scan()
              items = []
              for i in resp.get('Items', []):
                  items.append({
@@ -0,0 +1,148 @@
+import math
+import os
+import re
+
+from common.prompts import count_tokens, truncate_to_tokens
+
+# Post-retrieval stage: drop near-duplicate chunks, pick a diverse set with MMR,
+# stitch adjacent chunks of the same document back together (removing the splitter
+# overlap) and pack the result into the token budget the prompt builder allots to context.
+MMR_LAMBDA = float(os.environ.get('MMR_LAMBDA', '0.7'))
+DUPLICATE_COSINE = float(os.environ.get('DUPLICATE_COSINE', '0.95'))
+DUPLICATE_JACCARD = float(os.environ.get('DUPLICATE_JACCARD', '0.8'))
+PASSAGE_SEPARATOR = "\n\n"
+
+WORD_RE = re.compile(r"\w+")
+
+
+def chunk_span(hit):
+    """
+    (doc_id, start, end) of the chunk in its document's text, or None without a char_offset.
+    Vector IDs are content-stable ({doc_id}#{n}), so they say nothing about where a chunk sits.
+    """
+    start = hit['metadata'].get('char_offset')
+    if start is None:
+        return None
+    doc_id = hit['metadata'].get('doc_id') or hit['id'].rpartition('#')[0]
+    return doc_id, int(start), int(start) + len(hit['text'])
+
+
+def shingles(text, size=3):
+    words = WORD_RE.findall(text.lower())
+    return {' '.join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def similarity(a, b):
+    """Vector cosine when both hits carry values, word-shingle Jaccard otherwise (e.g. BM25-only hits)."""
+    if a.get('values') and b.get('values'):
+        return cosine(a['values'], b['values']), DUPLICATE_COSINE
+    sa, sb = a['shingles'], b['shingles']
+    return (len(sa & sb) / len(sa | sb) if sa and sb else 0.0), DUPLICATE_JACCARD
+
+
+def dedupe(hits):
+    """Hits arrive best first; a hit too similar to one already kept is dropped."""
+    kept = []
+    for hit in hits:
+        if all(sim < threshold for sim, threshold in (similarity(hit, other) for other in kept)):
+            kept.append(hit)
+    return kept
+
+
+def mmr(hits, budget):
+    """Maximal marginal relevance over the fused scores, stopping once the token budget is spent."""
+    remaining = list(hits)
+    selected = []
+    tokens = 0
+    while remaining and tokens < budget:
+        def marginal(hit):
+            redundancy = max((similarity(hit, other)[0] for other in selected), default=0.0)
+            return MMR_LAMBDA * hit['score'] - (1 - MMR_LAMBDA) * redundancy
+        best = max(remaining, key=marginal)
+        remaining.remove(best)
+        selected.append(best)
+        tokens += best['tokens']
+    return selected
+
+
+def overlap_length(first, second):
+    """
+    Characters at the start of `second` that repeat the end of `first`, or None when the two
+    aren't adjacent: `second` has to start inside (or right at the end of) `first` and run past it.
+    """
+    a, b = chunk_span(first), chunk_span(second)
+    if a is None or b is None or a[0] != b[0]:
+        return None
+    if not a[1] < b[1] <= a[2] or b[2] <= a[2]:
+        return None
+    return a[2] - b[1]
+
+
+def merge_adjacent(hits):
+    """
+    Joins selected chunks that are consecutive in the same document into one passage.
+    Passages are ordered by their best-ranked chunk.
+    """
+    rank = {hit['id']: r for r, hit in enumerate(hits)}
+    runs = []
+    # Chunks without an offset can't be placed, so they stay passages of their own
+    for hit in sorted(hits, key=lambda hit: (chunk_span(hit) is None, chunk_span(hit) or (hit['id'],))):
+        if runs and overlap_length(runs[-1][-1], hit) is not None:
+            runs[-1].append(hit)
+        else:
+            runs.append([hit])
+    passages = []
+    for run in sorted(runs, key=lambda run: min(rank[h['id']] for h in run)):
+        text = run[0]['text']
+        for previous, hit in zip(run, run[1:]):
+            text += hit['text'][overlap_length(previous, hit):]
+        passages.append({'hits': run, 'text': text, 'tokens': run[0]['tokens'] if len(run) == 1 else None})
+    return passages
+
+
+def pack(passages, budget, model_id=None):
+    """Returns (context_text, tokens, packed passages)."""
+    packed = []
+    tokens = 0
+    separator = count_tokens(PASSAGE_SEPARATOR, model_id)
+    for passage in passages:
+        cost = passage['tokens'] if passage['tokens'] is not None else count_tokens(passage['text'], model_id)
+        cost += separator
+        if tokens + cost > budget:
+            if packed:
+                continue
+            # A single passage larger than the whole budget is cut at a sentence boundary rather than dropped
+            passage['text'] = truncate_to_tokens(passage['text'], budget - separator, model_id)
+            cost = count_tokens(passage['text'], model_id) + separator
+        packed.append(passage)
+        tokens += cost
+    return PASSAGE_SEPARATOR.join(passage['text'] for passage in packed), tokens, packed
+
+
+def build_context(hits, budget, model_id=None):
+    """
+    hits: fused retrieval hits, best first, with metadata['text'] filled in, optional 'values'
+    and optional 'tokens' (the count cached in the chunk store).
+    Returns (context_text, used_hits); used_hits are the hits whose text made it into the context.
+    """
+    candidates = []
+    for hit in hits:
+        text = hit['metadata'].get('text', '')
+        if text:
+            tokens = hit.get('tokens') or count_tokens(text, model_id)
+            candidates.append({**hit, 'text': text, 'tokens': tokens, 'shingles': shingles(text)})
+    unique = dedupe(candidates)
+    selected = mmr(unique, budget)
+    passages = merge_adjacent(selected)
+    context_text, tokens, packed = pack(passages, budget, model_id)
+    used_ids = {hit['id'] for passage in packed for hit in passage['hits']}
+    used_hits = [hit for hit in hits if hit['id'] in used_ids]
+    print(f"DEBUG: Rerank kept {len(used_hits)}/{len(hits)} hits ({len(candidates) - len(unique)} duplicates) "
+          f"in {len(packed)} passages, ~{tokens} tokens")
+    return context_text, used_hits
@@ -0,0 +1,62 @@
+import os
+
+from boto3.dynamodb.types import Binary
+
+from common import background, clients
+from common.answer_cache import VERSION_KEY, AnswerCache, DynamoDBAnswerBackend
+
+
+class FakeTable:
+    """Stores items the way DynamoDB hands them back: binary attributes come out as Binary."""
+
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, Item):
+        self.items[(Item['scope'], Item['entry_id'])] = {
+            k: Binary(v) if isinstance(v, bytes) else v for k, v in Item.items()
+        }
+
+    def get_item(self, Key):
+        item = self.items.get((Key['scope'], Key['entry_id']))
+        return {'Item': item} if item else {}
+
+    def query(self, **kwargs):
+        entries = [item for (_, entry_id), item in self.items.items() if entry_id != VERSION_KEY]
+        entries.sort(key=lambda item: item['entry_id'], reverse=True)
+        return {'Items': entries[:kwargs.get('Limit')]}
+
+
+def use_fake_table(monkeypatch, tmp_path):
+    table = FakeTable()
+    monkeypatch.setattr(clients, 'table', lambda name: table)
+    monkeypatch.setattr(background, 'BACKGROUND_WRITES', True)
+    monkeypatch.setattr(background, 'WRITE_SPOOL_DIR', str(tmp_path))
+    return table
+
+
+def test_dynamodb_put_then_lookup(monkeypatch, tmp_path):
+    table = use_fake_table(monkeypatch, tmp_path)
+    monkeypatch.setattr(background, '_writer', background.BackgroundWriter())
+    cache = AnswerCache(DynamoDBAnswerBackend('answers'))
+
+    cache.store('doc-1', [0.6, 0.8, 0.0], 'Who pays?', 'The tenant.', [{'id': 'doc-1#0'}], 0, 'case-1')
+    assert background.flush(5)
+    assert len(table.items) == 1
+
+    hit, version = cache.lookup('doc-1', [0.3, 0.4, 0.0], 'case-1')
+    assert version == 0
+    assert hit['answer'] == 'The tenant.'
+    assert hit['sources'] == [{'id': 'doc-1#0'}]
+    assert hit['similarity'] > 0.99
+
+
+def test_spooled_binary_item_is_replayed(monkeypatch, tmp_path):
+    table = use_fake_table(monkeypatch, tmp_path)
+    spool = tmp_path / os.path.basename(background.spool_path_for_process())
+    spool.write_text(background.spool_line('w1', 'answers', [{'scope': 's', 'entry_id': '1', 'vector': b'\x00\xff'}]))
+
+    assert background.BackgroundWriter().flush(5)
+
+    assert table.items[('s', '1')]['vector'].value == b'\x00\xff'
+    assert not spool.exists()
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from common.extraction import iter_chunks
+
+WORDS = "the lessee shall indemnify lessor against claims arising under this agreement termination notice".split()
+
+
+def random_pages(seed, page_count=39):
+    rng = random.Random(seed)
+    pages = []
+    for number in range(1, page_count + 1):
+        paragraphs = []
+        for _ in range(rng.randint(1, 12)):
+            paragraph = " ".join(rng.choice(WORDS) for _ in range(rng.choice([5, 40, 120, 300, 900])))
+            if rng.random() < 0.3:
+                paragraph = paragraph.replace(" ", "\n", rng.randint(0, 30))
+            paragraphs.append(paragraph)
+        separator = rng.choice(["\n\n", "\n", "\n\n\n", " "])
+        pages.append((number, separator.join(paragraphs) + rng.choice(["\n", "\n\n", ""])))
+    return pages
+
+
+def page_of(pages, offset):
+    start = 0
+    found = pages[0][0]
+    for number, text in pages:
+        if start <= offset:
+            found = number
+        start += len(text)
+    return found
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('chunk_size, chunk_overlap', [(2000, 200), (500, 50)])
+def test_streamed_chunks_match_whole_document_split(seed, chunk_size, chunk_overlap):
+    pages = random_pages(seed)
+    text = "".join(page_text for _, page_text in pages)
+    expected = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text)
+
+    chunks = list(iter_chunks(iter(pages), chunk_size, chunk_overlap))
+
+    assert [chunk['text'] for chunk in chunks] == expected
+    for chunk in chunks:
+        assert text[chunk['char_offset']:chunk['char_offset'] + len(chunk['text'])] == chunk['text']
+        assert chunk['page_start'] == page_of(pages, chunk['char_offset'])
+        assert chunk['page_end'] == page_of(pages, chunk['char_offset'] + len(chunk['text']) - 1)
+
+
+def test_document_without_paragraph_breaks_matches_whole_document_split():
+    pages = [(number, text.replace("\n\n", "\n")) for number, text in random_pages(7, page_count=5)]
+    text = "".join(page_text for _, page_text in pages)
+    expected = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50).split_text(text)
+
+    assert [chunk['text'] for chunk in iter_chunks(iter(pages), 500, 50)] == expected
@@ -0,0 +1,35 @@
+import threading
+import time
+
+from common import artifacts, lexical
+
+
+def build_index(doc_id, texts):
+    builder = lexical.LexicalIndexBuilder(doc_id)
+    for n, text in enumerate(texts):
+        builder.add(f"{doc_id}#{n}", text)
+    return builder.build()
+
+
+def test_search_fetches_uncached_indexes_in_parallel(monkeypatch):
+    stored = {f"doc-{n}": build_index(f"doc-{n}", [f"clause {n} indemnify", "governing law"]) for n in range(32)}
+    in_flight = {'now': 0, 'max': 0}
+    lock = threading.Lock()
+
+    def slow_get_json(doc_id, name):
+        with lock:
+            in_flight['now'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['now'])
+        time.sleep(0.02)
+        with lock:
+            in_flight['now'] -= 1
+        return stored.get(doc_id)
+
+    monkeypatch.setattr(artifacts, 'get_json', slow_get_json)
+    monkeypatch.setattr(lexical, '_cache', lexical.OrderedDict())
+
+    hits = lexical.search("indemnify", list(stored) + ['missing'], top_k=50)
+
+    assert sorted(vid for vid, _ in hits) == sorted(f"doc-{n}#0" for n in range(32))
+    assert 1 < in_flight['max'] <= lexical.LEXICAL_FETCH_WORKERS
+    assert [ix['doc_id'] for ix in lexical.load_lexical_indexes(['doc-3', 'missing', 'doc-1'])] == ['doc-3', 'doc-1']
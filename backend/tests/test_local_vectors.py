@@ -0,0 +1,88 @@
+import multiprocessing
+
+import numpy as np
+
+from common import local_vectors
+from common.local_vectors import LocalVectorStore
+
+
+def vectors(doc_id, count, dim=8, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        {'id': f"{doc_id}#{n}", 'values': rng.normal(size=dim).tolist(), 'metadata': {'doc_id': doc_id, 'case_id': 'c'}}
+        for n in range(count)
+    ]
+
+
+def all_ids(store, namespace='ns'):
+    return {vector_id for page in store.list(namespace=namespace) for vector_id in page}
+
+
+def test_stores_sharing_a_directory_see_each_others_writes(tmp_path):
+    first = LocalVectorStore('idx', root=str(tmp_path))
+    second = LocalVectorStore('idx', root=str(tmp_path))
+    probe = [1.0] * 8
+
+    first.upsert(vectors('d', 5, seed=1), 'ns')
+    assert len(second.query(probe, 20, 'ns')['matches']) == 5  # second loads the segment now
+    second.upsert(vectors('e', 5, seed=2), 'ns')
+    first.upsert(vectors('f', 5, seed=3), 'ns')
+
+    for store in (first, second):
+        matches = store.query(probe, 50, 'ns')['matches']
+        assert len(matches) == 15
+        assert {m['id'] for m in store.query(probe, 50, 'ns', filter={'doc_id': 'e'})['matches']} == \
+            {f"e#{n}" for n in range(5)}
+    # Every id points at its own row, whichever store wrote it
+    e = vectors('e', 5, seed=2)
+    fetched = first.fetch([v['id'] for v in e], 'ns')
+    for vector in e:
+        expected = np.asarray(vector['values']) / np.linalg.norm(vector['values'])
+        assert np.allclose(fetched[vector['id']]['values'], expected, atol=1e-6)
+
+    second.delete(['d#0', 'f#4'], 'ns')
+    assert len(first.query(probe, 50, 'ns')['matches']) == 13
+
+
+def test_compaction_by_one_store_is_picked_up_by_the_other(tmp_path, monkeypatch):
+    monkeypatch.setattr(local_vectors, 'INITIAL_CAPACITY', 4)
+    first = LocalVectorStore('idx', root=str(tmp_path))
+    second = LocalVectorStore('idx', root=str(tmp_path))
+    probe = [1.0] * 8
+    second.upsert(vectors('a', 6, seed=4), 'ns')
+    assert len(second.query(probe, 50, 'ns')['matches']) == 6
+
+    for seed in range(5, 9):  # re-ingesting retires rows until first compacts
+        first.upsert(vectors('a', 6, seed=seed), 'ns')
+
+    latest = {v['id']: v['values'] for v in vectors('a', 6, seed=8)}
+    matches = second.query(probe, 50, 'ns', include_values=True)['matches']
+    assert len(matches) == 6
+    for match in matches:
+        expected = np.asarray(latest[match['id']]) / np.linalg.norm(latest[match['id']])
+        assert np.allclose(match['values'], expected, atol=1e-6)
+
+
+def upsert_from_process(root, doc_id, seed):
+    store = LocalVectorStore('idx', root=root)
+    for batch in range(10):
+        store.upsert(vectors(f"{doc_id}{batch}", 5, seed=seed + batch), 'ns')
+
+
+def test_concurrent_processes_append_without_overwriting(tmp_path):
+    processes = [
+        multiprocessing.get_context('spawn').Process(target=upsert_from_process, args=(str(tmp_path), doc_id, seed))
+        for doc_id, seed in (('p', 100), ('q', 200), ('r', 300))
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    store = LocalVectorStore('idx', root=str(tmp_path))
+    assert len(all_ids(store)) == 150
+    assert len(store.query([1.0] * 8, 200, 'ns')['matches']) == 150
+    for doc_id in ('p3', 'q7', 'r9'):
+        assert {m['metadata']['doc_id'] for m in store.query([1.0] * 8, 10, 'ns', filter={'doc_id': doc_id})['matches']} \
+            == {doc_id}
@@ -0,0 +1,33 @@
+from query.rerank import merge_adjacent
+
+DOCUMENT = "".join(f"Clause {n}: the tenant shall keep the premises in good repair. " for n in range(40))
+
+
+def hit(vector_id, start, length):
+    text = DOCUMENT[start:start + length]
+    return {'id': vector_id, 'text': text, 'tokens': len(text.split()),
+            'metadata': {'doc_id': 'lease.pdf', 'char_offset': start}}
+
+
+def test_adjacency_follows_offsets_not_ids():
+    # IDs are content-stable after re-ingestion, so '#1' and '#2' need not be neighbours
+    first = hit('lease.pdf#1', 0, 300)
+    far = hit('lease.pdf#2', 1200, 300)
+    overlapping = hit('lease.pdf#7', 250, 300)
+
+    passages = merge_adjacent([far, first, overlapping])
+
+    assert [[h['id'] for h in p['hits']] for p in passages] == [['lease.pdf#2'], ['lease.pdf#1', 'lease.pdf#7']]
+    assert passages[0]['text'] == DOCUMENT[1200:1500]
+    assert passages[1]['text'] == DOCUMENT[0:550]
+
+
+def test_chunks_without_offsets_or_contained_are_not_glued():
+    outer = hit('lease.pdf#0', 0, 400)
+    inner = hit('lease.pdf#1', 100, 200)
+    unplaced = {**hit('lease.pdf#2', 400, 100), 'metadata': {'doc_id': 'lease.pdf'}}
+
+    passages = merge_adjacent([outer, inner, unplaced])
+
+    assert [len(p['hits']) for p in passages] == [1, 1, 1]
+    assert [p['text'] for p in passages] == [DOCUMENT[0:400], DOCUMENT[100:300], DOCUMENT[400:500]]
@@ -0,0 +1,25 @@
+from common import risk
+
+FILLER = "The parties agree to the schedule set out in Annex B. " * 40
+
+
+def test_prescreen_sends_only_the_windows_around_risk_language():
+    chunks = [(0, {'text': FILLER}), (1, {'text': FILLER + "The Supplier shall indemnify the Customer. " + FILLER})]
+
+    screened = risk.prescreen(chunks)
+
+    assert [i for i, _ in screened] == [1]
+    assert "indemnify" in screened[0][1]['text']
+    assert len(screened[0][1]['text']) < 2 * risk.PRESCREEN_WINDOW + 100
+
+
+def test_missing_clauses_are_judged_on_the_whole_document():
+    chunks = [(0, {'text': "Either party may terminate this Agreement for convenience."}), (1, {'text': FILLER})]
+    # A batch that only saw chunk 1 reported the clause as missing
+    batch_findings = [{'chunk': 1, 'category': "Missing Termination for Convenience", 'risk': 'Medium', 'summary': "x"}]
+
+    assert risk.reduce_clauses(batch_findings, risk.absence_clauses(chunks)) == ('Low', [], [])
+
+    score, flags, clauses = risk.reduce_clauses([], risk.absence_clauses(chunks[1:]))
+    assert score == 'Medium'
+    assert [c['category'] for c in clauses] == ["Missing Termination for Convenience"]
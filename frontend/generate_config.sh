@@ -1,3 +1,4 @@
 #!/bin/bash
 # Generate config.js for the frontend, ensuring the path is correct from the repo root
-echo "window.config = { API_URL: \"$API_URL\" };" > frontend/public/config.js
+# STREAM_CHAT=true only where /chat/stream is served incrementally (local_server.py)
+echo "window.config = { API_URL: \"$API_URL\", STREAM_CHAT: ${STREAM_CHAT:-false} };" > frontend/public/config.js
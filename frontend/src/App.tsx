@@ -8,6 +8,7 @@ declare global {
     interface Window {
         config?: {
             API_URL?: string;
+            STREAM_CHAT?: boolean;
         };
     }
 }
@@ -15,6 +16,9 @@ declare global {
 function App() {
     // Read from window.config (injected at runtime) or fallback to local assumption
     const API_URL = window.config?.API_URL || 'http://localhost:8000'; // Matched with local_server.py
+    // Only local_server.py streams /chat/stream; behind API Gateway the Lambda buffers the whole
+    // response, so deployed builds use /chat unless STREAM_CHAT is set in config.js
+    const STREAM_CHAT = window.config?.STREAM_CHAT ?? !window.config?.API_URL;
     const [activeTab, setActiveTab] = useState<'dashboard' | 'chat' | 'admin'>('dashboard');
     const [query, setQuery] = useState('');
     const [chatHistory, setChatHistory] = useState<{ role: 'user' | 'ai', content: string, sources?: any[] }[]>([
@@ -26,10 +30,45 @@ function App() {
 
     const [isUploading, setIsUploading] = useState(false);
 
-    const fetchDocuments = () => {
-        fetch(`${API_URL}/documents`)
-            .then(res => res.json())
-            .then(data => setDocuments(Array.isArray(data) ? data : []))
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
+    // Polling state: the last ETag seen and the newest updated_at received
+    const documentsEtag = React.useRef('');
+    const documentsWatermark = React.useRef('');
+
+    const mergeDocuments = (incoming: any[]) => {
+        setDocuments(prev => {
+            const byId = new Map(prev.map(doc => [doc.id, doc]));
+            incoming.forEach(doc => byId.set(doc.id, doc));
+            return Array.from(byId.values()).sort((a, b) => (b.updated_at || '').localeCompare(a.updated_at || ''));
+        });
+    };
+
+    // No cursor: fetch what changed since the last call (the first page on the first call).
+    // With a cursor: fetch the next page of the full listing.
+    const fetchDocuments = (cursor?: string) => {
+        const params = new URLSearchParams();
+        const headers: Record<string, string> = {};
+        if (cursor) {
+            params.set('cursor', cursor);
+        } else if (documentsWatermark.current) {
+            params.set('since', documentsWatermark.current);
+            if (documentsEtag.current) headers['If-None-Match'] = documentsEtag.current;
+        }
+        return fetch(`${API_URL}/documents?${params}`, { headers })
+            .then(res => {
+                if (res.status === 304) return null;
+                if (!cursor) documentsEtag.current = res.headers.get('ETag') || '';
+                return res.json();
+            })
+            .then(data => {
+                if (!data) return;
+                mergeDocuments(data.documents || []);
+                if (data.watermark && data.watermark > documentsWatermark.current) {
+                    documentsWatermark.current = data.watermark;
+                }
+                // Deltas carry their own cursor but the watermark already covers it
+                if (cursor || !params.has('since')) setNextCursor(data.cursor || null);
+            })
             .catch(err => console.error("Failed to fetch docs:", err));
     };
 
@@ -105,23 +144,58 @@ function App() {
         // Temporary Loading State
         setChatHistory(prev => [...prev, { role: 'ai', content: 'Thinking...' } as const]);
 
+        // Replace the last (AI) message in place as stream events arrive
+        const updateAnswer = (patch: { content?: string, sources?: any[] }) => {
+            setChatHistory(prev => [
+                ...prev.slice(0, -1),
+                { ...prev[prev.length - 1], ...patch } as any
+            ]);
+        };
+
         try {
-            const res = await fetch(`${API_URL}/chat`, {
+            const res = await fetch(`${API_URL}/${STREAM_CHAT ? 'chat/stream' : 'chat'}`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ query, docId: selectedDoc || null, sessionId })
             });
-            const data = await res.json();
+            if (!STREAM_CHAT) {
+                const data = await res.json();
+                updateAnswer({ content: data.answer || "I couldn't find an answer.", sources: data.sources || [] });
+                return;
+            }
+            if (!res.ok || !res.body) throw new Error(`Chat stream failed: ${res.status}`);
 
-            // Replace Loading with Real Answer
-            setChatHistory(prev => [
-                ...prev.slice(0, -1), // Remove "Thinking..."
-                {
-                    role: 'ai',
-                    content: data.answer || "I couldn't find an answer.",
-                    sources: data.sources || []
-                } as any
-            ]);
+            // Server-Sent Events: sources first, then token deltas, then done
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let answer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\n\n');
+                buffer = events.pop() || '';
+                for (const raw of events) {
+                    const name = raw.match(/^event: (.*)$/m)?.[1];
+                    const data = raw.match(/^data: (.*)$/m)?.[1];
+                    if (!name || !data) continue;
+                    const payload = JSON.parse(data);
+                    if (name === 'sources') {
+                        updateAnswer({ sources: payload.sources || [] });
+                    } else if (name === 'token') {
+                        answer += payload.text;
+                        updateAnswer({ content: answer });
+                    } else if (name === 'done') {
+                        console.debug(`Time to first token: ${payload.ttft_ms} ms (total ${payload.total_ms} ms)`);
+                    } else if (name === 'error') {
+                        // The server stopped part-way; keep what arrived and say it is incomplete
+                        answer += (answer ? '\n\n' : '') + payload.message;
+                        updateAnswer({ content: answer });
+                    }
+                }
+            }
+            if (!answer) updateAnswer({ content: "I couldn't find an answer." });
         } catch (err) {
             console.error(err);
             setChatHistory(prev => [
@@ -218,7 +292,7 @@ function App() {
                                                                 'bg-green-100 text-green-800 border-green-200'
                                                             }`}>
                                                             {doc.risk_score === 'High' && <AlertCircle className="w-3 h-3 mr-1" />}
-                                                            {doc.risk_score || 'Low'} Risk
+                                                            {doc.risk_status === 'Pending' || doc.risk_status === 'Running' ? 'Analyzing...' : `${doc.risk_score || 'Low'} Risk`}
                                                         </span>
 
                                                         {/* Tooltip for Flags */}
@@ -248,6 +322,15 @@ function App() {
                                                 </td>
                                             </tr>
                                         )}
+                                        {nextCursor && (
+                                            <tr>
+                                                <td colSpan={4} className="px-6 py-4 text-center">
+                                                    <button onClick={() => fetchDocuments(nextCursor)} className="text-sm font-medium text-blue-600 hover:text-blue-800">
+                                                        Load more
+                                                    </button>
+                                                </td>
+                                            </tr>
+                                        )}
                                     </tbody>
                                 </table>
                             </div>
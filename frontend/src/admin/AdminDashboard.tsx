@@ -6,13 +6,27 @@ export const AdminDashboard: React.FC = () => {
     const API_URL = (window as any).config?.API_URL || 'http://localhost:3000/api';
     const [activeView, setActiveView] = useState<'overview' | 'users' | 'audit'>('overview');
     const [auditLogs, setAuditLogs] = useState<any[]>([]);
+    const [auditCursor, setAuditCursor] = useState<string | null>(null);
+    const [auditRequested, setAuditRequested] = useState(false);
 
-    // Fetch Audit Logs when view changes to 'audit'
-    if (activeView === 'audit' && auditLogs.length === 0) {
-        fetch(`${API_URL}/audit`)
+    // Latest events first; the cursor continues further back in time
+    const fetchAuditLogs = (cursor?: string) => {
+        const params = new URLSearchParams({ limit: '50' });
+        if (cursor) params.set('cursor', cursor);
+        fetch(`${API_URL}/audit?${params}`)
             .then(res => res.json())
-            .then(data => setAuditLogs(Array.isArray(data) ? data : []))
+            .then(data => {
+                const events = Array.isArray(data?.events) ? data.events : [];
+                setAuditLogs(prev => cursor ? [...prev, ...events] : events);
+                setAuditCursor(data?.cursor || null);
+            })
             .catch(err => console.error("Failed to fetch audit logs:", err));
+    };
+
+    // Fetch Audit Logs when view changes to 'audit'
+    if (activeView === 'audit' && !auditRequested) {
+        setAuditRequested(true);
+        fetchAuditLogs();
     }
 
     return (
@@ -156,6 +170,15 @@ export const AdminDashboard: React.FC = () => {
                                             </td>
                                         </tr>
                                     )}
+                                    {auditCursor && (
+                                        <tr>
+                                            <td colSpan={5} className="px-6 py-4 text-center">
+                                                <button onClick={() => fetchAuditLogs(auditCursor)} className="text-sm font-medium text-blue-600 hover:text-blue-800">
+                                                    Load older events
+                                                </button>
+                                            </td>
+                                        </tr>
+                                    )}
                                 </tbody>
                             </table>
                         </div>
@@ -41,6 +41,18 @@ resource "aws_dynamodb_table" "metadata" {
     name = "doc_id"
     type = "S"
   }
+  attribute {
+    name = "updated_at"
+    type = "S"
+  }
+
+  # GET /documents: a case's documents by last change, paginated and pollable with ?since=
+  global_secondary_index {
+    name            = "case_id-updated_at-index"
+    hash_key        = "case_id"
+    range_key       = "updated_at"
+    projection_type = "ALL"
+  }
 }
 
 resource "aws_dynamodb_table" "audit" {
@@ -57,6 +69,28 @@ resource "aws_dynamodb_table" "audit" {
     name = "timestamp"
     type = "S"
   }
+  attribute {
+    name = "bucket"
+    type = "S"
+  }
+  attribute {
+    name = "user_id"
+    type = "S"
+  }
+
+  # GET /audit reads (see common/audit.py): events by UTC day bucket, and by user
+  global_secondary_index {
+    name            = "bucket-timestamp-index"
+    hash_key        = "bucket"
+    range_key       = "timestamp"
+    projection_type = "ALL"
+  }
+  global_secondary_index {
+    name            = "user_id-timestamp-index"
+    hash_key        = "user_id"
+    range_key       = "timestamp"
+    projection_type = "ALL"
+  }
   stream_enabled   = true
   stream_view_type = "NEW_AND_OLD_IMAGES"
 }
@@ -77,6 +111,54 @@ resource "aws_dynamodb_table" "history_db" {
   }
 }
 
+resource "aws_dynamodb_table" "embedding_cache" {
+  name         = "CaseChat_EmbeddingCache"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "cache_key"
+
+  attribute {
+    name = "cache_key"
+    type = "S"
+  }
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
+resource "aws_dynamodb_table" "chunks" {
+  name         = "CaseChat_Chunks"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "vector_id"
+
+  attribute {
+    name = "vector_id"
+    type = "S"
+  }
+}
+
+resource "aws_dynamodb_table" "answer_cache" {
+  name         = "CaseChat_AnswerCache"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "scope"
+  range_key    = "entry_id"
+
+  attribute {
+    name = "scope"
+    type = "S"
+  }
+
+  attribute {
+    name = "entry_id"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
 # 3. S3 BUCKETS (Backend + Frontend)
 
 # Evidence Vault
@@ -209,9 +291,12 @@ resource "aws_iam_role_policy" "lambda_permissions" {
     Statement = [
       {
         Action = [
-          "s3:GetObject", "s3:PutObject", "s3:ListBucket", "s3:GeneratePresignedUrl",
-          "bedrock:InvokeModel",
-          "dynamodb:PutItem", "dynamodb:GetItem", "dynamodb:Query", "dynamodb:Scan"
+          "s3:GetObject", "s3:PutObject", "s3:DeleteObject", "s3:ListBucket", "s3:GeneratePresignedUrl",
+          "bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream",
+          "dynamodb:PutItem", "dynamodb:GetItem", "dynamodb:Query", "dynamodb:Scan",
+          "dynamodb:DeleteItem", "dynamodb:BatchGetItem", "dynamodb:BatchWriteItem", "dynamodb:UpdateItem",
+          "sqs:SendMessage", "sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes",
+          "sqs:ChangeMessageVisibility"
         ]
         Effect   = "Allow"
         Resource = "*" # Simplified for demo speed, or scope if strict
@@ -242,16 +327,108 @@ resource "aws_lambda_function" "ingest" {
 
   environment {
     variables = {
-      TABLE_NAME       = aws_dynamodb_table.metadata.name
-      AUDIT_TABLE_NAME = aws_dynamodb_table.audit.name
-      HISTORY_TABLE    = aws_dynamodb_table.history_db.name
-      BUCKET_NAME      = aws_s3_bucket.evidence_vault.bucket
-      PINECONE_API_KEY = var.pinecone_api_key
-      PINECONE_INDEX   = "casechat-index"
+      TABLE_NAME         = aws_dynamodb_table.metadata.name
+      AUDIT_TABLE_NAME   = aws_dynamodb_table.audit.name
+      HISTORY_TABLE      = aws_dynamodb_table.history_db.name
+      BUCKET_NAME        = aws_s3_bucket.evidence_vault.bucket
+      PINECONE_API_KEY   = var.pinecone_api_key
+      PINECONE_INDEX     = "casechat-index"
+      EMBED_CACHE        = "dynamodb"
+      EMBED_CACHE_TABLE  = aws_dynamodb_table.embedding_cache.name
+      CHUNK_TABLE        = aws_dynamodb_table.chunks.name
+      ANSWER_CACHE_TABLE = aws_dynamodb_table.answer_cache.name
+      EMBED_WORKERS      = "8"
+      INGEST_QUEUE_URL   = aws_sqs_queue.ingest.url
     }
   }
 }
 
+# Ingestion job queue: the S3-triggered ingest Lambda only enqueues, this worker does the work
+resource "aws_sqs_queue" "ingest_dlq" {
+  name                      = "casechat-ingest-dlq"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue" "ingest" {
+  name                       = "casechat-ingest-jobs"
+  visibility_timeout_seconds = 1800 # 6x the worker timeout, per the Lambda/SQS guidance
+  message_retention_seconds  = 345600
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.ingest_dlq.arn
+    maxReceiveCount     = 3
+  })
+}
+
+resource "aws_lambda_function" "ingest_worker" {
+  s3_bucket        = aws_s3_bucket.evidence_vault.id
+  s3_key           = aws_s3_object.lambda_code.key
+  function_name    = "casechat-ingest-worker-sls"
+  role             = aws_iam_role.lambda_role.arn
+  handler          = "ingest.index.worker_handler"
+
+  runtime          = "python3.12"
+  source_code_hash = data.archive_file.backend_zip.output_base64sha256
+  timeout          = 300
+  memory_size      = 512
+
+  environment {
+    variables = {
+      TABLE_NAME         = aws_dynamodb_table.metadata.name
+      BUCKET_NAME        = aws_s3_bucket.evidence_vault.bucket
+      PINECONE_API_KEY   = var.pinecone_api_key
+      PINECONE_INDEX     = "casechat-index"
+      EMBED_CACHE        = "dynamodb"
+      EMBED_CACHE_TABLE  = aws_dynamodb_table.embedding_cache.name
+      CHUNK_TABLE        = aws_dynamodb_table.chunks.name
+      ANSWER_CACHE_TABLE = aws_dynamodb_table.answer_cache.name
+      EMBED_WORKERS      = "8"
+      RISK_WORKERS       = "4"
+      AUDIT_TABLE_NAME   = aws_dynamodb_table.audit.name
+      AUDIT_HOT_DAYS     = "31"
+      INGEST_QUEUE_URL   = aws_sqs_queue.ingest.url
+    }
+  }
+}
+
+resource "aws_lambda_event_source_mapping" "ingest_worker" {
+  event_source_arn        = aws_sqs_queue.ingest.arn
+  function_name           = aws_lambda_function.ingest_worker.arn
+  batch_size              = 1
+  function_response_types = ["ReportBatchItemFailures"]
+
+  # Workers x EMBED_WORKERS is the peak number of in-flight Bedrock embedding calls
+  scaling_config {
+    maximum_concurrency = var.ingest_worker_concurrency
+  }
+}
+
+# Daily audit compaction: closed days move from CaseChat_Audit to archive segments in the
+# evidence bucket (see common/audit_archive.py), run as an 'audit_compact' worker job
+resource "aws_cloudwatch_event_rule" "audit_compact" {
+  name                = "casechat-audit-compact"
+  schedule_expression = "cron(30 2 * * ? *)"
+}
+
+resource "aws_cloudwatch_event_target" "audit_compact" {
+  rule  = aws_cloudwatch_event_rule.audit_compact.name
+  arn   = aws_sqs_queue.ingest.arn
+  input = jsonencode({ type = "audit_compact" })
+}
+
+resource "aws_sqs_queue_policy" "ingest" {
+  queue_url = aws_sqs_queue.ingest.id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [{
+      Effect    = "Allow"
+      Principal = { Service = "events.amazonaws.com" }
+      Action    = "sqs:SendMessage"
+      Resource  = aws_sqs_queue.ingest.arn
+      Condition = { ArnEquals = { "aws:SourceArn" = aws_cloudwatch_event_rule.audit_compact.arn } }
+    }]
+  })
+}
+
 resource "aws_lambda_function" "query" {
   s3_bucket        = aws_s3_bucket.evidence_vault.id
   s3_key           = aws_s3_object.lambda_code.key
@@ -266,12 +443,16 @@ resource "aws_lambda_function" "query" {
 
   environment {
     variables = {
-      TABLE_NAME       = aws_dynamodb_table.metadata.name
-      AUDIT_TABLE_NAME = aws_dynamodb_table.audit.name
-      HISTORY_TABLE    = aws_dynamodb_table.history_db.name
-      BUCKET_NAME      = aws_s3_bucket.evidence_vault.bucket
-      PINECONE_API_KEY = var.pinecone_api_key
-      PINECONE_INDEX   = "casechat-index"
+      TABLE_NAME         = aws_dynamodb_table.metadata.name
+      AUDIT_TABLE_NAME   = aws_dynamodb_table.audit.name
+      HISTORY_TABLE      = aws_dynamodb_table.history_db.name
+      BUCKET_NAME        = aws_s3_bucket.evidence_vault.bucket
+      PINECONE_API_KEY   = var.pinecone_api_key
+      PINECONE_INDEX     = "casechat-index"
+      EMBED_CACHE        = "dynamodb"
+      EMBED_CACHE_TABLE  = aws_dynamodb_table.embedding_cache.name
+      CHUNK_TABLE        = aws_dynamodb_table.chunks.name
+      ANSWER_CACHE_TABLE = aws_dynamodb_table.answer_cache.name
     }
   }
 }
@@ -306,10 +487,11 @@ resource "aws_apigatewayv2_api" "gateway" {
   name          = "casechat_sls_api"
   protocol_type = "HTTP"
   cors_configuration {
-    allow_origins = ["*"]
-    allow_methods = ["POST", "GET", "OPTIONS", "PUT"]
-    allow_headers = ["content-type", "authorization"]
-    max_age       = 300
+    allow_origins  = ["*"]
+    allow_methods  = ["POST", "GET", "OPTIONS", "PUT"]
+    allow_headers  = ["content-type", "authorization", "if-none-match"]
+    expose_headers = ["etag"]
+    max_age        = 300
   }
 }
 
@@ -9,3 +9,9 @@ variable "github_token" {
   type        = string
   sensitive   = true
 }
+
+variable "ingest_worker_concurrency" {
+  description = "Max concurrent ingest workers; keep workers x EMBED_WORKERS under the Bedrock embedding TPS quota"
+  type        = number
+  default     = 4
+}